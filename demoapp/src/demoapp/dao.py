@@ -2,9 +2,11 @@
 
 import datetime
 
+from twisted.internet import defer
 from twisted.application.service import Service
 
 from twoost.dbtools import DBUsingMixin
+from twoost.memcache import cached, invalidate_tags
 
 import logging
 logger = logging.getLogger(__name__)
@@ -14,23 +16,39 @@ class DBDaoService(DBUsingMixin, Service):
 
     def __init__(self, dbs, memcache=None):
         DBUsingMixin.__init__(self, dbs)
-        # TODO: add caching ;)
+        # `cached` methods run without caching when memcache is None
         self.memcache = memcache
 
     def startService(self):
         logger.debug("start dbdao")
         # do any required initialization here ...
 
+    @defer.inlineCallbacks
+    def _invalidate_events(self, result, event_id=None):
+        # db is already changed - don't fail caller because of memcache
+        if self.memcache is not None:
+            try:
+                yield invalidate_tags(self.memcache, ['events'])
+                if event_id is not None:
+                    yield self.get_event_by_id.invalidate(event_id)
+            except Exception:
+                logger.exception("can't invalidate cached events")
+        defer.returnValue(result)
+
     def delete_event_by_id(self, event_id):
-        return self.db_execute("DELETE FROM events WHERE id = ?", event_id)
+        d = self.db_execute("DELETE FROM events WHERE id = ?", event_id)
+        return d.addCallback(self._invalidate_events, event_id)
 
+    @cached(lambda event_id: "event:%s" % event_id, ttl=300)
     def get_event_by_id(self, event_id):
-        return self.db_query_one("SELECT * FROM events WHERE id = ?", event_id)
+        return self.db_fetch_one("SELECT * FROM events WHERE id = ?", event_id)
 
+    @cached(lambda dt: "events-after:%s" % dt.isoformat(), ttl=60, tags=['events'])
     def all_events_after_dt(self, dt):
-        return self.db_query_all("SELECT * FROM events WHERE created > ?", dt)
+        return self.db_fetch_all("SELECT * FROM events WHERE created > ?", dt)
 
     def insert_new_event(self, event):
-        return self.db_execute(
+        d = self.db_execute(
             "INSERT INTO events (id, payload, created) VALUES (?, ?, ?)",
             event['id'], event['payload'], datetime.datetime.now())
+        return d.addCallback(self._invalidate_events)
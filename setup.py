@@ -31,7 +31,7 @@ setup(
         'pika>=0.9.12',
         'psutil>=2.0',
         'argparse>=1.2',
-        'msgpack-python>=0.4',
+        'msgpack-python>=0.5.2',
         'raven>=4.0',
         'crontab>=0.20',
     ],
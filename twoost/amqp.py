@@ -7,8 +7,16 @@ Simple Twisted-style abstraction around AMQP pika library.
 """
 
 import json
+import zlib
 import uuid
+import signal
+import struct
+import hashlib
+import operator
+import traceback
+import multiprocessing
 import functools
+import collections
 
 try:
     import msgpack
@@ -21,20 +29,31 @@ if not msgpack:
     except ImportError:
         pass
 
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 import zope.interface
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, threads, task
 from twisted.internet.error import ConnectionDone
 from twisted.python import failure, components, reflect
 from twisted.application import service
 
 from pika.adapters.twisted_connection import TwistedProtocolConnection
-from pika.spec import BasicProperties as _BasicProperties
+from pika.channel import ContentFrameDispatcher
+from pika.spec import Basic as _Basic, BasicProperties as _BasicProperties
 from pika.connection import ConnectionParameters as _ConnectionParameters
 from pika.credentials import PlainCredentials as _PlainCredentials
 from pika.exceptions import MethodNotImplemented, ChannelClosed
 
-from twoost import timed, pclient
+from twoost import timed, pclient, metrics, cache, spool
 
 
 import logging
@@ -42,7 +61,10 @@ logger = logging.getLogger(__name__)
 
 
 __all__ = [
+    'register_codec',
+    'register_content_encoding',
     'AMQPMessage',
+    'AMQPStreamMessage',
     'AMQPService',
     'AMQPCollectionService',
     'IAMQPSchema',
@@ -105,17 +127,40 @@ class IAMQPSchemaBuilder(zope.interface.Interface):
 
 class AMQPMessage(object):
 
+    """Received message, body is decoded lazily (and only once) by `data`.
+
+    Fields of `deliver` and `properties` are exposed as plain properties.
+    """
+
+    __slots__ = ('body', 'deliver', 'properties', '_data')
+
+    _DELIVER_FIELDS = (
+        'consumer_tag', 'delivery_tag', 'redelivered', 'exchange', 'routing_key',
+    )
+
+    _PROPERTIES_FIELDS = (
+        'content_type', 'content_encoding', 'headers', 'delivery_mode',
+        'priority', 'correlation_id', 'reply_to', 'expiration', 'message_id',
+        'timestamp', 'type', 'user_id', 'app_id', 'cluster_id',
+    )
+
     def __init__(self, body, deliver, properties):
         self.body = body
         self.deliver = deliver
         self.properties = properties
+        self._data = _undecoded
 
     @property
     def data(self):
-        self.data = deserialize(self.body, self.content_type)
-        return self.data
+        d = self._data
+        if d is _undecoded:
+            p = self.properties
+            d = self._data = get_codec(p.content_type).loads(
+                decompress(self.body, p.content_encoding))
+        return d
 
     def __getattr__(self, name):
+        # rare fields only (e.g. `Basic.GetOk.message_count`)
         try:
             return getattr(self.properties, name)
         except AttributeError:
@@ -127,13 +172,22 @@ class AMQPMessage(object):
                 "body={s.body!r}>".format(s=self))
 
     def __dir__(self):
-        r = list(set(self.properties.__dict__.keys()
-                     + self.deliver.__dict__.keys()
-                     + self.__dict__.keys()))
+        r = list(set(list(self.properties.__dict__.keys())
+                     + list(self.deliver.__dict__.keys())
+                     + ['body', 'data', 'deliver', 'properties']))
         r.sort()
         return r
 
 
+_undecoded = object()
+
+for _f in AMQPMessage._DELIVER_FIELDS:
+    setattr(AMQPMessage, _f, property(operator.attrgetter('deliver.' + _f)))
+for _f in AMQPMessage._PROPERTIES_FIELDS:
+    setattr(AMQPMessage, _f, property(operator.attrgetter('properties.' + _f)))
+del _f
+
+
 class _NopeSerializer(object):
 
     @staticmethod
@@ -145,6 +199,22 @@ class _NopeSerializer(object):
         return s
 
 
+class _Codec(object):
+
+    def __init__(self, dumps, loads):
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _build_msgpack_codec():
+    if hasattr(msgpack, 'Packer'):
+        # reuse one packer (and its buffer) instead of creating new one per message
+        dumps = msgpack.Packer().pack
+    else:
+        dumps = msgpack.dumps
+    return _Codec(dumps, getattr(msgpack, 'unpackb', msgpack.loads))
+
+
 MESSAGE_SERIALIZERS = {
     None: _NopeSerializer,
     'plain/text': _NopeSerializer,
@@ -154,30 +224,306 @@ MESSAGE_SERIALIZERS = {
 }
 
 
+_MSGPACK_CONTENT_TYPES = ('msgpack', 'application/x-msgpack', 'application/msgpack')
+
 if msgpack:
-    MESSAGE_SERIALIZERS.update({
-        'msgpack': msgpack,
-        'application/x-msgpack': msgpack,
-        'application/msgpack': msgpack,
-    })
+    _msgpack_codec = _build_msgpack_codec()
+    MESSAGE_SERIALIZERS.update(dict.fromkeys(_MSGPACK_CONTENT_TYPES, _msgpack_codec))
+
+
+# content_type (as is) => serializer, filled lazily by `get_codec`
+_resolved_codecs = {}
+
+
+def register_codec(content_type, encoder, decoder):
+    """Register (or replace) serializer for messages with `content_type`.
+
+    `encoder` converts python object to string, `decoder` does the opposite.
+    F.e. to use faster json library:
+
+        register_codec('application/json', ujson.dumps, ujson.loads)
+    """
+    MESSAGE_SERIALIZERS[content_type.lower() if content_type else None] = \
+        _Codec(encoder, decoder)
+    _resolved_codecs.clear()
+
+
+def get_codec(content_type):
+    """Returns serializer (object with `dumps` & `loads`) for `content_type`."""
+    try:
+        return _resolved_codecs[content_type]
+    except KeyError:
+        pass
+    if not content_type:
+        s = _NopeSerializer
+    else:
+        s = MESSAGE_SERIALIZERS[content_type.lower()]
+    _resolved_codecs[content_type] = s
+    return s
 
 
 def deserialize(data, content_type):
     if not content_type:
         return data
-    s = MESSAGE_SERIALIZERS[content_type.lower()]
-    return s.loads(data)
+    return get_codec(content_type).loads(data)
 
 
 def serialize(data, content_type):
     if not content_type:
         return data
-    s = MESSAGE_SERIALIZERS[content_type.lower()]
-    return s.dumps(data)
+    return get_codec(content_type).dumps(data)
+
+
+# message compression (`content_encoding` property)
+
+CONTENT_ENCODINGS = {
+    'zlib': _Codec(zlib.compress, zlib.decompress),
+}
+
+if lz4:
+    CONTENT_ENCODINGS['lz4'] = _Codec(lz4.compress, lz4.decompress)
+
+if zstandard:
+    CONTENT_ENCODINGS['zstd'] = _Codec(
+        zstandard.ZstdCompressor().compress,
+        zstandard.ZstdDecompressor().decompress,
+    )
+
+
+def register_content_encoding(content_encoding, compress, decompress):
+    CONTENT_ENCODINGS[content_encoding] = _Codec(compress, decompress)
+    STREAM_DECOMPRESSORS.pop(content_encoding, None)
+
+
+def compress(data, content_encoding):
+    if not content_encoding:
+        return data
+    return CONTENT_ENCODINGS[content_encoding].dumps(data)
+
+
+def decompress(data, content_encoding):
+    # `content_encoding` may be used by other clients for charsets etc - skip unknown
+    c = CONTENT_ENCODINGS.get(content_encoding) if content_encoding else None
+    if c is None:
+        return data
+    return c.loads(data)
+
+
+# content_encoding => factory of incremental decompressor (with `decompress` method)
+STREAM_DECOMPRESSORS = {
+    'zlib': zlib.decompressobj,
+}
+
+if zstandard:
+    STREAM_DECOMPRESSORS['zstd'] = lambda: zstandard.ZstdDecompressor().decompressobj()
+
+
+# -- streamed messages
+
+class _FragmentsDispatcher(ContentFrameDispatcher):
+
+    """Keeps body frames of received message as is, without joining them."""
+
+    def _finish(self):
+        content = (self._method_frame, self._header_frame, self._body_fragments)
+        self._reset()
+        return content
+
+
+class AMQPStreamMessage(AMQPMessage):
+
+    """Received message, body is kept as list of frame payloads.
+
+    Consumers with `stream=True` get these.  `chunks` are read-only
+    memoryviews over received frames, so large messages may be processed
+    chunk by chunk (`iterChunks`, `iterObjects`) without copying whole body.
+    `body` is still available, but joined on first access.
+    """
+
+    __slots__ = ('fragments', '_body')
+
+    def __init__(self, fragments, deliver, properties):
+        self.fragments = fragments
+        self.deliver = deliver
+        self.properties = properties
+        self._body = None
+        self._data = _undecoded
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = b''.join(self.fragments)
+        return self._body
+
+    @property
+    def size(self):
+        return sum(map(len, self.fragments))
+
+    @property
+    def chunks(self):
+        return [memoryview(f) for f in self.fragments]
+
+    def iterChunks(self):
+        """Yields decompressed body by chunks."""
+        ce = self.properties.content_encoding
+        if not ce or ce not in CONTENT_ENCODINGS:
+            for c in self.chunks:
+                yield c
+        elif ce in STREAM_DECOMPRESSORS:
+            d = STREAM_DECOMPRESSORS[ce]()
+            for c in self.fragments:
+                yield d.decompress(c)
+            if hasattr(d, 'flush'):
+                yield d.flush()
+        else:
+            yield decompress(self.body, ce)
+
+    def _unpacker(self):
+        if self.properties.content_type in _MSGPACK_CONTENT_TYPES:
+            return getattr(msgpack, 'Unpacker', None)
+
+    def iterObjects(self):
+        """Yields objects decoded from body one by one.
+
+        Body is fed to msgpack `Unpacker` chunk by chunk, so message may hold
+        a stream of concatenated objects.  Other content types are decoded
+        as single object.
+        """
+        unpacker = self._unpacker()
+        if unpacker is None:
+            yield self.data
+            return
+        u = unpacker(max_buffer_size=0)
+        for c in self.iterChunks():
+            u.feed(c)
+            for x in u:
+                yield x
+
+    @property
+    def data(self):
+        if self._data is _undecoded and self._unpacker() is not None:
+            # decode without joining frames
+            for self._data in self.iterObjects():
+                break
+        return AMQPMessage.data.fget(self)
+
+    def __repr__(self):
+        return ("<AMQPStreamMessage(exchange={s.exchange!r},"
+                "routing_key={s.routing_key!r},"
+                "size={s.size!r}>".format(s=self))
+
+
+def _buildMessage(deliver, properties, body):
+    if isinstance(body, list):
+        return AMQPStreamMessage(body, deliver, properties)
+    return AMQPMessage(body=body, deliver=deliver, properties=properties)
+
+
+def _bodySize(body):
+    if isinstance(body, list):
+        return sum(map(len, body))
+    return len(body)
+
+
+# -- spooled publishes
+
+# lengths of exchange, routing key, compression & encoded properties
+_SPOOL_RECORD_HEADER = struct.Struct('>BBBI')
+
+
+def _spoolProperties(content_type, message_ttl, properties):
+    if isinstance(properties, _BasicProperties):
+        properties = dict(properties.__dict__)
+    p = _BasicProperties(**(properties or {}))
+    if content_type:
+        p.content_type = content_type
+    if message_ttl is not None:
+        p.expiration = str(int(message_ttl))
+    return p
+
+
+def _spoolField(s):
+    if not s:
+        return b""
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+
+def _packSpoolRecord(exchange, routing_key, data, properties, compression):
+    fields = [_spoolField(s) for s in (exchange, routing_key, compression)]
+    props = b"".join(properties.encode())
+    header = _SPOOL_RECORD_HEADER.pack(*([len(f) for f in fields] + [len(props)]))
+    return b"".join([header] + fields + [props, data])
+
+
+def _unpackSpoolRecord(record):
+    lens = _SPOOL_RECORD_HEADER.unpack_from(record)
+    offset = _SPOOL_RECORD_HEADER.size
+    fields = []
+    for n in lens:
+        fields.append(record[offset:offset + n])
+        offset += n
+    exchange, routing_key, compression, props = fields
+    p = _BasicProperties()
+    p.decode(props)
+    return exchange, routing_key, record[offset:], p, compression or None
 
 
 # ---
 
+class _PublishedMessages(object):
+
+    """In-flight confirmed publishes ordered by delivery tag.
+
+    Delivery tags grow monotonically, so multiple-ack just pops a prefix
+    of the deque - O(k) for k confirmed messages, independent of the window size.
+    Single (out of order) confirms remove an entry from the dict only,
+    stale tags are dropped from the deque head lazily.
+    """
+
+    def __init__(self):
+        self._tags = collections.deque()
+        self._entries = {}
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, delivery_tag):
+        return delivery_tag in self._entries
+
+    def add(self, delivery_tag, entry, size=0):
+        assert not self._tags or self._tags[-1] < delivery_tag
+        self._tags.append(delivery_tag)
+        self._entries[delivery_tag] = entry, size
+        self.bytes += size
+
+    def pop(self, delivery_tag):
+        entry, size = self._entries.pop(delivery_tag)
+        self.bytes -= size
+        tags = self._tags
+        while tags and tags[0] not in self._entries:
+            tags.popleft()
+        return entry
+
+    def popUpTo(self, delivery_tag):
+        tags, entries = self._tags, self._entries
+        result = []
+        while tags and tags[0] <= delivery_tag:
+            entry, size = entries.pop(tags.popleft(), (None, 0))
+            if entry is not None:
+                self.bytes -= size
+                result.append(entry)
+        return result
+
+    def popAll(self):
+        tags, entries = self._tags, self._entries
+        result = [entries[t][0] for t in tags if t in entries]
+        tags.clear()
+        entries.clear()
+        self.bytes = 0
+        return result
+
+
 class _PikaQueueUnconsumed(Exception):
     pass
 
@@ -186,10 +532,302 @@ class _NotReadyForPublish(Exception):
     pass
 
 
+class _PublishNacked(Exception):
+    pass
+
+
+class _NotScheduled(defer.CancelledError):
+    """Callback was cancelled while waiting for scheduler slot - message isn't processed."""
+
+
 class _SchemaBuilderProxy(components.proxyForInterface(IAMQPSchemaBuilder)):
     pass
 
 
+SCHEMA_REDECLARE_MODES = ('always', 'passive', 'skip')
+
+
+def _schemaKey(method, kwargs):
+    return method, repr(sorted(kwargs.items()))
+
+
+@zope.interface.implementer(IAMQPSchemaBuilder)
+class _CachingSchemaBuilder(object):
+
+    """Remembers successfully declared entities in `declared` (shared between
+    connections to the same broker).
+
+    Known entities are skipped (`redeclare='skip'`) or checked with passive
+    declaration (`redeclare='passive'`) on next connections.  Auto-deleted and
+    exclusive queues (and their bindings) are always redeclared.
+    """
+
+    def __init__(self, builder, declared, redeclare='always'):
+        assert redeclare in SCHEMA_REDECLARE_MODES
+        self.builder = builder
+        self.declared = declared
+        self.redeclare = redeclare
+        self.skipped = 0
+        self.verified = 0
+        self._volatile_queues = set()
+
+    def _declare(self, method, kwargs, volatile=False, verify=None):
+
+        key = _schemaKey(method, kwargs)
+        if not volatile and key in self.declared and self.redeclare != 'always':
+            if self.redeclare == 'passive' and verify:
+                self.verified += 1
+                return verify()
+            self.skipped += 1
+            return defer.succeed(None)
+
+        def remember(result):
+            if not volatile:
+                self.declared.add(key)
+            return result
+
+        d = defer.maybeDeferred(getattr(self.builder, method), **kwargs)
+        return d.addCallback(remember)
+
+    def declareQueue(self, queue, passive=False, **kwargs):
+        if passive:
+            return self.builder.declareQueue(queue=queue, passive=True, **kwargs)
+        volatile = kwargs.get('auto_delete') or kwargs.get('exclusive') or not queue
+        if volatile:
+            self._volatile_queues.add(queue)
+        kwargs['queue'] = queue
+        return self._declare(
+            'declareQueue', kwargs, volatile,
+            lambda: self.builder.declareQueue(queue=queue, passive=True))
+
+    def declareExchange(self, exchange, passive=False, **kwargs):
+        if passive:
+            return self.builder.declareExchange(exchange=exchange, passive=True, **kwargs)
+        kwargs['exchange'] = exchange
+        return self._declare(
+            'declareExchange', kwargs, kwargs.get('auto_delete'),
+            lambda: self.builder.declareExchange(
+                exchange=exchange, exchange_type=kwargs.get('exchange_type', 'direct'),
+                passive=True))
+
+    def bindQueue(self, exchange, queue, routing_key='', arguments=None):
+        return self._declare('bindQueue', dict(
+            exchange=exchange, queue=queue,
+            routing_key=routing_key, arguments=arguments,
+        ), queue in self._volatile_queues)
+
+    def bindExchange(self, source, destination, routing_key='', arguments=None):
+        return self._declare('bindExchange', dict(
+            source=source, destination=destination,
+            routing_key=routing_key, arguments=arguments,
+        ))
+
+
+def _declareAll(ds):
+    # run declarations concurrently, fail with first error (as is)
+    d = defer.gatherResults(list(ds), consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure if f.check(defer.FirstError) else f)
+    return d
+
+
+class _PublishedBatch(object):
+
+    """Confirmation state shared by all messages of one published batch.
+
+    Quacks like a `Deferred` for confirm bookkeeping: `callback` is called
+    once per acked message, `errback` - once per nacked (or failed) message.
+    """
+
+    def __init__(self, size):
+        self.pending = size
+        self.deferred = defer.Deferred()
+
+    def callback(self, _):
+        self.pending -= 1
+        if not self.pending and not self.deferred.called:
+            self.deferred.callback(None)
+
+    def errback(self, reason):
+        self.pending -= 1
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+
+class _ConfirmChannel(object):
+
+    """Confirm-mode channel for publishing with own delivery tags space."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.delivery_tag_counter = 0
+        self.published = _PublishedMessages()
+
+    def publish(self, exchange, routing_key, data, properties, entry):
+        self.delivery_tag_counter += 1
+        self.published.add(self.delivery_tag_counter, entry, len(data))
+        self.channel.basic_publish(exchange, routing_key, data, properties=properties)
+        return self.delivery_tag_counter
+
+    def onConfirm(self, a):
+
+        delivery_tag = a.method.delivery_tag
+        method_name = type(a.method).__name__
+        ack = method_name == 'Ack'
+
+        def confirm(d):
+            if ack:
+                d.callback(None)
+            else:
+                d.errback(_PublishNacked("message was nacked by server", delivery_tag))
+
+        if a.method.multiple:
+            logger.debug("multiple confirm - method %r, delivery_tag %d ...",
+                         method_name, delivery_tag)
+            for d in self.published.popUpTo(delivery_tag):
+                confirm(d)
+        else:
+            logger.debug("single confirm - method %r, delivery_tag %d",
+                         method_name, delivery_tag)
+            confirm(self.published.pop(delivery_tag))
+
+    def failPublished(self, reason):
+        for d in self.published.popAll():
+            d.errback(reason)
+
+
+class _ResizableSemaphore(defer.DeferredSemaphore):
+
+    """`DeferredSemaphore` which limit can be changed on the fly."""
+
+    _debt = 0
+
+    def resize(self, limit):
+        assert limit >= 1
+        while self.limit < limit:
+            self.limit += 1
+            if self._debt:
+                self._debt -= 1
+            else:
+                defer.DeferredSemaphore.release(self)
+        while self.limit > limit:
+            self.limit -= 1
+            if self.tokens:
+                self.tokens -= 1
+            else:
+                # take token back on next release
+                self._debt += 1
+
+    def release(self):
+        if self._debt:
+            self._debt -= 1
+        else:
+            defer.DeferredSemaphore.release(self)
+
+
+class _AdaptiveConcurrency(object):
+
+    """AIMD controller of consumer concurrency (`parallel`) & prefetch count.
+
+    Limit grows by one after each `limit` successful callbacks and is
+    multiplied by `decrease_factor` when any of them failed or they are slow.
+    Callback is slow when its average latency is above `target_latency`
+    or (when target is not set) above `latency_tolerance` * minimal latency.
+    Limit is changed at most once per `limit` finished callbacks.
+    """
+
+    def __init__(
+            self,
+            min_parallel=1,
+            max_parallel=64,
+            initial_parallel=None,
+            target_latency=None,
+            latency_tolerance=2.0,
+            decrease_factor=0.75,
+            prefetch_factor=2,
+            max_prefetch=None,
+            ewma_alpha=0.2,
+    ):
+        assert 1 <= min_parallel <= max_parallel
+        self.min_parallel = min_parallel
+        self.max_parallel = max_parallel
+        self.target_latency = target_latency
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.prefetch_factor = prefetch_factor
+        self.max_prefetch = max_prefetch
+        self.ewma_alpha = ewma_alpha
+
+        self.limit = max(min_parallel, min(initial_parallel or min_parallel, max_parallel))
+        self.latency = None
+        self.min_latency = None
+        self.error_rate = 0.0
+        self.listener = None
+        self._since_change = 0
+        self._errors_since_change = 0
+
+    @property
+    def prefetch_count(self):
+        p = self.limit * self.prefetch_factor
+        if self.max_prefetch:
+            p = min(p, self.max_prefetch)
+        return max(p, 1)
+
+    def _target(self):
+        if self.target_latency is not None:
+            return self.target_latency
+        elif self.min_latency is not None:
+            return self.min_latency * self.latency_tolerance
+
+    def callbackDone(self, latency, ok):
+
+        a = self.ewma_alpha
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += a * (latency - self.latency)
+        if self.min_latency is None or self.latency < self.min_latency:
+            self.min_latency = self.latency
+        self.error_rate += a * ((0.0 if ok else 1.0) - self.error_rate)
+
+        self._since_change += 1
+        if not ok:
+            self._errors_since_change += 1
+        if self._since_change < self.limit:
+            return
+
+        target = self._target()
+        if self._errors_since_change or (target is not None and self.latency > target):
+            limit = max(self.min_parallel, int(self.limit * self.decrease_factor))
+        else:
+            limit = min(self.max_parallel, self.limit + 1)
+
+        self._since_change = 0
+        self._errors_since_change = 0
+        if limit != self.limit:
+            logger.debug("change consumer concurrency %d -> %d (latency %.4f, target %r)",
+                         self.limit, limit, self.latency, target)
+            self.limit = limit
+            if self.listener:
+                self.listener(self.limit, self.prefetch_count)
+
+    def stats(self):
+        return {
+            'parallel': self.limit,
+            'prefetch_count': self.prefetch_count,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+        }
+
+
+def _build_adaptive(adaptive):
+    if not adaptive or isinstance(adaptive, _AdaptiveConcurrency):
+        return adaptive or None
+    elif adaptive is True:
+        return _AdaptiveConcurrency()
+    else:
+        return _AdaptiveConcurrency(**adaptive)
+
+
 class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol):
 
     ON_ERROR_STRATEGIES = (
@@ -198,8 +836,11 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         'reject',           # reject all messages (with delay `requeue_delay`)
         'requeue_hold',     # hold only *redelivered* messages until reconnect
         'do_nothing',       # do nothing - hold *all* messages until reconnect
+        'retry_queue',      # republish to TTL retry queue, it dead-letters msg back
     )
 
+    RETRY_COUNT_HEADER = 'x-retry-count'
+
     # strategy_name => (reque/reject on first error, requeue/reject on second error)
     _on_error_strategy_alg = {
         'requeue_once': (True, False),
@@ -209,7 +850,14 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         'do_nothing': (None, None),
     }
 
+    PUBLISH_CHANNEL_SELECTIONS = (
+        'round_robin',      # use confirm channels one by one
+        'least_inflight',   # use channel with minimal number of unconfirmed messages
+    )
+
     __consumer_tag_cnt = 0
+    _outbound_corked = False
+    requeue_timer_tick = 0.1
 
     def __init__(
             self,
@@ -219,6 +867,17 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             prefetch_count=None,
             requeue_delay=None,
             requeue_max_count=None,
+            max_inflight_confirms=None,
+            max_inflight_bytes=None,
+            publish_channels=None,
+            publish_channel_selection=None,
+            compression=None,
+            compression_threshold=None,
+            retry_delays=None,
+            retry_max_count=None,
+            schema_channels=None,
+            schema_redeclare=None,
+            declared_schema=None,
             **kwargs
     ):
 
@@ -235,12 +894,47 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         self.on_error = on_error or 'requeue'
         self.requeue_max_count = requeue_max_count if requeue_max_count is not None else 50000
         self.requeue_delay = requeue_delay if requeue_delay is not None else 120
+        self.max_inflight_confirms = max_inflight_confirms
+        self.max_inflight_bytes = max_inflight_bytes
+
+        assert (not publish_channel_selection
+                or publish_channel_selection in self.PUBLISH_CHANNEL_SELECTIONS)
+        self.publish_channels = publish_channels or 1
+        self.publish_channel_selection = publish_channel_selection or 'round_robin'
+
+        assert not compression or compression in CONTENT_ENCODINGS
+        self.compression = compression
+        self.compression_threshold = (
+            compression_threshold if compression_threshold is not None else 1024)
+
+        # exponential backoff - one retry queue per delay
+        self.retry_delays = tuple(retry_delays or (10, 60, 360))
+        self.retry_max_count = retry_max_count if retry_max_count is not None else 5
+
+        # declarations are spread between channels, so they don't wait each other
+        self.schema_channels = schema_channels or 4
+        assert not schema_redeclare or schema_redeclare in SCHEMA_REDECLARE_MODES
+        self.schema_redeclare = schema_redeclare or 'always'
+        self.declared_schema = declared_schema
 
         # -- state
-        self._published_messages = {}
+        self._confirm_channels = []
+        self._confirm_channel_rr = -1
         self._consumer_state = {}
         self._delayed_requeue_tasks = {}
+        self._requeue_timers = None
+        self._declared_retry_queues = set()
+        self._schema_channels = []
+        self._schema_channel_rr = -1
         self._ready_for_publish = False
+        self._properties_cache = {}
+        self._publish_window_waiters = collections.deque()
+        self._publish_window_paused = False
+
+        # -- metrics
+        self.counters = collections.Counter()
+        self.nacks_by_strategy = collections.Counter()
+        self.confirm_latency = metrics.Histogram()
 
     def connectionMade(self):
         logger.debug("amqp connection was made")
@@ -260,35 +954,90 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         logger.debug("open channel (write) %r " % self._write_channel)
 
     @defer.inlineCallbacks
-    def _open_safewrite_channel(self):
+    def _open_safewrite_channel(self, index):
         try:
-            self._safewrite_channel = yield self.channel()
-            self._publish_delivery_tag_counter = 0
-            yield self._safewrite_channel.confirm_delivery(callback=self._onPublishConfirm)
+            ch = yield self.channel()
+            cc = _ConfirmChannel(ch)
+            yield ch.confirm_delivery(callback=functools.partial(self._onPublishConfirm, cc))
         except MethodNotImplemented:
             logger.warning("server doesn't support 'confirm delivery'")
-            self._safewrite_channel = None
+            self._confirm_channels = []
         else:
-            self._safewrite_channel.add_on_close_callback(self._on_safewrite_channel_closed)
-            logger.debug("open channel (safe write) %r" % self._safewrite_channel)
+            ch.add_on_close_callback(
+                functools.partial(self._on_safewrite_channel_closed, index))
+            self._confirm_channels[index] = cc
+            logger.debug("open channel (safe write) #%d %r", index, ch)
+
+    @defer.inlineCallbacks
+    def _open_safewrite_channels(self):
+        self._confirm_channels = [None] * self.publish_channels
+        for i in range(self.publish_channels):
+            yield self._open_safewrite_channel(i)
+            if not self._confirm_channels:
+                break
 
     @defer.inlineCallbacks
     def handshakingMade(self):
         logger.info("handshaking with %r was made", self.virtual_host)
 
         yield self._open_write_channel()
-        yield self._open_safewrite_channel()
+        yield self._open_safewrite_channels()
 
         if self.schema:
             logger.debug("declare schema...")
-            yield defer.maybeDeferred(
-                IAMQPSchema(self.schema).declareSchema,
-                _SchemaBuilderProxy(self))
+            yield self._declareSchema()
             logger.debug("amqp schema has been declared")
 
         self._ready_for_publish = True
         self.protocolReady()
 
+    @defer.inlineCallbacks
+    def _openSchemaChannels(self, n):
+        self._schema_channels = yield _declareAll(self.channel() for _ in range(n))
+
+    def _closeSchemaChannels(self):
+        chs, self._schema_channels = self._schema_channels, []
+        for ch in chs:
+            if ch.is_open:
+                ch.close()
+
+    def _schemaChannel(self):
+        if not self._schema_channels:
+            return self._write_channel
+        self._schema_channel_rr = (self._schema_channel_rr + 1) % len(self._schema_channels)
+        return self._schema_channels[self._schema_channel_rr]
+
+    @defer.inlineCallbacks
+    def _declareSchema(self):
+
+        schema = IAMQPSchema(self.schema)
+        builder = _SchemaBuilderProxy(self)
+        if self.declared_schema is not None:
+            builder = _CachingSchemaBuilder(
+                builder, self.declared_schema, self.schema_redeclare)
+
+        if self.schema_channels > 1:
+            yield self._openSchemaChannels(self.schema_channels)
+        try:
+            yield defer.maybeDeferred(schema.declareSchema, builder)
+        except Exception:
+            if self.schema_redeclare == 'always' or not self.declared_schema:
+                raise
+            # broker was restarted or schema was altered - declare all again
+            logger.warning("cached schema doesn't match broker, redeclare it")
+            self.counters['schema_cache_invalidated'] += 1
+            self.declared_schema.clear()
+            # failed passive declaration closes channel, so use new ones
+            self._closeSchemaChannels()
+            yield self._openSchemaChannels(self.schema_channels)
+            yield defer.maybeDeferred(schema.declareSchema, builder)
+        finally:
+            self._closeSchemaChannels()
+
+        if isinstance(builder, _CachingSchemaBuilder):
+            self.counters['schema_skipped'] += builder.skipped
+            self.counters['schema_verified'] += builder.verified
+
     def _on_consuming_channel_closed(self, ct, channel, reply_code, reply_text):
         logger.error(
             "server closed channel, ct %r, reply_code %s, reply_text %s!",
@@ -303,6 +1052,13 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             no_ack=s['no_ack'],
             consumer_tag=ct,
             parallel=s['parallel'],
+            requeue_delay=s['requeue_delay'],
+            on_error=s['on_error'],
+            batch_size=s['batch_size'],
+            batch_timeout=s['batch_timeout'],
+            batch_on_error=s['batch_on_error'],
+            adaptive=s['adaptive'],
+            stream=s['stream'],
             **s.get('kwargs', {})
         )
 
@@ -314,30 +1070,29 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         return self._open_write_channel()
 
     @defer.inlineCallbacks
-    def _on_safewrite_channel_closed(self, channel, reply_code, reply_text):
-        yield self._open_safewrite_channel()
-        self._fail_published_messages(ChannelClosed(reply_code, reply_text))
+    def _on_safewrite_channel_closed(self, index, channel, reply_code, reply_text):
 
-    def _onPublishConfirm(self, a):
+        if self.is_closing or self.is_closed:
+            logger.debug("safe write channel #%d closed with connection", index)
+            return
 
-        delivery_tag = a.method.delivery_tag
-        method_name = type(a.method).__name__
-        ack = method_name == 'Ack'
-        deferred_method = (defer.Deferred.callback if ack else defer.Deferred.errback)
+        logger.error(
+            "server closed safe write channel #%d, reply_code %s, reply_text %s!",
+            index, reply_code, reply_text)
 
-        if a.method.multiple:
-            logger.debug("multiple confirm - method %r, delivery_tag %d ...",
-                         method_name, delivery_tag)
-            for k in list(self._published_messages):
-                if k <= delivery_tag:
-                    logger.debug("confirm - method %r, delivery_tag %d", method_name, k)
-                    d = self._published_messages.pop(k)
-                    deferred_method(d, None)
-        else:
-            logger.debug("single confirm - method %r, delivery_tag %d",
-                         method_name, delivery_tag)
-            d = self._published_messages.pop(delivery_tag)
-            deferred_method(d, None)
+        # fail messages *before* reopening - delivery tags restart from 1
+        cc = self._confirm_channels[index]
+        self._confirm_channels[index] = None
+        if cc is not None:
+            cc.failPublished(ChannelClosed(reply_code, reply_text))
+
+        yield self._open_safewrite_channel(index)
+        self._releasePublishWindow()
+
+    def _onPublishConfirm(self, cc, a):
+        cc.onConfirm(a)
+        if self._publish_window_waiters or self._publish_window_paused:
+            self._releasePublishWindow()
 
     def connectionLost(self, reason):
 
@@ -358,56 +1113,291 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                 queue_obj.close(reason)
 
         self._fail_published_messages(reason)
+        self._fail_publish_window_waiters(reason)
         TwistedProtocolConnection.connectionLost(self, reason)
 
     def _fail_published_messages(self, reason):
-        m2f = list(self._published_messages.itervalues())
-        self._published_messages.clear()
-        for d in m2f:
+        for cc in self._confirm_channels:
+            if cc is not None:
+                cc.failPublished(reason)
+
+    def _fail_publish_window_waiters(self, reason):
+        ws = list(self._publish_window_waiters)
+        self._publish_window_waiters.clear()
+        for d in ws:
             d.errback(reason)
+        self._setPublishWindowPaused(False)
+
+    # -- publish window
+
+    def _isPublishWindowFull(self):
+        ccs = [cc for cc in self._confirm_channels if cc is not None]
+        return (
+            (self.max_inflight_confirms is not None
+             and sum(len(cc.published) for cc in ccs) >= self.max_inflight_confirms)
+            or (self.max_inflight_bytes is not None
+                and sum(cc.published.bytes for cc in ccs) >= self.max_inflight_bytes)
+        )
+
+    def _selectConfirmChannel(self):
+
+        ccs = self._confirm_channels
+        if not ccs:
+            raise MethodNotImplemented("server doesn't support 'puslish confirm'")
+
+        if self.publish_channel_selection == 'least_inflight':
+            opened = [cc for cc in ccs if cc is not None]
+            cc = min(opened, key=lambda cc: len(cc.published)) if opened else None
+        else:
+            for _ in range(len(ccs)):
+                self._confirm_channel_rr = (self._confirm_channel_rr + 1) % len(ccs)
+                cc = ccs[self._confirm_channel_rr]
+                if cc is not None:
+                    break
+            else:
+                cc = None
+
+        if cc is None:
+            raise _NotReadyForPublish("not ready for publish - all confirm channels are closed")
+        return cc
+
+    def _waitPublishWindow(self):
+        logger.debug("publish window is full - wait for confirms")
+        d = defer.Deferred()
+        self._publish_window_waiters.append(d)
+        self._setPublishWindowPaused(True)
+        return d
+
+    def _releasePublishWindow(self):
+        waiters = self._publish_window_waiters
+        while waiters and not self._isPublishWindowFull():
+            waiters.popleft().callback(None)
+        if not waiters and not self._isPublishWindowFull():
+            self._setPublishWindowPaused(False)
+
+    def _setPublishWindowPaused(self, paused):
+        if self._publish_window_paused == paused:
+            return
+        self._publish_window_paused = paused
+        factory = getattr(self, 'factory', None)
+        if factory is None:
+            return
+        elif paused:
+            logger.debug("publish window is full - pause producers")
+            factory.pausePushProducers()
+        else:
+            logger.debug("publish window was released - resume producers")
+            factory.resumePushProducers()
+
+    def _flush_outbound(self):
+        if not self._outbound_corked:
+            TwistedProtocolConnection._flush_outbound(self)
+
+    def _writeCorked(self, fn, *args):
+        # collect all frames produced by `fn` & send them via single `transport.write`
+        self._outbound_corked = True
+        try:
+            return fn(*args)
+        finally:
+            self._outbound_corked = False
+            if self.outbound_buffer:
+                data = b"".join(self.outbound_buffer)
+                self.outbound_buffer.clear()
+                self.transport.write(data)
+
+    def _buildProperties(self, content_type, message_ttl, properties, content_encoding=None):
+
+        if isinstance(properties, _BasicProperties):
+            if content_type is None and message_ttl is None and content_encoding is None:
+                return properties
+            properties = dict(properties.__dict__)
+
+        if properties:
+            p = _BasicProperties(**properties)
+            if content_type:
+                p.content_type = content_type
+            if content_encoding:
+                p.content_encoding = content_encoding
+            if message_ttl is not None:
+                p.expiration = str(int(message_ttl))
+            return p
+
+        # properties without headers & custom fields are immutable for pika - share them
+        key = content_type, message_ttl, content_encoding
+        p = self._properties_cache.get(key)
+        if p is None:
+            p = _BasicProperties(
+                content_type=content_type or None,
+                content_encoding=content_encoding,
+            )
+            if message_ttl is not None:
+                p.expiration = str(int(message_ttl))
+            self._properties_cache[key] = p
+        return p
+
+    def _encodeMessage(self, body, content_type, message_ttl, properties, compression):
+
+        data = serialize(body, content_type)
+
+        if compression is None:
+            compression = self.compression
+        if compression and len(data) >= self.compression_threshold:
+            data = compress(data, compression)
+        else:
+            compression = None
+
+        p = self._buildProperties(content_type, message_ttl, properties, compression)
+        return data, p
 
     def publishMessage(
             self, exchange, routing_key, body,
             message_ttl=None,
-            content_type=None, properties=None, confirm=True):
+            content_type=None, properties=None, confirm=True,
+            compression=None):
 
         if not self._ready_for_publish:
             raise _NotReadyForPublish("not ready for publish - channel in wrong state")
 
-        data = serialize(body, content_type)
+        if confirm and (self._publish_window_waiters or self._isPublishWindowFull()):
+            return self._waitPublishWindow().addCallback(
+                lambda _: self._publishMessage(
+                    exchange, routing_key, body, message_ttl,
+                    content_type, properties, confirm, compression))
+
+        return self._publishMessage(
+            exchange, routing_key, body, message_ttl,
+            content_type, properties, confirm, compression)
+
+    def _publishMessage(
+            self, exchange, routing_key, body,
+            message_ttl, content_type, properties, confirm, compression):
+
+        if not self._ready_for_publish:
+            raise _NotReadyForPublish("not ready for publish - channel in wrong state")
+
+        data, p = self._encodeMessage(body, content_type, message_ttl, properties, compression)
         logger.debug("publish message, msg %r, exhange %r, rk %r, props %r",
                      data, exchange, routing_key, properties)
+        self.counters['messages_out'] += 1
+        self.counters['bytes_out'] += len(data)
 
-        p = _BasicProperties(**(properties or {}))
-        if content_type:
-            p.content_type = content_type
-        if message_ttl is not None:
-            p.expiration = str(int(message_ttl))
-
-        if confirm and self._safewrite_channel is not None:
-            self._publish_delivery_tag_counter += 1
-            delivery_tag = self._publish_delivery_tag_counter
+        if confirm:
+            cc = self._selectConfirmChannel()
             d = defer.Deferred()
-            self._published_messages[delivery_tag] = d
+            d.addBoth(self._observeConfirm, self.clock.seconds(), 1)
             logger.debug("safe-publish, exc %r, rk %r: %r", exchange, routing_key, data)
-            self._safewrite_channel.basic_publish(exchange, routing_key, data, properties=p)
+            delivery_tag = cc.publish(exchange, routing_key, data, p, d)
             logger.debug("delivery tag is %r", delivery_tag)
+            if self._isPublishWindowFull():
+                self._setPublishWindowPaused(True)
             return d
-        elif confirm:
-            raise MethodNotImplemented("server doesn't support 'puslish confirm'")
         else:
             self._write_channel.basic_publish(exchange, routing_key, data, properties=p)
             return defer.succeed(None)
 
-    @defer.inlineCallbacks  # noqa
-    def _queueCounsumingLoop(self, consumer_tag, queue, callback, no_ack, parallel=0):
+    def publishBatch(self, messages, confirm=True):
+        """Publish several messages at once, returns one `Deferred` for whole batch.
 
-        if parallel >= 0:
+        Each message is a dict (or a tuple) of `publishMessage` arguments.
+        All frames are written to the transport at once. Resulting `Deferred`
+        fires when all messages are confirmed (usually by one multiple-ack)
+        or fails on first nacked message.
+        """
+
+        if not self._ready_for_publish:
+            raise _NotReadyForPublish("not ready for publish - channel in wrong state")
+
+        if confirm and not self._confirm_channels:
+            raise MethodNotImplemented("server doesn't support 'puslish confirm'")
+
+        messages = list(messages)
+        if not messages:
+            return defer.succeed(None)
+
+        if confirm and (self._publish_window_waiters or self._isPublishWindowFull()):
+            # whole batch is published at once, even if it overfills the window
+            return self._waitPublishWindow().addCallback(
+                lambda _: self._publishConfirmedBatch(messages))
+        elif confirm:
+            return self._publishConfirmedBatch(messages)
+        else:
+            logger.debug("publish batch of %d messages", len(messages))
+            self._writeCorked(self._publishBatch, messages, None, None)
+            return defer.succeed(None)
+
+    def _publishConfirmedBatch(self, messages):
+
+        if not self._ready_for_publish:
+            raise _NotReadyForPublish("not ready for publish - channel in wrong state")
+
+        logger.debug("publish batch of %d messages", len(messages))
+        # all messages of batch go to one channel - so one multiple-ack confirms them
+        cc = self._selectConfirmChannel()
+        batch = _PublishedBatch(len(messages))
+        batch.deferred.addBoth(self._observeConfirm, self.clock.seconds(), len(messages))
+        self._writeCorked(self._publishBatch, messages, cc, batch)
+        if self._isPublishWindowFull():
+            self._setPublishWindowPaused(True)
+        return batch.deferred
+
+    def _publishBatch(self, messages, cc, batch):
+
+        for m in messages:
+            if isinstance(m, (tuple, list)):
+                m = dict(zip(
+                    ('exchange', 'routing_key', 'body',
+                     'message_ttl', 'content_type', 'properties'), m))
+            data, p = self._encodeMessage(
+                m['body'], m.get('content_type'), m.get('message_ttl'),
+                m.get('properties'), m.get('compression'))
+            routing_key = m.get('routing_key') or ''
+            self.counters['messages_out'] += 1
+            self.counters['bytes_out'] += len(data)
+            if cc is not None:
+                cc.publish(m['exchange'], routing_key, data, p, batch)
+            else:
+                self._write_channel.basic_publish(
+                    m['exchange'], routing_key, data, properties=p)
+
+    def _observeConfirm(self, x, t0, count):
+        self.confirm_latency.add(self.clock.seconds() - t0)
+        if isinstance(x, failure.Failure):
+            self.counters['confirms_failed'] += count
+        else:
+            self.counters['confirms_acked'] += count
+        return x
+
+    def getMetrics(self):
+        m = dict(self.counters)
+        m['nacks_by_strategy'] = dict(self.nacks_by_strategy)
+        ccs = [cc for cc in self._confirm_channels if cc is not None]
+        m['published_inflight'] = sum(len(cc.published) for cc in ccs)
+        m['published_inflight_bytes'] = sum(cc.published.bytes for cc in ccs)
+        m['delayed_requeue'] = sum(map(len, self._delayed_requeue_tasks.values()))
+        m['consumers'] = len(self._consumer_state)
+        m['confirm_latency'] = self.confirm_latency.snapshot()
+        return m
+
+    @defer.inlineCallbacks  # noqa
+    def _queueCounsumingLoop(
+            self, consumer_tag, queue, callback, no_ack, parallel=0,
+            batch_size=None, batch_timeout=None, batch_on_error=None,
+            adaptive=None):
+
+        if adaptive:
+            semaphore = _ResizableSemaphore(tokens=adaptive.limit)
+            callback = self._observeCallback(callback, adaptive)
+            adaptive_listener = adaptive.listener = functools.partial(
+                self._adaptConsuming, consumer_tag, semaphore)
+        elif parallel >= 0:
             semaphore = defer.DeferredSemaphore(tokens=(parallel or 1))
         else:
             semaphore = None
         connection_done = False
 
+        # delivery tags of not acked/rejected messages (in order of delivery)
+        unacked = collections.OrderedDict() if batch_size and not no_ack else None
+
         while 1:
 
             logger.debug("ct %s - waiting for msgs...", consumer_tag)
@@ -432,7 +1422,18 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                 logger.debug("found terminator %r in pika queue %s", msg, consumer_tag)
                 break
 
-            d = self._processIncomingMessage(msg, queue, callback, no_ack)
+            if batch_size:
+                msgs, stop_reason = yield self._collectIncomingBatch(
+                    [msg], queue, batch_size, batch_timeout)
+                if stop_reason == 'connection_done':
+                    # messages will be redelivered, we can't ack them anyway
+                    connection_done = True
+                    break
+                d = self._processIncomingBatch(
+                    msgs, callback, no_ack, unacked, batch_on_error)
+            else:
+                stop_reason = None
+                d = self._processIncomingMessage(msg, queue, callback, no_ack)
 
             if semaphore:
                 def after(x):
@@ -440,6 +1441,13 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                     return x
                 d.addBoth(after)
 
+            if stop_reason:
+                logger.debug("stop consuming loop - %s, ct %s", stop_reason, consumer_tag)
+                break
+
+        if adaptive and adaptive.listener is adaptive_listener:
+            adaptive.listener = None
+
         self._cleanupConsumingQueue(
             consumer_tag, queue,
             do_reject=(not connection_done and not no_ack),
@@ -451,6 +1459,65 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
 
         logger.debug("queue consuming loop stopped, consumer_tag %r", consumer_tag)
 
+    def _observeCallback(self, callback, adaptive):
+
+        def observed(msg):
+            t0 = self.clock.seconds()
+
+            def done(x):
+                ok = not isinstance(x, failure.Failure)
+                adaptive.callbackDone(self.clock.seconds() - t0, ok)
+                return x
+
+            return defer.maybeDeferred(callback, msg).addBoth(done)
+
+        return observed
+
+    def _adaptConsuming(self, consumer_tag, semaphore, parallel, prefetch_count):
+
+        logger.debug("ct %s - set parallel to %d, prefetch_count to %d",
+                     consumer_tag, parallel, prefetch_count)
+        semaphore.resize(parallel)
+
+        cstate = self._consumer_state.get(consumer_tag)
+        if cstate and not cstate['no_ack']:
+            d = cstate['channel'].basic_qos(prefetch_count=prefetch_count, all_channels=0)
+            d.addErrback(lambda f: logger.error("can't change prefetch_count: %s", f.value))
+
+    @defer.inlineCallbacks
+    def _collectIncomingBatch(self, msgs, queue, batch_size, batch_timeout):
+
+        deadline = self.clock.seconds() + (batch_timeout or 0)
+
+        while len(msgs) < batch_size:
+
+            if queue.pending:
+                msg = queue.pending.pop(0)
+            else:
+                timeout = deadline - self.clock.seconds()
+                if timeout <= 0:
+                    break
+
+                d = queue.get()
+                timeout_call = self.clock.callLater(timeout, d.cancel)
+                try:
+                    msg = yield d
+                except defer.CancelledError:
+                    break
+                except ConnectionDone:
+                    defer.returnValue((msgs, 'connection_done'))
+                except Exception as e:
+                    defer.returnValue((msgs, "pika queue closed (%r)" % (e,)))
+                finally:
+                    if timeout_call.active():
+                        timeout_call.cancel()
+
+            if not msg:
+                defer.returnValue((msgs, 'terminator found'))
+            msgs.append(msg)
+
+        defer.returnValue((msgs, None))
+
     def _cleanupConsumingQueue(self, consumer_tag, queue, do_reject=True):
 
         logger.debug("clear consuming state for queue %r", queue)
@@ -478,31 +1545,123 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
 
         ch, deliver, props, body = msg
         delivery_tag = deliver.delivery_tag
-        amqp_msg = AMQPMessage(deliver=deliver, properties=props, body=body)
+        amqp_msg = _buildMessage(deliver, props, body)
         logger.debug("received %s", amqp_msg)
+        self.counters['messages_in'] += 1
+        self.counters['bytes_in'] += _bodySize(body)
 
         d = defer.maybeDeferred(callback, amqp_msg)
         logger.debug("run callback for dtag %r,", delivery_tag)
 
         def err(e):
+            if e.check(_NotScheduled):
+                # consumer is stopped, message isn't failed
+                if not no_ack:
+                    logger.debug("requeue unprocessed message, delivery tag %r", delivery_tag)
+                    ch.basic_reject(delivery_tag, requeue=True)
+                return None
             ei = (e.type, e.value, e.tb)
             logger.error("fail to process %r", msg, exc_info=ei)
             if no_ack:
-                return None
+                return None
+            elif e.check(ConnectionDone):
+                logger.debug("no active connection - we can't nack message")
+            else:
+                self._handleFailedIncomingMessage(ch, amqp_msg)
+
+        def ack(x):
+            if not no_ack:
+                logger.debug("send ack, delivery tag %r", delivery_tag)
+                ch.basic_ack(delivery_tag)
+                self.counters['acks'] += 1
+
+        d.addCallbacks(ack, err)
+        return d
+
+    def _processIncomingBatch(self, msgs, callback, no_ack, unacked, batch_on_error):
+
+        ch = msgs[0][0]
+        amqp_msgs = [
+            _buildMessage(deliver, props, body)
+            for _, deliver, props, body in msgs
+        ]
+        delivery_tags = [m.delivery_tag for m in amqp_msgs]
+        logger.debug("received batch of %d msgs, dtags %r", len(amqp_msgs), delivery_tags)
+        self.counters['messages_in'] += len(msgs)
+        self.counters['bytes_in'] += sum(_bodySize(m[3]) for m in msgs)
+
+        if unacked is not None:
+            for dt in delivery_tags:
+                unacked[dt] = True
+
+        def settled(dt):
+            if unacked is not None:
+                unacked.pop(dt, None)
+
+        def fail(e, ms):
+            if no_ack:
+                return
             elif e.check(ConnectionDone):
-                logger.debug("no active connection - we can't nack message")
+                logger.debug("no active connection - we can't nack messages")
             else:
-                self._handleFailedIncomingMessage(ch, amqp_msg)
+                for m in ms:
+                    self._handleFailedIncomingMessage(ch, m, on_settled=settled)
+
+        @defer.inlineCallbacks
+        def retry_by_one():
+            for m in amqp_msgs:
+                try:
+                    yield defer.maybeDeferred(callback, [m])
+                except Exception:
+                    f = failure.Failure()
+                    logger.error("fail to process %r", m, exc_info=(f.type, f.value, f.tb))
+                    fail(f, [m])
+                else:
+                    self._ackIncomingBatch(ch, [m.delivery_tag], no_ack, unacked)
 
-        def ack(x):
-            if not no_ack:
-                logger.debug("send ack, delivery tag %r", delivery_tag)
-                ch.basic_ack(delivery_tag)
+        def err(e):
+            if e.check(_NotScheduled):
+                # consumer is stopped, messages aren't failed
+                if not no_ack:
+                    logger.debug("requeue unprocessed batch, delivery tags %r", delivery_tags)
+                    for dt in delivery_tags:
+                        ch.basic_reject(dt, requeue=True)
+                        settled(dt)
+                return
+            ei = (e.type, e.value, e.tb)
+            logger.error("fail to process batch of %d msgs", len(amqp_msgs), exc_info=ei)
+            if batch_on_error == 'message' and len(amqp_msgs) > 1 and not no_ack:
+                logger.debug("process failed batch message by message")
+                return retry_by_one()
+            fail(e, amqp_msgs)
 
+        def ack(_):
+            self._ackIncomingBatch(ch, delivery_tags, no_ack, unacked)
+
+        d = defer.maybeDeferred(callback, amqp_msgs)
         d.addCallbacks(ack, err)
         return d
 
-    def _handleFailedIncomingMessage(self, ch, msg):
+    def _ackIncomingBatch(self, ch, delivery_tags, no_ack, unacked):
+
+        if no_ack:
+            return
+
+        self.counters['acks'] += len(delivery_tags)
+        for dt in delivery_tags:
+            unacked.pop(dt, None)
+
+        # multiple-ack is safe only when there are no unacked messages before batch
+        max_dt = delivery_tags[-1]
+        if not unacked or next(iter(unacked)) > max_dt:
+            logger.debug("send multiple ack, delivery tag %r", max_dt)
+            ch.basic_ack(max_dt, multiple=True)
+        else:
+            for dt in delivery_tags:
+                logger.debug("send ack, delivery tag %r", dt)
+                ch.basic_ack(dt)
+
+    def _handleFailedIncomingMessage(self, ch, msg, on_settled=None):
 
         delivery_tag = msg.delivery_tag
         consumer_tag = msg.consumer_tag
@@ -514,6 +1673,11 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             return
 
         on_error_strategy = cstate.get('on_error') or self.on_error
+        self.nacks_by_strategy[on_error_strategy] += 1
+        if on_error_strategy == 'retry_queue':
+            self._retryIncomingMessage(ch, msg, cstate['queue'], on_settled)
+            return
+
         on_error_requeue = self._on_error_strategy_alg[on_error_strategy][int(redelivered)]
 
         rej_tasks_count = len(self._delayed_requeue_tasks.get(consumer_tag, ()))
@@ -526,10 +1690,14 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         elif not on_error_requeue and too_many_rejs:
             logger.error("reject message without delay: %r", msg)
             ch.basic_reject(delivery_tag, requeue=False)
+            if on_settled:
+                on_settled(delivery_tag)
 
         elif on_error_requeue and too_many_rejs:
             logger.error("requeue message without delay: %r", msg)
             ch.basic_reject(delivery_tag, requeue=True)
+            if on_settled:
+                on_settled(delivery_tag)
 
         else:
             msg_requeue_delay = cstate.get('requeue_delay') or self.requeue_delay
@@ -541,6 +1709,8 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                 def reject_message():
                     logger.debug("reject/requeue message, dt %r", delivery_tag)
                     ch.basic_reject(delivery_tag, requeue=on_error_requeue)
+                    if on_settled:
+                        on_settled(delivery_tag)
                     m = self._delayed_requeue_tasks.get(consumer_tag)
                     if m is not None:
                         m.pop(delivery_tag, None)
@@ -549,13 +1719,85 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
 
                 fmrt = self._delayed_requeue_tasks.setdefault(consumer_tag, {})
                 assert delivery_tag not in fmrt
-                t = self.clock.callLater(msg_requeue_delay, reject_message)
+                t = self._scheduleRequeue(msg_requeue_delay, reject_message)
                 fmrt[delivery_tag] = t, ch
                 logger.debug("fmrt task is %r, dt %r", t, delivery_tag)
 
             else:
                 logger.debug("reject message, dt %r", delivery_tag)
                 ch.basic_reject(delivery_tag, requeue=on_error_requeue)
+                if on_settled:
+                    on_settled(delivery_tag)
+
+    def _retryQueueName(self, queue, delay):
+        return "%s.retry.%gs" % (queue, delay)
+
+    def _declareRetryQueues(self, queue):
+        ds = []
+        for delay in self.retry_delays:
+            rq = self._retryQueueName(queue, delay)
+            if rq in self._declared_retry_queues:
+                continue
+            self._declared_retry_queues.add(rq)
+            ds.append(self.declareQueue(
+                rq, durable=True, message_ttl=int(delay * 1000),
+                dead_letter_exchange='', dead_letter_exchange_rk=queue,
+            ).addErrback(self._onRetryQueueDeclareFailed, rq))
+        return defer.gatherResults(ds, consumeErrors=True)
+
+    def _onRetryQueueDeclareFailed(self, f, rq):
+        self._declared_retry_queues.discard(rq)
+        return f
+
+    def _retryIncomingMessage(self, ch, msg, queue, on_settled=None):
+
+        delivery_tag = msg.delivery_tag
+        props = msg.properties
+        headers = dict(props.headers or ())
+        retry_count = int(headers.get(self.RETRY_COUNT_HEADER) or 0)
+
+        def settled(_=None):
+            if on_settled:
+                on_settled(delivery_tag)
+
+        if retry_count >= self.retry_max_count:
+            logger.error("reject message after %d retries: %r", retry_count, msg)
+            ch.basic_reject(delivery_tag, requeue=False)
+            settled()
+            return
+
+        headers[self.RETRY_COUNT_HEADER] = retry_count + 1
+        properties = dict(props.__dict__)
+        properties['headers'] = headers
+
+        delay = self.retry_delays[min(retry_count, len(self.retry_delays) - 1)]
+        rq = self._retryQueueName(queue, delay)
+        logger.debug("retry message in %s secs via %r, dt %r", delay, rq, delivery_tag)
+
+        def ack(_):
+            ch.basic_ack(delivery_tag)
+            settled()
+
+        def requeue(f):
+            logger.error("can't republish message to %r: %s", rq, f.value)
+            ch.basic_reject(delivery_tag, requeue=True)
+            settled()
+
+        # ack original message only when retry copy is confirmed
+        d = defer.maybeDeferred(
+            self.publishMessage, exchange='', routing_key=rq, body=msg.body,
+            properties=_BasicProperties(**properties), confirm=True, compression=False)
+        d.addCallbacks(ack, requeue)
+        d.addErrback(lambda f: logger.error("can't settle failed message: %s", f.value))
+
+    def _scheduleRequeue(self, delay, fn):
+        # one shared wheel instead of `callLater` per failed message,
+        # rejects of one tick are sent via single `transport.write`
+        if self._requeue_timers is None:
+            self._requeue_timers = timed.TimerWheel(
+                tick=self.requeue_timer_tick, clock=self.clock,
+                runner=self._writeCorked)
+        return self._requeue_timers.callLater(delay, fn)
 
     def _generateConsumerTag(self):
         type(self).__consumer_tag_cnt += 1
@@ -566,22 +1808,46 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             self, queue='', callback=None, no_ack=False,
             requeue_delay=None, on_error=None,
             consumer_tag=None, parallel=0,
+            batch_size=None, batch_timeout=None, batch_on_error=None,
+            adaptive=None, stream=False,
             **kwargs):
 
         assert callback
+        assert not batch_on_error or batch_on_error in ('batch', 'message')
         logger.info("consume queue '%s/%s'", self.virtual_host, queue)
         consumer_tag = consumer_tag or self._generateConsumerTag()
+        adaptive = _build_adaptive(adaptive)
+
+        if adaptive and not no_ack:
+            prefetch_count = adaptive.prefetch_count
+        else:
+            prefetch_count = self.prefetch_count
+
+        if (on_error or self.on_error) == 'retry_queue':
+            yield self._declareRetryQueues(queue)
 
         ch = yield self.channel()
-        if self.prefetch_count is not None:
-            logger.debug("set qos prefetch_count to %d", self.prefetch_count)
-            yield ch.basic_qos(prefetch_count=self.prefetch_count, all_channels=0)
+        if stream:
+            # pass bodies to consumer as list of frames (see `AMQPStreamMessage`)
+            self._channels[ch.channel_number].frame_dispatcher = _FragmentsDispatcher()
+
+        if prefetch_count is not None:
+            logger.debug("set qos prefetch_count to %d", prefetch_count)
+            yield ch.basic_qos(prefetch_count=prefetch_count, all_channels=0)
 
-        queue_obj, ct = yield ch.basic_consume(
-            queue=queue, no_ack=no_ack, consumer_tag=consumer_tag,
-            **kwargs)
+        consume_ok = self._waitConsumeOk(ch, consumer_tag)
+        try:
+            queue_obj, ct = yield ch.basic_consume(
+                queue=queue, no_ack=no_ack, consumer_tag=consumer_tag,
+                **kwargs)
+        except Exception:
+            consume_ok.addErrback(lambda _: None)
+            raise
         assert ct == consumer_tag
 
+        # pika's basic_consume fires before 'ConsumeOk' is received
+        yield consume_ok
+
         ch.add_on_close_callback(functools.partial(self._on_consuming_channel_closed, ct))
         logger.debug("open channel (read) %r for ct %r", ch, ct)
 
@@ -596,21 +1862,40 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             queue=queue,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            batch_on_error=batch_on_error,
+            adaptive=adaptive,
+            stream=stream,
         )
 
-        # pika don't wait 'ConsumeOk' message
-        # HACK-1: run consuming-loop a bit later to avoid races
-        self.clock.callLater(
-            0.05, self._queueCounsumingLoop,
+        self._queueCounsumingLoop(
             ct, queue_obj, callback, no_ack=no_ack, parallel=parallel,
+            batch_size=batch_size, batch_timeout=batch_timeout,
+            batch_on_error=batch_on_error, adaptive=adaptive,
         )
 
-        # HACK-2: simulate waiting of 'ConsumeOk'
-        yield timed.sleep(0.1)
-
         logger.debug("consumer tag is %r", consumer_tag)
         defer.returnValue(ct)
 
+    def _waitConsumeOk(self, channel, consumer_tag):
+
+        d = defer.Deferred()
+
+        def on_consume_ok(frame):
+            if not d.called:
+                d.callback(frame)
+
+        def on_close(channel, reply_code, reply_text):
+            if not d.called:
+                d.errback(ChannelClosed(reply_code, reply_text))
+
+        channel.callbacks.add(
+            channel.channel_number, _Basic.ConsumeOk, on_consume_ok,
+            arguments={'consumer_tag': consumer_tag})
+        channel.add_on_close_callback(on_close)
+        return d
+
     @defer.inlineCallbacks
     def consumeExchange(
             self,
@@ -619,7 +1904,16 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             bind_arguments=None, queue_arguments=None,
             requeue_delay=None,
             on_error=None,
+            batch_size=None,
+            batch_timeout=None,
+            batch_on_error=None,
+            adaptive=None,
+            stream=False,
     ):
+        if (on_error or self.on_error) == 'retry_queue':
+            # retry queues are durable, they would outlive exclusive queue
+            raise ValueError("on_error 'retry_queue' is not supported for exchange consumers")
+
         consumer_tag = consumer_tag or self._generateConsumerTag()
 
         logger.debug("declare exclusive queue")
@@ -649,6 +1943,11 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             no_ack=no_ack,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            batch_on_error=batch_on_error,
+            adaptive=adaptive,
+            stream=stream,
         )
 
         defer.returnValue(ct)
@@ -705,7 +2004,7 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             if dead_letter_exchange_rk:
                 arguments['x-dead-letter-routing-key'] = dead_letter_exchange_rk
 
-        return self._write_channel.queue_declare(
+        return self._schemaChannel().queue_declare(
             queue=queue, passive=passive, durable=durable, exclusive=exclusive,
             auto_delete=auto_delete, arguments=arguments,
         )
@@ -720,7 +2019,7 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             self.virtual_host,
             exchange, exchange_type, passive, durable, auto_delete, internal)
 
-        return self._write_channel.exchange_declare(
+        return self._schemaChannel().exchange_declare(
             exchange=exchange, passive=passive,
             durable=durable, exchange_type=exchange_type,
             auto_delete=auto_delete, arguments=arguments, internal=internal)
@@ -730,7 +2029,7 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             "bind exchange '%s/%s' to queue %r, routing key %r",
             self.virtual_host, exchange, queue, routing_key)
 
-        return self._write_channel.queue_bind(
+        return self._schemaChannel().queue_bind(
             queue=queue, exchange=exchange,
             routing_key=routing_key, arguments=arguments)
 
@@ -738,7 +2037,7 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         logger.info(
             "bind exchange '%s/%s' to exchange %r, routing key %r",
             destination, source, routing_key)
-        return self._write_channel.exchange_bind(
+        return self._schemaChannel().exchange_bind(
             self.virtual_host,
             destination=destination, source=source,
             routing_key=routing_key, arguments=arguments)
@@ -762,6 +2061,16 @@ class AMQPFactory(pclient.PersistentClientFactory):
             prefetch_count=None,
             requeue_delay=120,
             on_error=None,
+            max_inflight_confirms=None,
+            max_inflight_bytes=None,
+            publish_channels=None,
+            publish_channel_selection=None,
+            compression=None,
+            compression_threshold=None,
+            retry_delays=None,
+            retry_max_count=None,
+            schema_channels=None,
+            schema_redeclare=None,
             **kwargs
     ):
         # defaults for _AMQPProtocol
@@ -769,6 +2078,22 @@ class AMQPFactory(pclient.PersistentClientFactory):
         self.prefetch_count = prefetch_count
         self.on_error = on_error
         self.requeue_delay = requeue_delay
+        self.max_inflight_confirms = max_inflight_confirms
+        self.max_inflight_bytes = max_inflight_bytes
+        self.publish_channels = publish_channels
+        self.publish_channel_selection = publish_channel_selection
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.retry_delays = retry_delays
+        self.retry_max_count = retry_max_count
+        self.schema_channels = schema_channels
+        self.schema_redeclare = schema_redeclare
+
+        # what was declared on broker by previous connections
+        self.declared_schema = set()
+
+        self._push_producers = set()
+        self._push_producers_paused = False
 
         self._protocol_parameters = {
             'virtual_host': vhost,
@@ -799,11 +2124,40 @@ class AMQPFactory(pclient.PersistentClientFactory):
             prefetch_count=self.prefetch_count,
             requeue_delay=self.requeue_delay,
             on_error=self.on_error,
+            max_inflight_confirms=self.max_inflight_confirms,
+            max_inflight_bytes=self.max_inflight_bytes,
+            publish_channels=self.publish_channels,
+            publish_channel_selection=self.publish_channel_selection,
+            compression=self.compression,
+            compression_threshold=self.compression_threshold,
+            retry_delays=self.retry_delays,
+            retry_max_count=self.retry_max_count,
+            schema_channels=self.schema_channels,
+            schema_redeclare=self.schema_redeclare,
+            declared_schema=self.declared_schema,
         )
         p.factory = self
         self._protocol_instance = p
         return p
 
+    def addPushProducer(self, producer):
+        self._push_producers.add(producer)
+        if self._push_producers_paused:
+            producer.pauseProducing()
+
+    def removePushProducer(self, producer):
+        self._push_producers.discard(producer)
+
+    def pausePushProducers(self):
+        self._push_producers_paused = True
+        for p in list(self._push_producers):
+            p.pauseProducing()
+
+    def resumePushProducers(self):
+        self._push_producers_paused = False
+        for p in list(self._push_producers):
+            p.resumeProducing()
+
     def clientConnectionLost(self, connector, reason):
         if self._protocol_instance and self._protocol_instance.heartbeat:
             logger.debug("stop heartbeating")
@@ -825,39 +2179,456 @@ class schemaFromDict(object):
             raise ValueError("Invalid schema dict: unexpected keys %r", ks)
         self.config = config
 
+    def _bindings(self, key, bind_fn):
+        for bind in self.config.get(key, ()):
+            if isinstance(bind, (tuple, list)):
+                yield bind_fn(*bind)
+            else:
+                yield bind_fn(**bind)
+
     @defer.inlineCallbacks
     def declareSchema(self, builder):
         logger.debug("Load schema from config %r", self.config)
 
-        for exchange, props in self.config.get('exchange', {}).items():
+        # entities of one kind are independent - declare them concurrently
+
+        def declareExchange(exchange, props):
             # small quirk
-            props = props or {}
+            props = dict(props or {})
             if 'type' in props and 'exchange_type' not in props:
                 props['exchange_type'] = props.pop('type')
+            return builder.declareExchange(exchange=exchange, **props)
 
-            yield builder.declareExchange(exchange=exchange, **props)
+        yield _declareAll(
+            declareExchange(exchange, props)
+            for exchange, props in self.config.get('exchange', {}).items())
 
-        for queue, props in self.config.get('queue', {}).items():
-            props = props or {}
-            yield builder.declareQueue(queue=queue, **props)
+        yield _declareAll(
+            builder.declareQueue(queue=queue, **(props or {}))
+            for queue, props in self.config.get('queue', {}).items())
 
-        for bind in self.config.get('bind', ()):
-            if isinstance(bind, (tuple, list)):
-                yield builder.bindQueue(*bind)
+        yield _declareAll(self._bindings('bind', builder.bindQueue))
+        yield _declareAll(self._bindings('bind_exchange', builder.bindExchange))
+
+
+components.registerAdapter(schemaFromDict, dict, IAMQPSchema)
+
+
+# --- integration with app-framework
+
+class _Deduplicator(object):
+
+    """Remembers keys of successfully processed messages.
+
+    Keys are kept in bounded in-memory LRU cache and, optionally, in memcache
+    (any object with `get`, `set` & `getMultiple`, f.e. `MemCacheCollectionService`
+    client), so duplicates are detected across workers & restarts too.
+    """
+
+    def __init__(
+            self,
+            key_fn=None,
+            max_size=100000,
+            ttl=3600,
+            memcache=None,
+            memcache_prefix="amqp-dedup:",
+            clock=None,
+    ):
+        self.key_fn = key_fn or operator.attrgetter('message_id')
+        self.ttl = ttl
+        self.memcache = memcache
+        self.memcache_prefix = memcache_prefix
+        self.seen = cache.LRUCache(max_size=max_size, ttl=ttl, clock=clock)
+        self.counters = collections.Counter()
+
+    def _memcacheKey(self, key):
+        if not isinstance(key, bytes):
+            key = (u"%s" % key).encode('utf-8')
+        return self.memcache_prefix + hashlib.sha1(key).hexdigest()
+
+    def _memcacheFailed(self, f, op):
+        logger.error("dedup memcache %s failed: %s", op, f.value)
+
+    def check(self, key):
+        """Returns `Deferred` which fires with `True` for processed keys."""
+
+        if key in self.seen:
+            self.counters['hits'] += 1
+            return defer.succeed(True)
+        if not self.memcache:
+            self.counters['misses'] += 1
+            return defer.succeed(False)
+
+        def on_result(result):
+            if result and result[1]:
+                self.counters['memcache_hits'] += 1
+                self.seen.set(key, True)
+                return True
+            self.counters['misses'] += 1
+            return False
+
+        d = defer.maybeDeferred(self.memcache.get, self._memcacheKey(key))
+        d.addErrback(self._memcacheFailed, 'get')
+        return d.addCallback(on_result)
+
+    def checkMultiple(self, keys):
+        """Returns `Deferred` which fires with set of processed keys."""
+
+        processed = set(k for k in keys if k in self.seen)
+        self.counters['hits'] += len(processed)
+        rest = [k for k in keys if k not in processed]
+        if not rest or not self.memcache:
+            self.counters['misses'] += len(rest)
+            return defer.succeed(processed)
+
+        mckeys = dict((self._memcacheKey(k), k) for k in rest)
+
+        def on_result(result):
+            for mckey, (_, value) in (result or {}).items():
+                if value and mckey in mckeys:
+                    key = mckeys[mckey]
+                    self.seen.set(key, True)
+                    processed.add(key)
+                    self.counters['memcache_hits'] += 1
+            self.counters['misses'] += len(keys) - len(processed)
+            return processed
+
+        d = defer.maybeDeferred(self.memcache.getMultiple, list(mckeys))
+        d.addErrback(self._memcacheFailed, 'getMultiple')
+        return d.addCallback(on_result)
+
+    def markProcessed(self, key):
+        self.seen.set(key, True)
+        if self.memcache:
+            defer.maybeDeferred(
+                self.memcache.set, self._memcacheKey(key), "1",
+                expireTime=int(self.ttl or 0),
+            ).addErrback(self._memcacheFailed, 'set')
+
+    def stats(self):
+        s = dict(self.counters)
+        s['size'] = len(self.seen)
+        return s
+
+
+def _build_dedup(dedup):
+    if not dedup or isinstance(dedup, _Deduplicator):
+        return dedup or None
+    elif dedup is True:
+        return _Deduplicator()
+    else:
+        return _Deduplicator(**dedup)
+
+
+class _ProcessCallbackFailed(Exception):
+    pass
+
+
+def _decodePayload(payload, deserialize):
+    body, content_type, content_encoding = payload
+    if not deserialize:
+        return body
+    return get_codec(content_type).loads(decompress(body, content_encoding))
+
+
+def _initChildProcess():
+    # forked child inherits reactor's signal handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _runInChildProcess(callback_name, payload, deserialize):
+    # executed by `_ProcessExecutor` in child process
+    try:
+        callback = reflect.namedAny(callback_name)
+        if isinstance(payload, list):
+            data = [_decodePayload(p, deserialize) for p in payload]
+        else:
+            data = _decodePayload(payload, deserialize)
+        callback(data)
+    except Exception:
+        return False, traceback.format_exc()
+    return True, None
+
+
+class _ProcessExecutor(object):
+
+    """Runs importable callbacks in pool of child processes.
+
+    Child gets raw message body (with content type & encoding) and decodes
+    it by itself. No more than `max_pending` tasks are submitted to pool,
+    slot is released only when task is finished in child process (not when
+    caller cancels it).
+
+    Pool can't kill single task, so when child process dies or task runs
+    longer than `task_timeout` the whole pool is restarted and all pending
+    tasks are failed.
+    """
+
+    watch_interval = 1
+    stop_timeout = 30
+    clock = reactor
+
+    def __init__(self, pool_size=None, max_pending=None, task_timeout=None):
+        self.pool_size = pool_size or multiprocessing.cpu_count()
+        self.max_pending = max_pending or self.pool_size * 2
+        self.task_timeout = task_timeout
+        self._semaphore = defer.DeferredSemaphore(self.max_pending)
+        self._pool = None
+        self._pids = None
+        self._tasks = {}  # id => (async result, deferred, deadline)
+        self._tasks_cnt = 0
+        self._watcher = None
+        self._stopping = []
+        self._running = False
+
+    @staticmethod
+    def callbackName(callback):
+        if not callable(callback):
+            return callback
+        name = reflect.fullyQualifiedName(callback)
+        try:
+            importable = reflect.namedAny(name) is callback
+        except Exception:
+            importable = False
+        if not importable:
+            raise ValueError("callback %r is not importable by name" % callback)
+        return name
+
+    def start(self):
+        self._running = True
+        if self._pool is not None:
+            return
+        logger.debug("start pool of %d processes", self.pool_size)
+        self._pool = multiprocessing.Pool(self.pool_size, _initChildProcess)
+        self._pids = self._workerPids()
+        self._watcher = task.LoopingCall(self._watch)
+        self._watcher.clock = self.clock
+        self._watcher.start(self.watch_interval, now=False)
+
+    def _workerPids(self):
+        return set(p.pid for p in self._pool._pool)
+
+    def call(self, callback_name, payload, deserialize=True):
+
+        acquired = self._semaphore.acquire()
+        d = defer.Deferred(lambda _: acquired.cancel())
+
+        def submit(_):
+            if self._pool is None:
+                self._semaphore.release()
+                d.errback(_ProcessCallbackFailed("process pool is not running"))
             else:
-                yield builder.bindQueue(**bind)
+                self._submit(d, callback_name, payload, deserialize)
 
-        for bind in self.config.get('bind_exchange', ()):
-            if isinstance(bind, (tuple, list)):
-                yield builder.bindExchange(*bind)
+        acquired.addCallbacks(submit, lambda f: None)
+        return d
+
+    def _submit(self, d, callback_name, payload, deserialize):
+
+        self._tasks_cnt += 1
+        tid = self._tasks_cnt
+        deadline = self.clock.seconds() + self.task_timeout if self.task_timeout else None
+        result = self._pool.apply_async(
+            _runInChildProcess, (callback_name, payload, deserialize),
+            callback=lambda r: reactor.callFromThread(self._onResult, tid, r),
+        )
+        self._tasks[tid] = result, d, deadline
+
+    def _onResult(self, tid, result):
+        t = self._tasks.pop(tid, None)
+        if t is None:
+            # task was failed by pool restart
+            return
+        self._semaphore.release()
+        d = t[1]
+        if d.called:
+            # cancelled
+            return
+        ok, tb = result
+        if ok:
+            d.callback(None)
+        else:
+            d.errback(_ProcessCallbackFailed(tb))
+
+    def _watch(self):
+        if self._pool is None:
+            return
+        if any(p.exitcode is not None for p in self._pool._pool) \
+                or self._workerPids() != self._pids:
+            self._restartPool("child process died")
+            return
+        now = self.clock.seconds()
+        for _, _, deadline in self._tasks.values():
+            if deadline is not None and deadline <= now:
+                self._restartPool("task timeout (%s secs)" % self.task_timeout)
+                return
+
+    def _failTasks(self, reason):
+        tasks, self._tasks = self._tasks, {}
+        for _, d, _ in tasks.values():
+            self._semaphore.release()
+            if not d.called:
+                d.errback(_ProcessCallbackFailed(reason))
+
+    def _terminate(self):
+        pool, self._pool = self._pool, None
+        if self._watcher is not None and self._watcher.running:
+            self._watcher.stop()
+        self._watcher = None
+
+        def terminate():
+            # joins worker & handler threads, may take seconds
+            pool.terminate()
+            pool.join()
+
+        return threads.deferToThread(terminate)
+
+    def _restartPool(self, reason):
+        logger.error("restart pool of %d processes - %s", self.pool_size, reason)
+        self._stopping.append(self._terminate())
+        if self._running:
+            self.start()
+        self._failTasks(reason)
+
+    @defer.inlineCallbacks
+    def stop(self):
+
+        self._running = False
+        deadline = self.clock.seconds() + self.stop_timeout
+        while self._tasks and self._pool is not None and self.clock.seconds() < deadline:
+            yield task.deferLater(self.clock, 0.1, self._watch)
+
+        if self._pool is not None:
+            logger.debug("stop pool of %d processes", self.pool_size)
+            if self._tasks:
+                self._stopping.append(self._terminate())
             else:
-                yield builder.bindExchange(**bind)
+                self._watcher.stop()
+                self._watcher = None
+                pool, self._pool = self._pool, None
+                pool.close()
+                self._stopping.append(threads.deferToThread(pool.join))
+
+        self._failTasks("process pool is stopped")
+        ds, self._stopping = self._stopping, []
+        yield defer.gatherResults(ds)
 
 
-components.registerAdapter(schemaFromDict, dict, IAMQPSchema)
+class _SchedulerClient(object):
 
+    __slots__ = ('weight', 'priority', 'vtime', 'waiting', 'active', 'granted')
+
+    def __init__(self, weight, priority, vtime):
+        self.weight = weight
+        self.priority = priority
+        self.vtime = vtime
+        self.waiting = collections.deque()
+        self.active = 0
+        self.granted = 0
+
+
+class _WeightedScheduler(object):
+
+    """Shares concurrency budget (`limit`) between consumers of one service.
+
+    Free slot goes to waiting consumer with the highest `priority`.
+    Consumers with same priority share slots proportionally to their
+    `weight` (start-time fair queueing). Slots unused by idle consumers
+    are borrowed by busy ones.
+    """
+
+    def __init__(self, limit):
+        assert limit >= 1
+        self.limit = limit
+        self.active = 0
+        self._vtime = 0.0
+        self._clients = {}
+
+    def _client(self, client):
+        st = self._clients.get(client)
+        if st is None:
+            st = self._clients[client] = _SchedulerClient(
+                weight=getattr(client, 'weight', None) or 1,
+                priority=getattr(client, 'priority', None) or 0,
+                vtime=self._vtime,
+            )
+        return st
+
+    def _grant(self, st):
+        self.active += 1
+        st.active += 1
+        st.granted += 1
+        self._vtime = st.vtime
+        st.vtime += 1.0 / st.weight
+
+    def _pick(self):
+        best = None
+        for st in self._clients.values():
+            if st.waiting and (
+                    best is None
+                    or st.priority > best.priority
+                    or (st.priority == best.priority and st.vtime < best.vtime)):
+                best = st
+        return best
+
+    def acquire(self, client):
+
+        st = self._client(client)
+        if not st.waiting:
+            # don't let idle client accumulate credit
+            st.vtime = max(st.vtime, self._vtime)
+        if self.active < self.limit:
+            self._grant(st)
+            return defer.succeed(None)
+
+        def cancel(d):
+            st.waiting.remove(d)
+            d.errback(_NotScheduled())
+
+        d = defer.Deferred(canceller=cancel)
+        st.waiting.append(d)
+        return d
+
+    def release(self, client):
+
+        self.active -= 1
+        st = self._clients.get(client)
+        if st is not None:
+            st.active -= 1
+
+        while self.active < self.limit:
+            st = self._pick()
+            if st is None:
+                break
+            d = st.waiting.popleft()
+            self._grant(st)
+            d.callback(None)
+
+    def run(self, client, fn, *args, **kwargs):
+
+        def call(_):
+            return defer.maybeDeferred(fn, *args, **kwargs).addBoth(release)
+
+        def release(x):
+            self.release(client)
+            return x
+
+        return self.acquire(client).addCallback(call)
+
+    def unregister(self, client):
+        st = self._clients.pop(client, None)
+        if st is not None:
+            for d in list(st.waiting):
+                d.cancel()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': sum(len(st.waiting) for st in self._clients.values()),
+        }
 
-# --- integration with app-framework
 
 class _BaseConsumer(service.Service):
 
@@ -874,18 +2645,53 @@ class _BaseConsumer(service.Service):
             deserialize=True,
             requeue_delay=None,
             on_error=None,
+            batch_size=None,
+            batch_timeout=None,
+            batch_on_error=None,
+            adaptive=None,
+            dedup=None,
+            weight=None,
+            priority=None,
+            executor=None,
+            pool_size=None,
+            stream=False,
+            task_timeout=None,
     ):
 
+        assert not executor or executor == 'process'
+        if executor:
+            self.executor = _ProcessExecutor(pool_size, task_timeout=task_timeout)
+            self.callback_name = _ProcessExecutor.callbackName(callback)
+            # keep pool busy, but still limited by prefetch
+            parallel = parallel or self.executor.max_pending
+        else:
+            self.executor = None
+
         self.callback = callback
         self.deserialize = deserialize
         self.parallel = parallel
         self.no_ack = no_ack
         self.requeue_delay = requeue_delay
         self.on_error = on_error
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch_on_error = batch_on_error
+        self.stream = stream
+        # shared between reconnects - keep learned limits
+        self.adaptive = _build_adaptive(adaptive)
+        self.dedup = _build_dedup(dedup)
+        self._dedup_inflight = {}
+        # share of `AMQPService.scheduler` budget
+        self.weight = weight or 1
+        self.priority = priority or 0
         self._active_callbacks = {}
         self._active_callbacks_cnt = 0
         self._consume_deferred = None
 
+        self.clock = reactor
+        self.counters = collections.Counter()
+        self.callback_latency = metrics.Histogram()
+
     @defer.inlineCallbacks
     def _cancelActiveCallbacks(self):
 
@@ -916,6 +2722,8 @@ class _BaseConsumer(service.Service):
             return
         logger.debug("start service %s", self)
         service.Service.startService(self)
+        if self.executor:
+            self.executor.start()
         p = self.parent.amqp_service.protocol
         if p:
             self.clientProtocolReady(p)
@@ -935,9 +2743,6 @@ class _BaseConsumer(service.Service):
             except Exception:
                 logger.exception("upps")
 
-            logger.debug("too quick consume-unconsume - sleep for 0.5 sec")
-            yield timed.sleep(0.5)
-
         logger.debug("stop service %s", self)
         p1 = self._protocol_instance
         p2 = self.parent.amqp_service.protocol
@@ -952,6 +2757,8 @@ class _BaseConsumer(service.Service):
                 logger.exception("Can't cancel consuming")
 
         yield self._cancelActiveCallbacks()
+        if self.executor:
+            yield self.executor.stop()
         yield defer.maybeDeferred(service.Service.stopService, self)
 
     def clientProtocolReady(self, protocol):
@@ -979,19 +2786,155 @@ class _BaseConsumer(service.Service):
         self.consumer_tag = None
         self._consume_deferred = None
 
-    def onMessage(self, msg):
+    def _scheduler(self):
+        amqp_service = getattr(self.parent, 'amqp_service', None)
+        return getattr(amqp_service, 'scheduler', None)
+
+    def _runCallback(self, data, count=1):
 
         self._active_callbacks_cnt += 1
         cid = self._active_callbacks_cnt
+        self.counters['messages'] += count
 
         def remove_ac(x):
             self._active_callbacks.pop(cid, None)
+            if isinstance(x, failure.Failure) and not x.check(_NotScheduled):
+                self.counters['failures'] += 1
             return x
 
-        data = deserialize(msg.body, msg.content_type) if self.deserialize else msg
-        d = self._active_callbacks[cid] = defer.maybeDeferred(self.callback, data)
+        scheduler = self._scheduler()
+        if scheduler:
+            d = scheduler.run(self, self._timedCallback, data)
+        else:
+            d = self._timedCallback(data)
+        self._active_callbacks[cid] = d
         return d.addBoth(remove_ac)
 
+    def _timedCallback(self, data):
+
+        t0 = self.clock.seconds()
+
+        def observe(x):
+            self.callback_latency.add(self.clock.seconds() - t0)
+            return x
+
+        if self.executor:
+            d = self.executor.call(self.callback_name, data, self.deserialize)
+        else:
+            d = defer.maybeDeferred(self.callback, data)
+        return d.addBoth(observe)
+
+    def _messageData(self, msg):
+        if self.executor:
+            # decoded by child process
+            p = msg.properties
+            return msg.body, p.content_type, p.content_encoding
+        return msg.data if self.deserialize else msg
+
+    def onMessage(self, msg):
+        if self.dedup:
+            key = self.dedup.key_fn(msg)
+            if key is not None:
+                return self._runDeduplicated(key, msg)
+        return self._runCallback(self._messageData(msg))
+
+    def _runDeduplicated(self, key, msg):
+
+        waiting = self._dedup_inflight.get(key)
+        if waiting is not None:
+            # same message is processed right now - check again when it's done
+            d = defer.Deferred()
+            waiting.append(d)
+            return d.addCallback(lambda _: self.onMessage(msg))
+        waiting = self._dedup_inflight[key] = []
+
+        def run(processed):
+            if processed:
+                logger.debug("skip duplicate message, key %r", key)
+                return
+            return self._runCallback(self._messageData(msg)).addCallback(mark)
+
+        def mark(x):
+            self.dedup.markProcessed(key)
+            return x
+
+        def done(x):
+            del self._dedup_inflight[key]
+            for d in waiting:
+                d.callback(None)
+            return x
+
+        return self.dedup.check(key).addCallback(run).addBoth(done)
+
+    def onBatch(self, msgs):
+        if self.dedup:
+            return self._runDeduplicatedBatch(msgs)
+        return self._runBatchCallback(msgs)
+
+    def _runBatchCallback(self, msgs):
+        if self.deserialize or self.executor:
+            data = [self._messageData(msg) for msg in msgs]
+        else:
+            data = msgs
+        return self._runCallback(data, len(msgs))
+
+    def _runDeduplicatedBatch(self, msgs):
+
+        keys = [self.dedup.key_fn(m) for m in msgs]
+
+        def run(processed):
+            batch_keys = set()
+            unique = []
+            for k, m in zip(keys, msgs):
+                if k is None:
+                    unique.append(m)
+                elif k not in processed and k not in batch_keys:
+                    batch_keys.add(k)
+                    unique.append(m)
+            if not unique:
+                logger.debug("skip batch of %d duplicates", len(msgs))
+                return
+            return self._runBatchCallback(unique).addCallback(mark, batch_keys)
+
+        def mark(x, batch_keys):
+            for k in batch_keys:
+                self.dedup.markProcessed(k)
+            return x
+
+        return self.dedup.checkMultiple(
+            [k for k in keys if k is not None]).addCallback(run)
+
+    def _consumeParams(self):
+        return dict(
+            callback=(self.onBatch if self.batch_size else self.onMessage),
+            parallel=self.parallel,
+            no_ack=self.no_ack,
+            requeue_delay=self.requeue_delay,
+            on_error=self.on_error,
+            batch_size=self.batch_size,
+            batch_timeout=self.batch_timeout,
+            batch_on_error=self.batch_on_error,
+            adaptive=self.adaptive,
+            stream=self.stream,
+        )
+
+    def stats(self):
+        s = {
+            'consumer_tag': self.consumer_tag,
+            'parallel': self.parallel,
+            'active_callbacks': len(self._active_callbacks),
+            'weight': self.weight,
+            'priority': self.priority,
+            'messages': self.counters['messages'],
+            'failures': self.counters['failures'],
+            'callback_latency': self.callback_latency.snapshot(),
+        }
+        if self.adaptive:
+            s.update(self.adaptive.stats())
+        if self.dedup:
+            s['dedup'] = self.dedup.stats()
+        return s
+
 
 class _QueueConsumer(_BaseConsumer):
 
@@ -1004,11 +2947,7 @@ class _QueueConsumer(_BaseConsumer):
     def _consume(self, protocol):
         return protocol.consumeQueue(
             queue=self.queue,
-            callback=self.onMessage,
-            parallel=self.parallel,
-            no_ack=self.no_ack,
-            requeue_delay=self.requeue_delay,
-            on_error=self.on_error,
+            **self._consumeParams()
         )
 
 
@@ -1017,21 +2956,103 @@ class _ExchangeConsumer(_BaseConsumer):
     """Consumes AMQP exchange & runs callback."""
     def __init__(self, exchange, callback, routing_key='', *args, **kwargs):
         _BaseConsumer.__init__(self, callback, *args, **kwargs)
+        if self.on_error == 'retry_queue':
+            raise ValueError("on_error 'retry_queue' is not supported for exchange consumers")
         self.exchange = exchange
         self.routing_key = routing_key
 
     def _consume(self, protocol):
         return protocol.consumeExchange(
             exchange=self.exchange,
-            callback=self.onMessage,
-            parallel=self.parallel,
-            no_ack=self.no_ack,
-            requeue_delay=self.requeue_delay,
-            on_error=self.on_error,
             routing_key=self.routing_key,
+            **self._consumeParams()
         )
 
 
+class _BatchSender(object):
+
+    """Sender callback, which coalesces messages into batches.
+
+    Messages sent within one reactor tick (but not more than `max_messages`
+    messages or `max_bytes` bytes) are published via single `publishBatch` call.
+    Each call returns own `Deferred`, which fires with result of whole batch.
+    """
+
+    def __init__(
+            self, amqp_service, exchange, routing_key=None, routing_key_fn=None,
+            content_type='json', confirm=True, max_messages=1000, max_bytes=1048576,
+            compression=None, clock=None,
+    ):
+
+        assert routing_key is None or routing_key_fn is None
+        self.amqp_service = amqp_service
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.routing_key_fn = routing_key_fn
+        self.content_type = content_type
+        self.confirm = confirm
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.clock = clock or reactor
+
+        self._properties = _BasicProperties(content_type=content_type or None)
+        self._dumps = get_codec(content_type).dumps
+        self._messages = []
+        self._waiters = []
+        self._bytes = 0
+        self._flush_call = None
+
+    def __call__(self, data):
+
+        rk = self.routing_key or (self.routing_key_fn and self.routing_key_fn(data)) or ''
+        body = self._dumps(data)
+
+        d = defer.Deferred()
+        self._messages.append({
+            'exchange': self.exchange,
+            'routing_key': rk,
+            'body': body,
+            'properties': self._properties,
+            'compression': self.compression,
+        })
+        self._waiters.append(d)
+        self._bytes += len(body)
+
+        if len(self._messages) >= self.max_messages or self._bytes >= self.max_bytes:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(0, self.flush)
+
+        return d
+
+    def flush(self):
+
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+        if not self._messages:
+            return
+
+        messages, self._messages = self._messages, []
+        waiters, self._waiters = self._waiters, []
+        self._bytes = 0
+
+        logger.debug("flush batch of %d messages to exchange %r", len(messages), self.exchange)
+
+        def notify_waiters(x):
+            for d in waiters:
+                if isinstance(x, failure.Failure):
+                    d.errback(x)
+                else:
+                    d.callback(x)
+
+        d = self.amqp_service.publishBatch(messages, confirm=self.confirm)
+        d.addBoth(notify_waiters)
+
+
 class _ConsumersContainer(service.MultiService):
 
     def __init__(self, amqp_service):
@@ -1043,13 +3064,44 @@ class AMQPService(pclient.PersistentClientService, object):
     # amqp service contains all conusumers as subservices
 
     name = 'amqp'
-    protocolProxiedMethods = ['publishMessage']
+    protocolProxiedMethods = ['publishMessage', 'publishBatch']
+
+    # global concurrency budget for callbacks of all consumers
+    max_parallel = None
+
+    # durable spool for messages published while broker is unreachable
+    spool_dir = None
+    spool_max_size = 1 << 30
+    spool_segment_size = 16 << 20
+    spool_window = 200
+    spool_retry_delay = 5
+
+    spool = None
+    _spool_inflight = 0
+    _spool_retry = None
 
     def __init__(self, *args, **kwargs):
         pclient.PersistentClientService.__init__(self, *args, **kwargs)
         self.consumer_services = _ConsumersContainer(self)
+        self.max_parallel = kwargs.get('max_parallel', self.max_parallel)
+        self.scheduler = _WeightedScheduler(self.max_parallel) if self.max_parallel else None
+        for p in [
+                'spool_dir',
+                'spool_max_size',
+                'spool_segment_size',
+                'spool_window',
+                'spool_retry_delay',
+        ]:
+            if p in kwargs:
+                setattr(self, p, kwargs[p])
 
     def startService(self):
+        if self.spool_dir and self.spool is None:
+            self.spool = spool.SegmentSpool(
+                self.spool_dir, segment_size=self.spool_segment_size,
+                max_size=self.spool_max_size)
+            if len(self.spool):
+                logger.info("%d spooled messages in %s", len(self.spool), self.spool_dir)
         pclient.PersistentClientService.startService(self)
         self.consumer_services.startService()
 
@@ -1061,24 +3113,170 @@ class AMQPService(pclient.PersistentClientService, object):
     def stopService(self):
         yield self.consumer_services.stopService()
         yield defer.maybeDeferred(pclient.PersistentClientService.stopService, self)
+        if self._spool_retry is not None and self._spool_retry.active():
+            self._spool_retry.cancel()
+        self._spool_retry = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
 
     def needToRetryProtocolCall(self, f):
         return f.check(ConnectionDone) or f.check(_NotReadyForPublish)
 
-    def clientConnectionLost(self, reason):
+    # -- spool
+
+    def publishMessage(
+            self, exchange, routing_key, body,
+            message_ttl=None, content_type=None, properties=None,
+            confirm=True, compression=None):
+        """Publish message via current connection.
+
+        When spool is enabled, message is stored to spool (and resulting
+        deferred fires immediately) while broker is unreachable or older
+        spooled messages are not published yet.
+        """
+
+        if self.spool is None:
+            return self.protocolCall(
+                'publishMessage', exchange, routing_key, body,
+                message_ttl=message_ttl, content_type=content_type,
+                properties=properties, confirm=confirm, compression=compression)
+
+        args = exchange, routing_key, body, message_ttl, content_type, properties, compression
         p = self.protocol
-        if p and p.heartbeat:
-            logger.debug("stop heartbeating")
-            p.heartbeat.stop()
-        return pclient.PersistentClientService.clientConnectionLost(self, reason)
+        if p is None or len(self.spool):
+            return defer.maybeDeferred(self._spoolPublish, *args)
+
+        def spoolOnError(f):
+            if not self.needToRetryProtocolCall(f) or self.spool is None:
+                return f
+            return self._spoolPublish(*args)
+
+        return defer.maybeDeferred(
+            p.publishMessage, exchange, routing_key, body,
+            message_ttl=message_ttl, content_type=content_type,
+            properties=properties, confirm=confirm, compression=compression,
+        ).addErrback(spoolOnError)
+
+    def _spoolPublish(
+            self, exchange, routing_key, body,
+            message_ttl, content_type, properties, compression):
+        logger.debug("spool message, exchange %r, rk %r", exchange, routing_key)
+        self.spool.append(_packSpoolRecord(
+            exchange, routing_key, serialize(body, content_type),
+            _spoolProperties(content_type, message_ttl, properties), compression))
+        self._drainSpool()
+
+    def _drainSpool(self):
+
+        p = self.protocol
+        if p is None or self.spool is None or self._spool_retry is not None:
+            return
+
+        while self._spool_inflight < self.spool_window:
+            r = self.spool.read()
+            if r is None:
+                break
+            pos, record = r
+            exchange, routing_key, data, properties, compression = _unpackSpoolRecord(record)
+            self._spool_inflight += 1
+            defer.maybeDeferred(
+                p.publishMessage, exchange, routing_key, data,
+                properties=properties, compression=compression, confirm=True,
+            ).addCallbacks(
+                self._spooledPublished, self._spooledPublishFailed,
+                callbackArgs=(pos,),
+            )
+
+    def _spooledPublished(self, _, pos):
+        self._spool_inflight -= 1
+        if self.spool is not None:
+            self.spool.ack(pos)
+            self._drainSpool()
+
+    def _spooledPublishFailed(self, f):
+        self._spool_inflight -= 1
+        logger.warning("can't publish spooled message: %s", f.getErrorMessage())
+        if self.spool is not None and self._spool_retry is None:
+            self._spool_retry = self.clock.callLater(self.spool_retry_delay, self._retryDrainSpool)
+
+    def _retryDrainSpool(self):
+        if self._spool_inflight:
+            # wait for all in-flight messages before rereading them
+            self._spool_retry = self.clock.callLater(
+                self.spool_retry_delay, self._retryDrainSpool)
+            return
+        self._spool_retry = None
+        self.spool.rewind()
+        self._drainSpool()
 
     def clientProtocolReady(self, protocol):
         pclient.PersistentClientService.clientProtocolReady(self, protocol)
         for ss in self.consumer_services.services:
             ss.clientProtocolReady(protocol)
+        if self.spool is not None and not self._spool_inflight:
+            if self._spool_retry is not None and self._spool_retry.active():
+                self._spool_retry.cancel()
+            self._spool_retry = None
+            self.spool.rewind()
+            self._drainSpool()
+
+    def checkHealth(self):
+
+        spooled = None
+        if self.spool is not None and len(self.spool):
+            spooled = "spooled {0} msgs, {1:.1%} of spool".format(
+                len(self.spool), self.spool.size / self.spool.max_size)
+
+        try:
+            pclient.PersistentClientService.checkHealth(self)
+        except Exception as e:
+            if spooled:
+                raise Exception("{0}, {1}".format(e, spooled))
+            raise
+
+        m = self.protocol.getMetrics()
+        comment = [
+            "in {0}, out {1}, unconfirmed {2}, requeue {3}".format(
+                m.get('messages_in', 0), m.get('messages_out', 0),
+                m['published_inflight'], m['delayed_requeue']),
+        ]
+        if spooled:
+            comment.append(spooled)
+        comment.extend(
+            "{0}: parallel {1[parallel]}, prefetch {1[prefetch_count]}".format(
+                c.consumer_tag, c.stats())
+            for c in self.consumer_services
+            if c.adaptive and c.consumer_tag
+        )
+        return "; ".join(comment)
+
+    def getConsumersStats(self):
+        return [c.stats() for c in self.consumer_services]
+
+    def getMetrics(self):
+        """Returns metrics of current connection & all consumers."""
+        p = self.protocol
+        return {
+            'connection': p.getMetrics() if p else None,
+            'consumers': self.getConsumersStats(),
+            'scheduler': self.scheduler.stats() if self.scheduler else None,
+            'spool': self.spool.stats() if self.spool is not None else None,
+        }
+
+    def clientConnectionLost(self, reason):
+        p = self.protocol
+        if p and p.heartbeat:
+            logger.debug("stop heartbeating")
+            p.heartbeat.stop()
+        return pclient.PersistentClientService.clientConnectionLost(self, reason)
 
     def setupQueueConsuming(self, queue, callback, no_ack=False, parallel=0,
-                            deserialize=True, requeue_delay=None, on_error=None):
+                            deserialize=True, requeue_delay=None, on_error=None,
+                            batch_size=None, batch_timeout=None, batch_on_error=None,
+                            adaptive=None, dedup=None, weight=None, priority=None,
+                            executor=None, pool_size=None, stream=False,
+                            task_timeout=None):
 
         logger.debug("setup queue consuming for conn %r, queue %r", self, queue)
         qc = _QueueConsumer(
@@ -1089,12 +3287,27 @@ class AMQPService(pclient.PersistentClientService, object):
             deserialize=deserialize,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            batch_on_error=batch_on_error,
+            adaptive=adaptive,
+            dedup=dedup,
+            weight=weight,
+            priority=priority,
+            executor=executor,
+            pool_size=pool_size,
+            stream=stream,
+            task_timeout=task_timeout,
         )
         qc.setServiceParent(self.consumer_services)
         return qc
 
     def setupExchangeConsuming(self, exchange, callback, routing_key='', requeue_delay=None,
-                               parallel=0, deserialize=True, no_ack=False, on_error=None):
+                               parallel=0, deserialize=True, no_ack=False, on_error=None,
+                               batch_size=None, batch_timeout=None, batch_on_error=None,
+                               adaptive=None, dedup=None, weight=None, priority=None,
+                               executor=None, pool_size=None, stream=False,
+                               task_timeout=None):
 
         logger.debug("setup exchange consuming for conn %r, exch %r", self, exchange)
         qc = _ExchangeConsumer(
@@ -1106,33 +3319,80 @@ class AMQPService(pclient.PersistentClientService, object):
             parallel=parallel,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            batch_on_error=batch_on_error,
+            adaptive=adaptive,
+            dedup=dedup,
+            weight=weight,
+            priority=priority,
+            executor=executor,
+            pool_size=pool_size,
+            stream=stream,
+            task_timeout=task_timeout,
         )
         qc.setServiceParent(self.consumer_services)
         return qc
 
+    def addPushProducer(self, producer):
+        """Register `IPushProducer`, which is paused while publish window is full."""
+        self.factory.addPushProducer(producer)
+
+    def removePushProducer(self, producer):
+        self.factory.removePushProducer(producer)
+
     def unsetupConsuming(self, consumer):
         assert isinstance(consumer, _BaseConsumer)
-        self.consumer_services.removeService(consumer)
+        d = defer.maybeDeferred(self.consumer_services.removeService, consumer)
+        if self.scheduler:
+            d.addBoth(lambda x: self.scheduler.unregister(consumer) or x)
+        return d
 
     def makeSender(self, exchange, routing_key=None, routing_key_fn=None,
-                   content_type='json', confirm=True):
+                   content_type='json', confirm=True, compression=None):
 
         assert routing_key is None or routing_key_fn is None
         logger.debug(
             "build sender callback for conn %r, " "exchange %r, ctype %s, confirm flag %r",
             self, exchange, content_type, confirm)
 
+        # resolve codec & build message properties only once
+        dumps = get_codec(content_type).dumps
+        properties = _BasicProperties(content_type=content_type or None)
+
         def send(data):
             rk = routing_key or (routing_key_fn and routing_key_fn(data)) or ''
             return self.publishMessage(
                 exchange=exchange,
                 routing_key=rk,
-                body=data,
-                content_type=content_type,
+                body=dumps(data),
+                properties=properties,
                 confirm=confirm,
+                compression=compression,
             )
         return send
 
+    def makeBatchSender(self, exchange, routing_key=None, routing_key_fn=None,
+                        content_type='json', confirm=True,
+                        max_messages=1000, max_bytes=1048576, compression=None):
+
+        logger.debug(
+            "build batch sender callback for conn %r, exchange %r, ctype %s, confirm flag %r",
+            self, exchange, content_type, confirm)
+
+        return _BatchSender(
+            self,
+            exchange=exchange,
+            routing_key=routing_key,
+            routing_key_fn=routing_key_fn,
+            content_type=content_type,
+            confirm=confirm,
+            max_messages=max_messages,
+            max_bytes=max_bytes,
+            compression=compression,
+            clock=self.clock,
+        )
+
 
 class AMQPCollectionService(pclient.PersistentClientsCollectionService):
 
@@ -1153,3 +3413,15 @@ class AMQPCollectionService(pclient.PersistentClientsCollectionService):
 
     def makeSender(self, connection, *args, **kwargs):
         return self[connection].makeSender(*args, **kwargs)
+
+    def makeBatchSender(self, connection, *args, **kwargs):
+        return self[connection].makeBatchSender(*args, **kwargs)
+
+    def addPushProducer(self, connection, producer):
+        return self[connection].addPushProducer(producer)
+
+    def removePushProducer(self, connection, producer):
+        return self[connection].removePushProducer(producer)
+
+    def getMetrics(self):
+        return dict((c, self[c].getMetrics()) for c in self.connections)
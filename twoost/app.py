@@ -114,6 +114,10 @@ def build_amqps(app, active_connections=None):
         d[conn] = dict(params)
         if conn in schemas:
             d[conn]['schema'] = schemas[conn]
+        if d[conn].pop('spool', None) and not d[conn].get('spool_dir'):
+            # each worker has own spool
+            workerid = getattr(app, 'workerid', None) or 'default'
+            d[conn]['spool_dir'] = os.path.join(settings.PID_DIR, 'spool', workerid, conn)
 
     return attach_service(app, amqp.AMQPCollectionService(d))
 
@@ -0,0 +1,89 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+In-process caches.
+"""
+
+import sys
+import collections
+
+from twisted.internet import reactor
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'LRUCache',
+]
+
+
+def _sizeof(value):
+    if isinstance(value, bytes):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+
+    """Bounded mapping with LRU eviction and optional expiration (`ttl`).
+
+    Size is limited by number of items (`max_size`) and optionally by
+    total size of values (`max_bytes`, measured by `sizeof`).
+    """
+
+    def __init__(self, max_size=10000, ttl=None, clock=None, max_bytes=None, sizeof=None):
+        assert max_size > 0
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock or reactor
+        self.sizeof = sizeof or _sizeof
+        self.bytes = 0
+        self._data = collections.OrderedDict()  # key => (value, expire_at, size)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        try:
+            item = self._data.pop(key)
+        except KeyError:
+            return None
+        if item[1] is not None and item[1] <= self.clock.seconds():
+            self.bytes -= item[2]
+            return None
+        self._data[key] = item
+        return item
+
+    def get(self, key, default=None):
+        item = self._lookup(key)
+        return default if item is None else item[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expire_at = self.clock.seconds() + ttl if ttl else None
+        size = self.sizeof(value) if self.max_bytes else 0
+        self.delete(key)
+        self._data[key] = value, expire_at, size
+        self.bytes += size
+        while len(self._data) > self.max_size or (
+                self.max_bytes and self.bytes > self.max_bytes and len(self._data) > 1):
+            _, item = self._data.popitem(last=False)
+            self.bytes -= item[2]
+
+    def delete(self, key):
+        item = self._data.pop(key, None)
+        if item is None:
+            return False
+        self.bytes -= item[2]
+        return True
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
@@ -0,0 +1,87 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+Consistent hashing (ketama-style ring with weighted virtual nodes).
+"""
+
+import bisect
+import struct
+import hashlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'HashRing',
+]
+
+
+_POINTS = struct.Struct('<IIII')
+
+
+def _md5(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.md5(key).digest()
+
+
+class HashRing(object):
+
+    """Maps keys to nodes, adding or removing node remaps ~1/n of keys.
+
+    `nodes` is a dict `name => weight` (or list of names).  Each node gets
+    about `replicas * weight / avg_weight` points on the ring, 4 points per
+    md5 digest of "name-i" - same layout as in libketama.
+    """
+
+    def __init__(self, nodes, replicas=160):
+
+        if not isinstance(nodes, dict):
+            nodes = dict.fromkeys(nodes, 1)
+        assert nodes, "no nodes"
+        assert all(w > 0 for w in nodes.values())
+
+        self.nodes = dict(nodes)
+        self.replicas = replicas
+
+        total = sum(nodes.values())
+        points = []
+        for name in sorted(nodes):
+            digests = int(replicas * len(nodes) * nodes[name] / total) // 4 or 1
+            for i in range(digests):
+                for p in _POINTS.unpack(_md5("%s-%d" % (name, i))):
+                    points.append((p, name))
+        points.sort()
+
+        self._points = [p for p, _ in points]
+        self._names = [n for _, n in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _index(self, key):
+        p = _POINTS.unpack(_md5(key))[0]
+        i = bisect.bisect(self._points, p)
+        return 0 if i == len(self._points) else i
+
+    def getNode(self, key):
+        return self._names[self._index(key)]
+
+    def iterNodes(self, key):
+        """Yields all nodes (each once) in order of preference for `key`."""
+        i = start = self._index(key)
+        names = self._names
+        seen = set()
+        while 1:
+            n = names[i]
+            if n not in seen:
+                seen.add(n)
+                yield n
+                if len(seen) == len(self.nodes):
+                    return
+            i = (i + 1) % len(names)
+            if i == start:
+                return
@@ -1,17 +1,33 @@
 # coding: utf-8
 
+from __future__ import print_function, division
+
+import re
+import math
+import uuid
+import random
+import hashlib
+import datetime
 import itertools
 import functools
+import collections
 
-from twisted.internet import defer
-from twisted.protocols.memcache import MemCacheProtocol
+import msgpack
+import zope.interface
 
+from twisted.internet import defer, reactor, task
+from twisted.application import service
+from twisted.protocols.memcache import MemCacheProtocol, ClientError
+from twisted.python import failure
+
+from twoost import health, cache
 from .pclient import (
     PersistentClientsCollectionService,
     PersistentClientFactory,
     PersistentClientProtocol,
 )
 from twoost._misc import merge_dicts
+from twoost.hashring import HashRing
 
 
 import logging
@@ -19,8 +35,13 @@ logger = logging.getLogger(__name__)
 
 
 __all__ = [
+    'cached',
+    'invalidate_tags',
+    'CoalescingMemCacheClient',
     'MemCacheCollectionService',
-]  
+    'MemCachePoolService',
+    'TwoTierMemCacheClient',
+]
 
 
 class _MemCacheProtocol(PersistentClientProtocol, MemCacheProtocol):
@@ -120,6 +141,349 @@ class _MemCacheMultiClientProxy(object):
         raise NotImplementedError
 
 
+class CoalescingMemCacheClient(object):
+
+    """Merges `get`s issued within one reactor tick into `getMultiple`.
+
+    Concurrent gets of the same key share one request (including
+    requests already sent).  Keys are grouped by server when `client`
+    is a multi client, so failure of one server fails only its keys.
+    Invalid keys are rejected before batching, so they can't fail
+    gets of other callers.  Other methods are passed to `client` as is.
+    """
+
+    max_batch_size = 200
+    max_key_length = 250
+
+    def __init__(self, client, clock=None):
+        self.client = client
+        self.clock = clock or reactor
+        self.counters = collections.Counter()
+        self._waiters = {}  # key => [deferred], for pending & sent keys
+        self._pending = []
+        self._flush_call = None
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get(self, key, withIdentifier=False):
+        if withIdentifier:
+            return self.client.get(key, withIdentifier)
+        self.counters['gets'] += 1
+        if not isinstance(key, bytes):
+            return defer.fail(ClientError(
+                "Invalid type for key: %s, expecting bytes" % (type(key),)))
+        if len(key) > self.max_key_length:
+            return defer.fail(ClientError("Key too long"))
+        if _UNSAFE_KEY_RE.search(key.decode('latin-1')):
+            return defer.fail(ClientError("Invalid character in key"))
+        d = defer.Deferred()
+        ws = self._waiters.get(key)
+        if ws is not None:
+            self.counters['coalesced'] += 1
+            ws.append(d)
+            return d
+        self._waiters[key] = [d]
+        self._pending.append(key)
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(0, self._flush)
+        return d
+
+    def getMultiple(self, keys, withIdentifier=False):
+        if withIdentifier:
+            return self.client.getMultiple(keys, withIdentifier)
+        keys = list(keys)
+        ds = [self.get(k) for k in keys]
+        return defer.gatherResults(ds, consumeErrors=True).addCallbacks(
+            lambda vs: dict(zip(keys, vs)),
+            lambda f: f.value.subFailure,
+        )
+
+    def _groups(self, keys):
+        resolve = getattr(self.client, 'resolveClientNameByKey', None)
+        if resolve is None:
+            return [(self.client, keys)]
+        groups = collections.defaultdict(list)
+        for k in keys:
+            try:
+                groups[resolve(k)].append(k)
+            except Exception:
+                self._failKeys([k], failure.Failure())
+        res = []
+        for cn, ks in groups.items():
+            try:
+                res.append((self.client.memcaches[cn], ks))
+            except LookupError:
+                self._failKeys(ks, failure.Failure(
+                    ValueError("unknown memcache server", cn)))
+        return res
+
+    def _failKeys(self, keys, f):
+        for k in keys:
+            for d in self._waiters.pop(k, ()):
+                d.errback(f)
+
+    def _flush(self):
+        self._flush_call = None
+        keys, self._pending = self._pending, []
+        try:
+            groups = self._groups(keys)
+        except Exception:
+            # don't leave waiters hanging in `_waiters` forever
+            self._failKeys(keys, failure.Failure())
+            return
+        n = self.max_batch_size
+        for client, ks in groups:
+            for i in range(0, len(ks), n):
+                self._fetch(client, ks[i:i + n])
+
+    def _fetch(self, client, keys):
+
+        self.counters['batches'] += 1
+        self.counters['batched_keys'] += len(keys)
+
+        def done(result):
+            for k in keys:
+                for d in self._waiters.pop(k, ()):
+                    d.callback(result.get(k, (0, None)))
+
+        d = defer.maybeDeferred(client.getMultiple, keys)
+        d.addCallbacks(done, lambda f: self._failKeys(keys, f))
+
+
+class TwoTierMemCacheClient(object):
+
+    """Per-process LRU cache (L1) in front of memcache client.
+
+    Values stay in L1 for `ttl` seconds, misses - for `negative_ttl`
+    (not cached when None).  After that value is served stale for up to
+    `stale_ttl` seconds while one request refreshes it, and concurrent
+    misses of one key share one memcache request - so expiration of hot
+    key doesn't cause a stampede.
+
+    With `write='through'` successfully set values go to L1, with
+    `write='invalidate'` they are just dropped from L1.  Other processes
+    see changes after `ttl` at most.
+    """
+
+    def __init__(
+            self, client,
+            ttl=1, stale_ttl=5, negative_ttl=None,
+            max_size=10000, max_bytes=None,
+            write='through', clock=None):
+
+        assert write in ('through', 'invalidate')
+        self.client = client
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.write = write
+        self.clock = clock or reactor
+        # key => (flags, value, fresh_until)
+        self.l1 = cache.LRUCache(
+            max_size=max_size, max_bytes=max_bytes, clock=self.clock,
+            sizeof=lambda x: len(x[1] or b''))
+        self.counters = collections.Counter()
+        self._inflight = {}  # key => [deferred]
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _store(self, key, flags, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl:
+            self.l1.set(key, (flags, value, self.clock.seconds() + ttl), ttl + self.stale_ttl)
+
+    def get(self, key, withIdentifier=False):
+
+        if withIdentifier:
+            return self.client.get(key, withIdentifier)
+
+        item = self.l1.get(key)
+        if item is not None:
+            flags, value, fresh_until = item
+            if fresh_until > self.clock.seconds():
+                self.counters['hits' if value is not None else 'negative_hits'] += 1
+            else:
+                self.counters['stale_hits'] += 1
+                if key not in self._inflight:
+                    self._fetch(key).addErrback(
+                        lambda f: logger.error("can't refresh %r: %s", key, f.value))
+            return defer.succeed((flags, value))
+
+        self.counters['misses'] += 1
+        return self._fetch(key)
+
+    def _fetch(self, key):
+
+        d = defer.Deferred()
+        waiters = self._inflight.get(key)
+        if waiters is not None:
+            self.counters['coalesced'] += 1
+            waiters.append(d)
+            return d
+
+        waiters = self._inflight[key] = [d]
+        self.counters['fetches'] += 1
+
+        def done(result):
+            # value may be changed by `set` while we were waiting
+            if self._inflight.get(key) is waiters:
+                del self._inflight[key]
+                self._store(key, *result)
+            for w in waiters:
+                w.callback(result)
+
+        def fail(f):
+            if self._inflight.get(key) is waiters:
+                del self._inflight[key]
+            for w in waiters:
+                w.errback(f)
+
+        defer.maybeDeferred(self.client.get, key).addCallbacks(done, fail)
+        return d
+
+    def getMultiple(self, keys, withIdentifier=False):
+        if withIdentifier:
+            return self.client.getMultiple(keys, withIdentifier)
+        keys = list(keys)
+        return defer.gatherResults([self.get(k) for k in keys], consumeErrors=True).addCallbacks(
+            lambda vs: dict(zip(keys, vs)),
+            lambda f: f.value.subFailure,
+        )
+
+    def invalidate(self, key):
+        """Drops `key` from L1 only."""
+        self.l1.delete(key)
+        self._inflight.pop(key, None)
+
+    def set(self, key, val, flags=0, expireTime=0):
+
+        self.invalidate(key)
+        d = defer.maybeDeferred(self.client.set, key, val, flags, expireTime)
+
+        def stored(x):
+            if self.write == 'through' and x:
+                # don't let concurrent `get` overwrite it with older value
+                self._inflight.pop(key, None)
+                self._store(key, flags, val)
+            return x
+
+        return d.addCallback(stored)
+
+    def __buildInvalidatingMethod(name):
+        @functools.wraps(getattr(MemCacheProtocol, name))
+        def method(self, key, *args, **kwargs):
+            self.invalidate(key)
+            return getattr(self.client, name)(key, *args, **kwargs)
+        return method
+
+    for m in [
+        'increment',
+        'decrement',
+        'replace',
+        'add',
+        'checkAndSet',
+        'append',
+        'prepend',
+        'delete',
+    ]:
+        locals()[m] = __buildInvalidatingMethod(m)
+
+    def getMetrics(self):
+        m = dict(self.counters)
+        lookups = sum(self.counters[x] for x in ('hits', 'negative_hits', 'stale_hits', 'misses'))
+        hits = lookups - self.counters['misses']
+        m['hit_ratio'] = hits / lookups if lookups else None
+        m['l1_size'] = len(self.l1)
+        m['l1_bytes'] = self.l1.bytes
+        return m
+
+
+@zope.interface.implementer(health.IHealthChecker)
+class MemCachePoolService(service.Service, object):
+
+    """Several connections to one memcache server.
+
+    Memcache protocol answers requests in order, so one slow request
+    delays all requests behind it on the same connection.  Pool sends
+    each call to connected client with least outstanding requests.
+    Clients aren't subservices - health is checked for server as a whole.
+    """
+
+    def __init__(self, clients, protocolProxiedMethods):
+        assert clients
+        self.clients = list(clients)
+        self.protocolProxiedMethods = protocolProxiedMethods
+        self._outstanding = [0] * len(self.clients)
+        self._calls = [0] * len(self.clients)
+
+    def startService(self):
+        service.Service.startService(self)
+        for c in self.clients:
+            c.startService()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        return defer.gatherResults([
+            defer.maybeDeferred(c.stopService) for c in self.clients
+        ])
+
+    def _pickClient(self):
+        best = None
+        for i, c in enumerate(self.clients):
+            if c.protocol and (best is None or self._outstanding[i] < self._outstanding[best]):
+                best = i
+        if best is None:
+            # nothing is connected - let client delay or fail the call
+            best = self._outstanding.index(min(self._outstanding))
+        return best
+
+    @property
+    def protocol(self):
+        for c in self.clients:
+            if c.protocol:
+                return c.protocol
+
+    def protocolCall(self, method_name, *args, **kwargs):
+
+        i = self._pickClient()
+        self._outstanding[i] += 1
+        self._calls[i] += 1
+
+        def done(x):
+            self._outstanding[i] -= 1
+            return x
+
+        d = defer.maybeDeferred(self.clients[i].protocolCall, method_name, *args, **kwargs)
+        return d.addBoth(done)
+
+    def __getattr__(self, name):
+        if name in self.protocolProxiedMethods:
+            m = functools.partial(self.protocolCall, name)
+            setattr(self, name, m)
+            return m
+        raise AttributeError(name)
+
+    def dropConnection(self):
+        return defer.gatherResults([c.dropConnection() for c in self.clients])
+
+    def checkHealth(self):
+        connected = sum(1 for c in self.clients if c.protocol)
+        if not connected:
+            raise Exception("no connections, reconnect in %s secs" % int(
+                min(c.reconnect_delay for c in self.clients)))
+        return "%d of %d connections" % (connected, len(self.clients))
+
+    def poolStats(self):
+        return {
+            'pool_size': len(self.clients),
+            'connected': sum(1 for c in self.clients if c.protocol),
+            'outstanding': sum(self._outstanding),
+            'calls': sum(self._calls),
+        }
+
+
 class MemCacheFactory(PersistentClientFactory):
     protocol = MemCacheProtocol
 
@@ -154,9 +518,364 @@ class MemCacheCollectionService(PersistentClientsCollectionService):
         'callretry_delay': 0,
     }
 
-    def multiClient(self, resolveClientNameByKey):
+    def buildClientService(self, endpoint, factory, params):
+        pool_size = params.get('pool_size') or 1
+        if pool_size == 1:
+            return PersistentClientsCollectionService.buildClientService(
+                self, endpoint, factory, params)
+        return MemCachePoolService(
+            [
+                PersistentClientsCollectionService.buildClientService(
+                    self, endpoint, factory, params)
+                for _ in range(pool_size)
+            ],
+            self.protocolProxiedMethods,
+        )
+
+    def poolStats(self):
+        """Returns `server name => connection stats`."""
+        r = {}
+        for s in self:
+            if isinstance(s, MemCachePoolService):
+                r[s.name] = s.poolStats()
+            else:
+                r[s.name] = {'pool_size': 1, 'connected': int(bool(s.protocol))}
+        return r
+
+    # virtual nodes per server on hash ring (see `HashRing`)
+    ring_replicas = 160
+
+    _ring = None
+
+    @property
+    def ring(self):
+        if self._ring is None:
+            self._ring = HashRing(
+                dict((name, p.get('weight', 1)) for name, p in self.connections.items()),
+                replicas=self.ring_replicas,
+            )
+        return self._ring
+
+    def ringResolver(self, failover=True):
+        """Returns function `key => server name`, based on consistent hash ring.
+
+        With `failover` keys of disconnected (reconnecting) server go to
+        next connected server on the ring.
+        """
+
+        ring = self.ring
+        if not failover:
+            return ring.getNode
+
+        def resolve(key):
+            for name in ring.iterNodes(key):
+                if self[name].protocol:
+                    return name
+            # nothing is connected - let primary server queue/fail the call
+            return ring.getNode(key)
+
+        return resolve
+
+    def multiClient(self, resolveClientNameByKey=None):
+        if resolveClientNameByKey is None:
+            resolveClientNameByKey = self.ringResolver()
         return _MemCacheMultiClientProxy(self, resolveClientNameByKey)
 
+    def coalescingClient(self, name=None, resolveClientNameByKey=None):
+        """Returns `CoalescingMemCacheClient` for one server or for multi client."""
+        if name is not None:
+            return CoalescingMemCacheClient(self[name])
+        return CoalescingMemCacheClient(self.multiClient(resolveClientNameByKey))
+
+    def twoTierClient(self, name=None, **kwargs):
+        """Returns `TwoTierMemCacheClient` over `coalescingClient(name)`."""
+        return TwoTierMemCacheClient(self.coalescingClient(name), **kwargs)
+
 
 # deprecated
 MemCacheService = MemCacheCollectionService
+
+
+# --- cache-aside decorator
+
+_EXT_DATETIME = 1
+_EXT_DATE = 2
+_DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def _packDefault(obj):
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(_EXT_DATETIME, obj.isoformat().encode('ascii'))
+    elif isinstance(obj, datetime.date):
+        return msgpack.ExtType(_EXT_DATE, obj.isoformat().encode('ascii'))
+    elif hasattr(obj, 'keys'):
+        # db rows (f.e. `sqlite3.Row`) are cached as dicts
+        return dict((k, obj[k]) for k in obj.keys())
+    raise TypeError("can't serialize %r" % (obj,))
+
+
+def _parseDatetime(s):
+    for f in _DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(s, f)
+        except ValueError:
+            pass
+    raise ValueError("invalid datetime %r" % s)
+
+
+def _extHook(code, data):
+    if code == _EXT_DATETIME:
+        return _parseDatetime(data.decode('ascii'))
+    elif code == _EXT_DATE:
+        return _parseDatetime(data.decode('ascii') + 'T00:00:00').date()
+    return msgpack.ExtType(code, data)
+
+
+def _packCached(obj):
+    return msgpack.packb(obj, default=_packDefault, use_bin_type=True)
+
+
+def _unpackCached(data):
+    return msgpack.unpackb(data, ext_hook=_extHook, raw=False)
+
+
+_UNSAFE_KEY_RE = re.compile(r'[\x00-\x20\x7f]')
+
+
+def _safeKey(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    if len(key) > 200 or _UNSAFE_KEY_RE.search(key.decode('latin-1')):
+        key = hashlib.md5(key).hexdigest().encode('ascii')
+    return key
+
+
+def _tagKey(tag):
+    return _safeKey("tag:%s" % tag)
+
+
+def _cacheClient(memcache, cache=None):
+    if cache is not None:
+        return memcache[cache]
+    elif hasattr(memcache, 'multiClient'):
+        return memcache.multiClient()
+    return memcache
+
+
+def invalidate_tags(memcache, tags, cache=None):
+    """Invalidates all values cached by `cached` with any of `tags`."""
+    client = _cacheClient(memcache, cache)
+    return defer.gatherResults([
+        defer.maybeDeferred(client.set, _tagKey(t), uuid.uuid4().hex)
+        for t in tags
+    ])
+
+
+def cached(key_fn, ttl, cache=None, tags=None, version=None,
+           early_refresh=1.0, lock_timeout=None, lock_poll=0.05, clock=None):
+    """Cache-aside for methods returning Deferred, values are stored via msgpack.
+
+    Memcache is taken from `memcache` attribute of instance (method is
+    called directly when it's None), `cache` is name of memcache server
+    (keys are spread over all servers by default).  Key is
+    `key_fn(*args, **kwargs)` prefixed with module, class & method names
+    and `version`.
+
+    Only one call per process recomputes missing key, others wait for it.
+    With `lock_timeout` calls in other processes wait too (up to
+    `lock_timeout` seconds, lock is a memcache key).  Value may be
+    recomputed a bit before expiration, probability grows with time spent
+    on computation (`early_refresh` scales it, 0 disables).
+
+    `tags` (list or function of method args) marks value, see
+    `invalidate_tags`.  Decorated method has `invalidate(instance, *args)`.
+    """
+
+    def decorator(fn):
+        return _CachedMethod(
+            fn, key_fn, ttl, cache=cache, tags=tags, version=version,
+            early_refresh=early_refresh, lock_timeout=lock_timeout,
+            lock_poll=lock_poll, clock=clock)
+
+    return decorator
+
+
+class _CachedMethod(object):
+
+    def __init__(self, fn, key_fn, ttl, cache, tags, version,
+                 early_refresh, lock_timeout, lock_poll, clock):
+        self.fn = fn
+        self.key_fn = key_fn
+        self.ttl = ttl
+        self.cache = cache
+        self.tags = tags
+        self.early_refresh = early_refresh
+        self.lock_timeout = lock_timeout
+        self.lock_poll = lock_poll
+        self.clock = clock or reactor
+        self.version = version or 0
+        self.prefix = None  # set on first access via class
+        self.counters = collections.Counter()
+        self._inflight = {}  # key => [deferred]
+        functools.update_wrapper(self, fn)
+
+    def __get__(self, instance, owner):
+        if self.prefix is None:
+            # class which defines method, not subclass
+            cls = next(
+                (c for c in owner.__mro__ if vars(c).get(self.fn.__name__) is self),
+                owner)
+            self.prefix = "%s.%s.%s:%s:" % (
+                self.fn.__module__, cls.__name__, self.fn.__name__, self.version)
+        if instance is None:
+            return self
+        m = functools.partial(self, instance)
+        m.invalidate = functools.partial(self.invalidate, instance)
+        return m
+
+    def key(self, *args, **kwargs):
+        return _safeKey("%s%s" % (self.prefix, self.key_fn(*args, **kwargs)))
+
+    def invalidate(self, instance, *args, **kwargs):
+        if instance.memcache is None:
+            return defer.succeed(None)
+        client = _cacheClient(instance.memcache, self.cache)
+        return defer.maybeDeferred(client.delete, self.key(*args, **kwargs))
+
+    def __call__(self, instance, *args, **kwargs):
+        if instance.memcache is None:
+            return defer.maybeDeferred(self.fn, instance, *args, **kwargs)
+        client = _cacheClient(instance.memcache, self.cache)
+        tags = self.tags(*args, **kwargs) if callable(self.tags) else (self.tags or ())
+        return self._get(client, self.key(*args, **kwargs), list(tags), instance, args, kwargs)
+
+    def _isFresh(self, expire_at, delta):
+        now = self.clock.seconds()
+        if not self.early_refresh:
+            return now < expire_at
+        # "optimal probabilistic cache stampede prevention" (XFetch)
+        return now - delta * self.early_refresh * math.log(1 - random.random()) < expire_at
+
+    @defer.inlineCallbacks
+    def _get(self, client, key, tags, instance, args, kwargs):
+
+        tag_keys = [_tagKey(t) for t in tags]
+        try:
+            found = yield client.getMultiple([key] + tag_keys)
+        except Exception:
+            logger.exception("can't read %r from memcache", key)
+            self.counters['errors'] += 1
+            value = yield self.fn(instance, *args, **kwargs)
+            defer.returnValue(value)
+
+        versions = [found.get(k, (0, None))[1] for k in tag_keys]
+        data = found.get(key, (0, None))[1]
+
+        if data is not None:
+            try:
+                value, expire_at, delta, value_versions = _unpackCached(data)
+            except Exception:
+                logger.exception("broken cached value for %r", key)
+                value_versions = None
+            if value_versions != versions:
+                self.counters['invalidated'] += 1
+            elif self._isFresh(expire_at, delta):
+                self.counters['hits'] += 1
+                defer.returnValue(value)
+            elif key in self._inflight:
+                # somebody is refreshing it already
+                self.counters['hits'] += 1
+                defer.returnValue(value)
+            else:
+                self.counters['early_refresh'] += 1
+        else:
+            self.counters['misses'] += 1
+
+        value = yield self._recompute(client, key, tag_keys, versions, instance, args, kwargs)
+        defer.returnValue(value)
+
+    def _recompute(self, client, key, tag_keys, versions, instance, args, kwargs):
+
+        d = defer.Deferred()
+        waiters = self._inflight.get(key)
+        if waiters is not None:
+            self.counters['waited'] += 1
+            waiters.append(d)
+            return d
+
+        waiters = self._inflight[key] = [d]
+
+        def done(result):
+            del self._inflight[key]
+            for w in waiters:
+                w.callback(result)
+
+        def fail(f):
+            del self._inflight[key]
+            for w in waiters:
+                w.errback(f)
+
+        self._lockedCompute(
+            client, key, tag_keys, versions, instance, args, kwargs,
+        ).addCallbacks(done, fail)
+        return d
+
+    @defer.inlineCallbacks
+    def _lockedCompute(self, client, key, tag_keys, versions, instance, args, kwargs):
+
+        if not self.lock_timeout:
+            value = yield self._compute(client, key, versions, instance, args, kwargs)
+            defer.returnValue(value)
+
+        lock_key = _safeKey(b"lock:" + key)
+        try:
+            locked = yield client.add(lock_key, b"1", expireTime=int(math.ceil(self.lock_timeout)))
+        except Exception:
+            logger.exception("can't lock %r", key)
+            locked = True
+
+        if not locked:
+            # other process computes it - wait
+            self.counters['lock_waits'] += 1
+            wait_until = self.clock.seconds() + self.lock_timeout
+            while self.clock.seconds() < wait_until:
+                yield task.deferLater(self.clock, self.lock_poll, lambda: None)
+                try:
+                    found = yield client.getMultiple([key] + tag_keys)
+                except Exception:
+                    break
+                versions = [found.get(k, (0, None))[1] for k in tag_keys]
+                data = found.get(key, (0, None))[1]
+                if data is None:
+                    continue
+                try:
+                    value, expire_at, delta, value_versions = _unpackCached(data)
+                except Exception:
+                    continue
+                if value_versions == versions and self._isFresh(expire_at, delta):
+                    defer.returnValue(value)
+            self.counters['lock_timeouts'] += 1
+
+        try:
+            value = yield self._compute(client, key, versions, instance, args, kwargs)
+        finally:
+            if locked:
+                defer.maybeDeferred(client.delete, lock_key).addErrback(
+                    lambda f: logger.error("can't unlock %r: %s", key, f.value))
+        defer.returnValue(value)
+
+    @defer.inlineCallbacks
+    def _compute(self, client, key, versions, instance, args, kwargs):
+
+        t0 = self.clock.seconds()
+        value = yield self.fn(instance, *args, **kwargs)
+        now = self.clock.seconds()
+        self.counters['computed'] += 1
+
+        data = _packCached([value, now + self.ttl, now - t0, versions])
+        try:
+            yield client.set(key, data, expireTime=int(math.ceil(self.ttl)))
+        except Exception:
+            logger.exception("can't store %r to memcache", key)
+        defer.returnValue(value)
+
@@ -0,0 +1,79 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+Cheap in-process metrics: counters & fixed-memory histograms.
+"""
+
+import math
+
+
+__all__ = [
+    'Histogram',
+]
+
+
+class Histogram(object):
+
+    """Histogram with log-scaled buckets (~12% relative error by default).
+
+    Memory usage doesn't depend on number of observations, so it may be
+    used for latencies of each message.
+    """
+
+    def __init__(self, min_value=1e-5, max_value=1e3, buckets_per_decade=20):
+        assert 0 < min_value < max_value
+        self.min_value = min_value
+        self.max_value = max_value
+        self._scale = buckets_per_decade / math.log(10)
+        self._buckets = [0] * (self._bucketIndex(max_value) + 1)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self._buckets)):
+            self._buckets[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def _bucketIndex(self, value):
+        if value <= self.min_value:
+            return 0
+        return int(math.log(value / self.min_value) * self._scale) + 1
+
+    def _bucketValue(self, index):
+        if index == 0:
+            return self.min_value
+        return self.min_value * math.exp(index / self._scale)
+
+    def add(self, value):
+        i = min(self._bucketIndex(value), len(self._buckets) - 1)
+        self._buckets[i] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Returns upper bound of bucket containing `q`-quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        last = len(self._buckets) - 1
+        acc = 0
+        for i, c in enumerate(self._buckets):
+            acc += c
+            if acc >= rank and c:
+                return self.max if i == last else min(self._bucketValue(i), self.max)
+        return self.max
+
+    def snapshot(self, quantiles=(0.5, 0.9, 0.99)):
+        s = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+        }
+        for q in quantiles:
+            s['p%g' % (q * 100)] = self.quantile(q)
+        return s
@@ -0,0 +1,264 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+Durable FIFO of byte records (append-only memory-mapped segment files).
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import collections
+
+from twoost._misc import mkdir_p
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'SegmentSpool',
+    'SpoolFull',
+]
+
+
+class SpoolFull(Exception):
+    pass
+
+
+_MAGIC = b'TWSP'
+_SEGMENT_HEADER = struct.Struct('>4sxxxxQ')  # magic, consumed offset
+_RECORD_HEADER = struct.Struct('>II')  # length, crc32
+_HEADER_SIZE = _SEGMENT_HEADER.size
+
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class _Segment(object):
+
+    def __init__(self, path, number, size=None):
+
+        self.path = path
+        self.number = number
+
+        exists = os.path.exists(path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if not exists:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.mmap = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+        if exists:
+            magic, self.consumed = _SEGMENT_HEADER.unpack_from(self.mmap, 0)
+            if magic != _MAGIC:
+                raise ValueError("%s is not a spool segment" % path)
+        else:
+            self.consumed = _HEADER_SIZE
+            _SEGMENT_HEADER.pack_into(self.mmap, 0, _MAGIC, self.consumed)
+
+        self.records = collections.deque()  # offsets of not consumed records
+        self.end = self._scan(self.consumed)
+
+    def _scan(self, offset):
+        # find records written before restart, stop at first broken one
+        while offset + _RECORD_HEADER.size <= self.size:
+            length, crc = _RECORD_HEADER.unpack_from(self.mmap, offset)
+            start = offset + _RECORD_HEADER.size
+            if not length or start + length > self.size:
+                break
+            if _crc(self.mmap[start:start + length]) != crc:
+                logger.warning("broken record in %s at %d, skip rest of segment", self.path, offset)
+                break
+            self.records.append(offset)
+            offset = start + length
+        return offset
+
+    def room(self):
+        return self.size - self.end - _RECORD_HEADER.size
+
+    def append(self, data):
+        offset = self.end
+        start = offset + _RECORD_HEADER.size
+        self.mmap[start:start + len(data)] = data
+        # length is written last - record becomes visible atomically
+        _RECORD_HEADER.pack_into(self.mmap, offset, len(data), _crc(data))
+        self.records.append(offset)
+        self.end = start + len(data)
+        return offset
+
+    def read(self, offset):
+        length, _ = _RECORD_HEADER.unpack_from(self.mmap, offset)
+        start = offset + _RECORD_HEADER.size
+        return self.mmap[start:start + length], start + length
+
+    def recordEnd(self, offset):
+        length, _ = _RECORD_HEADER.unpack_from(self.mmap, offset)
+        return offset + _RECORD_HEADER.size + length
+
+    def setConsumed(self, offset):
+        self.consumed = offset
+        _SEGMENT_HEADER.pack_into(self.mmap, 0, _MAGIC, offset)
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.mmap.close()
+
+
+class SegmentSpool(object):
+
+    """Durable FIFO queue of byte records.
+
+    Records are appended to preallocated memory-mapped segment files in
+    `path`, so `append` costs a memory copy.  Records are handed out by
+    `read` and removed from head by `ack` (out of order acks are allowed).
+    Records which were read, but not acked are returned by `read` again
+    after `rewind` or process restart.
+
+    Data is written to disk by OS (survives process crash), use `flush`
+    to force it.
+    """
+
+    segment_template = "%016d.seg"
+
+    def __init__(self, path, segment_size=16 << 20, max_size=1 << 30):
+
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+
+        self._segments = collections.deque()
+        self._read_pos = None  # (segment number, offset of next record)
+        self._acked = set()
+        self._count = 0
+        self._bytes = 0
+        # numbers are never reused - `_read_pos` may refer to dropped segment
+        self._next_number = 0
+
+        self._open()
+
+    def _open(self):
+        mkdir_p(self.path)
+        names = sorted(n for n in os.listdir(self.path) if n.endswith('.seg'))
+        for name in names:
+            s = _Segment(os.path.join(self.path, name), int(name.split('.')[0]))
+            self._segments.append(s)
+            self._next_number = s.number + 1
+            self._count += len(s.records)
+            self._bytes += s.end - s.consumed
+        while len(self._segments) > 1 and not self._segments[0].records:
+            self._dropHeadSegment()
+        logger.debug("open spool %s, %d records", self.path, self._count)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def _addSegment(self, size):
+        n = self._next_number
+        self._next_number += 1
+        s = _Segment(os.path.join(self.path, self.segment_template % n), n, size)
+        self._segments.append(s)
+        return s
+
+    def _dropHeadSegment(self):
+        s = self._segments.popleft()
+        s.close()
+        os.unlink(s.path)
+
+    def append(self, data):
+
+        need = len(data) + _RECORD_HEADER.size
+        if self._bytes + need > self.max_size:
+            raise SpoolFull("spool %s is full (%d bytes)" % (self.path, self._bytes))
+
+        s = self._segments[-1] if self._segments else None
+        if s is None or s.room() < len(data):
+            if s is not None and not s.records:
+                # whole spool is consumed
+                self._dropHeadSegment()
+            s = self._addSegment(max(self.segment_size, need + _HEADER_SIZE))
+
+        s.append(data)
+        self._count += 1
+        self._bytes += need
+
+    def _segment(self, number):
+        for s in self._segments:
+            if s.number == number:
+                return s
+
+    def read(self):
+        """Returns `(position, data)` of next unread record or None."""
+
+        if not self._segments:
+            return None
+
+        s = self._read_pos and self._segment(self._read_pos[0])
+        if s:
+            offset = self._read_pos[1]
+        else:
+            s = self._segments[0]
+            offset = s.consumed
+
+        while 1:
+            if offset < s.end:
+                data, end = s.read(offset)
+                pos = s.number, offset
+                self._read_pos = s.number, end
+                if pos not in self._acked:
+                    return pos, data
+                offset = end
+            else:
+                s = self._segment(s.number + 1)
+                if s is None:
+                    return None
+                offset = s.consumed
+
+    def rewind(self):
+        """Read not acked records again."""
+        self._read_pos = None
+
+    def ack(self, pos):
+        self._acked.add(pos)
+        while self._segments:
+            s = self._segments[0]
+            while s.records and (s.number, s.records[0]) in self._acked:
+                offset = s.records.popleft()
+                self._acked.discard((s.number, offset))
+                end = s.recordEnd(offset)
+                s.setConsumed(end)
+                self._count -= 1
+                self._bytes -= end - offset
+            if s.records or len(self._segments) == 1:
+                break
+            self._dropHeadSegment()
+
+    def flush(self):
+        for s in self._segments:
+            s.flush()
+
+    def close(self):
+        for s in self._segments:
+            s.flush()
+            s.close()
+        self._segments.clear()
+
+    def stats(self):
+        return {
+            'records': self._count,
+            'bytes': self._bytes,
+            'max_size': self.max_size,
+            'segments': len(self._segments),
+        }
@@ -0,0 +1,795 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+"""
+Minimal in-process AMQP 0-9-1 broker for tests & benchmarks.
+
+Speaks real wire protocol (frames are encoded/decoded by pika), so
+`twoost.amqp` works with it as with RabbitMQ.  Supports direct, fanout, topic
+and headers exchanges, exchange-to-exchange bindings, publisher confirms,
+qos, ack/nack/reject, message & queue TTL and dead-lettering.
+
+There are no virtual hosts (all connections share one namespace),
+authentication, transactions or persistence.
+
+    broker = AMQPBroker()
+    port = reactor.listenTCP(0, broker, interface='127.0.0.1')
+"""
+
+import copy
+import uuid
+import itertools
+import collections
+
+from twisted.internet import protocol, reactor
+
+from pika import spec, frame as _frame
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'AMQPBroker',
+]
+
+
+FRAME_MAX = 131072
+
+ACCESS_REFUSED = 403
+NOT_FOUND = 404
+RESOURCE_LOCKED = 405
+PRECONDITION_FAILED = 406
+UNEXPECTED_FRAME = 505
+NOT_ALLOWED = 530
+NOT_IMPLEMENTED = 540
+
+NO_ROUTE = 312
+
+SERVER_PROPERTIES = {
+    'product': 'twoost-amqpbroker',
+    'capabilities': {
+        'publisher_confirms': True,
+        'basic.nack': True,
+        'consumer_cancel_notify': True,
+        'exchange_exchange_bindings': True,
+        'per_consumer_qos': True,
+    },
+}
+
+
+class _ChannelError(Exception):
+
+    def __init__(self, code, text):
+        Exception.__init__(self, code, text)
+        self.code = code
+        self.text = text
+
+
+def _newName(prefix):
+    return prefix + uuid.uuid4().hex[:22]
+
+
+def _topicMatch(pattern, words):
+    if not pattern:
+        return not words
+    p = pattern[0]
+    if p == '#':
+        return any(_topicMatch(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return (p == '*' or p == words[0]) and _topicMatch(pattern[1:], words[1:])
+
+
+def _headersMatch(arguments, headers):
+    arguments = dict(arguments or ())
+    match_any = arguments.pop('x-match', 'all') == 'any'
+    headers = headers or {}
+    matched = (headers.get(k) == v for k, v in arguments.items() if not k.startswith('x-'))
+    return any(matched) if match_any else all(matched)
+
+
+class _Message(object):
+
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body', 'redelivered', 'expire_at')
+
+    def __init__(self, exchange, routing_key, properties, body):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = False
+        self.expire_at = None
+
+
+class _Exchange(object):
+
+    def __init__(
+            self, name, type='direct', durable=False,
+            auto_delete=False, internal=False, arguments=None):
+        self.name = name
+        self.type = type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.internal = internal
+        self.arguments = arguments or {}
+        self.bindings = []  # [(destination, routing_key, arguments)]
+
+    def bind(self, destination, routing_key, arguments):
+        b = destination, routing_key, arguments or {}
+        if b not in self.bindings:
+            self.bindings.append(b)
+
+    def unbind(self, destination, routing_key, arguments):
+        b = destination, routing_key, arguments or {}
+        if b in self.bindings:
+            self.bindings.remove(b)
+
+    def unbindAll(self, destination):
+        self.bindings = [b for b in self.bindings if b[0] is not destination]
+
+    def match(self, routing_key, headers):
+        if self.type == 'fanout':
+            return [b[0] for b in self.bindings]
+        elif self.type == 'topic':
+            words = routing_key.split('.')
+            return [b[0] for b in self.bindings if _topicMatch(b[1].split('.'), words)]
+        elif self.type == 'headers':
+            return [b[0] for b in self.bindings if _headersMatch(b[2], headers)]
+        else:
+            return [b[0] for b in self.bindings if b[1] == routing_key]
+
+
+class _Queue(object):
+
+    def __init__(
+            self, broker, name, durable=False, exclusive=False,
+            auto_delete=False, arguments=None, owner=None):
+
+        self.broker = broker
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.owner = owner
+        self.deleted = False
+
+        self.message_ttl = self.arguments.get('x-message-ttl')
+        self.dead_letter_exchange = self.arguments.get('x-dead-letter-exchange')
+        self.dead_letter_routing_key = self.arguments.get('x-dead-letter-routing-key')
+
+        self.messages = collections.deque()
+        self.consumers = collections.deque()
+        self._had_consumers = False
+        self._expire_timer = None
+
+    def enqueue(self, msg):
+        ttl = self.message_ttl
+        if msg.properties.expiration is not None:
+            msg_ttl = int(msg.properties.expiration)
+            ttl = msg_ttl if ttl is None else min(ttl, msg_ttl)
+        if ttl is not None:
+            msg.expire_at = self.broker.clock.seconds() + ttl / 1000
+        self.messages.append(msg)
+        self.dispatch()
+
+    def requeue(self, msgs):
+        if self.deleted:
+            return
+        for msg in reversed(msgs):
+            msg.redelivered = True
+            self.messages.appendleft(msg)
+        self.dispatch()
+
+    def addConsumer(self, consumer):
+        self._had_consumers = True
+        self.consumers.append(consumer)
+        self.dispatch()
+
+    def removeConsumer(self, consumer):
+        if consumer in self.consumers:
+            self.consumers.remove(consumer)
+        if self.auto_delete and self._had_consumers and not self.consumers:
+            self.broker.deleteQueue(self)
+
+    def _expireMessages(self):
+        now = self.broker.clock.seconds()
+        while self.messages:
+            expire_at = self.messages[0].expire_at
+            if expire_at is None or expire_at > now:
+                break
+            self.broker.deadLetter(self, self.messages.popleft(), 'expired')
+
+    def _scheduleExpiration(self):
+
+        expire_at = self.messages[0].expire_at if self.messages else None
+        t = self._expire_timer
+
+        if t is not None and t.active():
+            if expire_at is not None and t.getTime() <= expire_at:
+                return
+            t.cancel()
+        self._expire_timer = None
+
+        if expire_at is not None:
+            delay = max(0, expire_at - self.broker.clock.seconds())
+            self._expire_timer = self.broker.clock.callLater(delay, self.dispatch)
+
+    def dispatch(self):
+
+        if self.deleted:
+            return
+
+        self._expireMessages()
+        consumers = self.consumers
+        while self.messages and consumers:
+            for _ in range(len(consumers)):
+                c = consumers[0]
+                consumers.rotate(-1)
+                if c.hasCapacity():
+                    break
+            else:
+                break  # all consumers are busy
+            c.deliver(self, self.messages.popleft())
+
+        self._scheduleExpiration()
+
+    def purge(self):
+        n = len(self.messages)
+        self.messages.clear()
+        self._scheduleExpiration()
+        return n
+
+
+class _Consumer(object):
+
+    def __init__(self, channel, tag, queue, no_ack):
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.no_ack = no_ack
+        self.unacked = 0
+
+    def hasCapacity(self):
+        ch = self.channel
+        if not ch.flow_active:
+            return False
+        if self.no_ack:
+            return True
+        if ch.prefetch_count and self.unacked >= ch.prefetch_count:
+            return False
+        if ch.global_prefetch_count and len(ch.unacked) >= ch.global_prefetch_count:
+            return False
+        return True
+
+    def deliver(self, queue, msg):
+        self.channel.deliver(self, queue, msg)
+
+
+class _BrokerChannel(object):
+
+    def __init__(self, connection, number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.number = number
+        self.closing = False
+
+        self.consumers = {}
+        self.unacked = collections.OrderedDict()  # tag => (consumer, queue, msg)
+        self.prefetch_count = 0
+        self.global_prefetch_count = 0
+        self.flow_active = True
+
+        self.confirm = False
+        self.publish_seq = 0
+
+        self._delivery_tags = itertools.count(1)
+        self._content = None
+
+    def send(self, method):
+        self.connection.sendMethod(self.number, method)
+
+    def deliver(self, consumer, queue, msg):
+        tag = next(self._delivery_tags)
+        if not consumer.no_ack:
+            consumer.unacked += 1
+            self.unacked[tag] = consumer, queue, msg
+        self.connection.sendContent(
+            self.number,
+            spec.Basic.Deliver(consumer.tag, tag, msg.redelivered, msg.exchange, msg.routing_key),
+            msg.properties, msg.body)
+
+    def _queue(self, name):
+        q = self.broker.queues.get(name)
+        if q is None:
+            raise _ChannelError(NOT_FOUND, "NOT_FOUND - no queue '%s'" % name)
+        if q.exclusive and q.owner is not self.connection:
+            raise _ChannelError(
+                RESOURCE_LOCKED, "RESOURCE_LOCKED - queue '%s' is exclusive" % name)
+        return q
+
+    def _exchange(self, name):
+        e = self.broker.exchanges.get(name)
+        if e is None:
+            raise _ChannelError(NOT_FOUND, "NOT_FOUND - no exchange '%s'" % name)
+        return e
+
+    def _dispatchConsumers(self):
+        for q in set(c.queue for c in self.consumers.values()):
+            q.dispatch()
+
+    def release(self):
+        # channel is closed - forget consumers, requeue unacked messages
+        for c in list(self.consumers.values()):
+            c.queue.removeConsumer(c)
+        self.consumers.clear()
+        self._requeue(list(self.unacked.values()))
+        self.unacked.clear()
+
+    def _requeue(self, items):
+        by_queue = collections.OrderedDict()
+        for _, queue, msg in items:
+            by_queue.setdefault(queue, []).append(msg)
+        for queue, msgs in by_queue.items():
+            queue.requeue(msgs)
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            tags = [t for t in self.unacked if not delivery_tag or t <= delivery_tag]
+        elif delivery_tag in self.unacked:
+            tags = [delivery_tag]
+        else:
+            raise _ChannelError(
+                PRECONDITION_FAILED,
+                "PRECONDITION_FAILED - unknown delivery tag %d" % delivery_tag)
+        items = [self.unacked.pop(t) for t in tags]
+        for consumer, _, _ in items:
+            if consumer:
+                consumer.unacked -= 1
+        return items
+
+    def _reject(self, items, requeue):
+        if requeue:
+            self._requeue(items)
+        else:
+            for _, queue, msg in items:
+                self.broker.deadLetter(queue, msg, 'rejected')
+        self._dispatchConsumers()
+
+    # -- content
+
+    def contentReceived(self, f):
+
+        if self._content is None:
+            raise _ChannelError(UNEXPECTED_FRAME, "UNEXPECTED_FRAME - content without method")
+
+        method, properties, parts, size, body_size = self._content
+        if isinstance(f, _frame.Header):
+            properties, body_size = f.properties, f.body_size
+        elif properties is None:
+            raise _ChannelError(UNEXPECTED_FRAME, "UNEXPECTED_FRAME - body without header")
+        else:
+            parts.append(f.fragment)
+            size += len(f.fragment)
+
+        if size >= body_size:
+            self._content = None
+            self._publish(method, properties, b"".join(parts))
+        else:
+            self._content = method, properties, parts, size, body_size
+
+    def _publish(self, method, properties, body):
+
+        if self.confirm:
+            self.publish_seq += 1
+
+        e = self._exchange(method.exchange)
+        if e.internal:
+            raise _ChannelError(
+                ACCESS_REFUSED, "ACCESS_REFUSED - cannot publish to internal exchange '%s'" % e.name)
+
+        routed = self.broker.publish(e, method.routing_key, properties, body)
+        if not routed and method.mandatory:
+            self.connection.sendContent(
+                self.number,
+                spec.Basic.Return(NO_ROUTE, 'NO_ROUTE', method.exchange, method.routing_key),
+                properties, body)
+        if self.confirm:
+            self.send(spec.Basic.Ack(self.publish_seq))
+
+    # -- methods
+
+    def amqp_Channel_Close(self, m):
+        self.release()
+        self.connection.channels.pop(self.number, None)
+        self.send(spec.Channel.CloseOk())
+
+    def amqp_Channel_Flow(self, m):
+        self.flow_active = m.active
+        self.send(spec.Channel.FlowOk(m.active))
+        self._dispatchConsumers()
+
+    def amqp_Exchange_Declare(self, m):
+        e = self.broker.exchanges.get(m.exchange)
+        if m.passive:
+            self._exchange(m.exchange)
+        elif e is None:
+            if m.exchange.startswith('amq.'):
+                raise _ChannelError(
+                    ACCESS_REFUSED, "ACCESS_REFUSED - exchange name '%s' is reserved" % m.exchange)
+            self.broker.declareExchange(
+                m.exchange, m.type, durable=m.durable, auto_delete=m.auto_delete,
+                internal=m.internal, arguments=m.arguments)
+        elif e.type != m.type:
+            raise _ChannelError(
+                PRECONDITION_FAILED,
+                "PRECONDITION_FAILED - inequivalent arg 'type' for exchange '%s': "
+                "received '%s' but current is '%s'" % (m.exchange, m.type, e.type))
+        if not m.nowait:
+            self.send(spec.Exchange.DeclareOk())
+
+    def amqp_Exchange_Delete(self, m):
+        e = self._exchange(m.exchange)
+        if m.if_unused and e.bindings:
+            raise _ChannelError(
+                PRECONDITION_FAILED, "PRECONDITION_FAILED - exchange '%s' in use" % m.exchange)
+        self.broker.deleteExchange(e)
+        if not m.nowait:
+            self.send(spec.Exchange.DeleteOk())
+
+    def amqp_Exchange_Bind(self, m):
+        self._exchange(m.source).bind(
+            self._exchange(m.destination), m.routing_key, m.arguments)
+        if not m.nowait:
+            self.send(spec.Exchange.BindOk())
+
+    def amqp_Exchange_Unbind(self, m):
+        self._exchange(m.source).unbind(
+            self._exchange(m.destination), m.routing_key, m.arguments)
+        if not m.nowait:
+            self.send(spec.Exchange.UnbindOk())
+
+    def amqp_Queue_Declare(self, m):
+        name = m.queue or _newName('amq.gen-')
+        q = self.broker.queues.get(name)
+        if m.passive or q is not None:
+            q = self._queue(name)
+            if not m.passive and dict(q.arguments) != dict(m.arguments or ()):
+                raise _ChannelError(
+                    PRECONDITION_FAILED,
+                    "PRECONDITION_FAILED - inequivalent arguments for queue '%s'" % name)
+        else:
+            q = self.broker.declareQueue(
+                name, durable=m.durable, exclusive=m.exclusive,
+                auto_delete=m.auto_delete, arguments=m.arguments,
+                owner=self.connection if m.exclusive else None)
+        if not m.nowait:
+            self.send(spec.Queue.DeclareOk(name, len(q.messages), len(q.consumers)))
+
+    def amqp_Queue_Bind(self, m):
+        if not m.exchange:
+            raise _ChannelError(
+                ACCESS_REFUSED, "ACCESS_REFUSED - operation not permitted on the default exchange")
+        self._exchange(m.exchange).bind(self._queue(m.queue), m.routing_key, m.arguments)
+        if not m.nowait:
+            self.send(spec.Queue.BindOk())
+
+    def amqp_Queue_Unbind(self, m):
+        self._exchange(m.exchange).unbind(self._queue(m.queue), m.routing_key, m.arguments)
+        self.send(spec.Queue.UnbindOk())
+
+    def amqp_Queue_Purge(self, m):
+        n = self._queue(m.queue).purge()
+        if not m.nowait:
+            self.send(spec.Queue.PurgeOk(n))
+
+    def amqp_Queue_Delete(self, m):
+        q = self._queue(m.queue)
+        if m.if_unused and q.consumers:
+            raise _ChannelError(
+                PRECONDITION_FAILED, "PRECONDITION_FAILED - queue '%s' in use" % m.queue)
+        if m.if_empty and q.messages:
+            raise _ChannelError(
+                PRECONDITION_FAILED, "PRECONDITION_FAILED - queue '%s' not empty" % m.queue)
+        n = len(q.messages)
+        self.broker.deleteQueue(q)
+        if not m.nowait:
+            self.send(spec.Queue.DeleteOk(n))
+
+    def amqp_Basic_Qos(self, m):
+        if m.global_:
+            self.global_prefetch_count = m.prefetch_count
+        else:
+            self.prefetch_count = m.prefetch_count
+        self.send(spec.Basic.QosOk())
+        self._dispatchConsumers()
+
+    def amqp_Basic_Consume(self, m):
+        q = self._queue(m.queue)
+        tag = m.consumer_tag or _newName('amq.ctag-')
+        if tag in self.consumers:
+            raise _ChannelError(
+                NOT_ALLOWED, "NOT_ALLOWED - attempt to reuse consumer tag '%s'" % tag)
+        c = self.consumers[tag] = _Consumer(self, tag, q, m.no_ack)
+        if not m.nowait:
+            self.send(spec.Basic.ConsumeOk(tag))
+        q.addConsumer(c)
+
+    def amqp_Basic_Cancel(self, m):
+        c = self.consumers.pop(m.consumer_tag, None)
+        if c:
+            c.queue.removeConsumer(c)
+        if not m.nowait:
+            self.send(spec.Basic.CancelOk(m.consumer_tag))
+
+    def amqp_Basic_Publish(self, m):
+        self._content = m, None, [], 0, 0
+
+    def amqp_Basic_Get(self, m):
+        q = self._queue(m.queue)
+        q._expireMessages()
+        if not q.messages:
+            self.send(spec.Basic.GetEmpty())
+            return
+        msg = q.messages.popleft()
+        tag = next(self._delivery_tags)
+        if not m.no_ack:
+            self.unacked[tag] = None, q, msg
+        self.connection.sendContent(
+            self.number,
+            spec.Basic.GetOk(tag, msg.redelivered, msg.exchange, msg.routing_key, len(q.messages)),
+            msg.properties, msg.body)
+
+    def amqp_Basic_Ack(self, m):
+        self._settle(m.delivery_tag, m.multiple)
+        self._dispatchConsumers()
+
+    def amqp_Basic_Nack(self, m):
+        self._reject(self._settle(m.delivery_tag, m.multiple), m.requeue)
+
+    def amqp_Basic_Reject(self, m):
+        self._reject(self._settle(m.delivery_tag, False), m.requeue)
+
+    def amqp_Basic_Recover(self, m):
+        self._reject(self._settle(0, True), True)
+        self.send(spec.Basic.RecoverOk())
+
+    def amqp_Confirm_Select(self, m):
+        self.confirm = True
+        if not m.nowait:
+            self.send(spec.Confirm.SelectOk())
+
+
+class _BrokerProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        self.broker = self.factory
+        self.broker.connections.add(self)
+        self.channels = {}
+        self.frame_max = FRAME_MAX
+        self._buffer = b""
+
+    def connectionLost(self, reason):
+        self.broker.connections.discard(self)
+        for ch in list(self.channels.values()):
+            ch.release()
+        self.channels.clear()
+        for q in list(self.broker.queues.values()):
+            if q.owner is self:
+                self.broker.deleteQueue(q)
+
+    def dataReceived(self, data):
+        self._buffer += data
+        while self._buffer and self.transport.connected:
+            consumed, f = _frame.decode_frame(self._buffer)
+            if f is None:
+                break
+            self._buffer = self._buffer[consumed:]
+            self.frameReceived(f)
+
+    def sendMethod(self, channel_number, method):
+        self.transport.write(_frame.Method(channel_number, method).marshal())
+
+    def sendContent(self, channel_number, method, properties, body):
+        chunk = self.frame_max - spec.FRAME_HEADER_SIZE - spec.FRAME_END_SIZE
+        frames = [
+            _frame.Method(channel_number, method).marshal(),
+            _frame.Header(channel_number, len(body), properties).marshal(),
+        ]
+        for i in range(0, len(body), chunk):
+            frames.append(_frame.Body(channel_number, body[i:i + chunk]).marshal())
+        self.transport.write(b"".join(frames))
+
+    def frameReceived(self, f):
+        if isinstance(f, _frame.ProtocolHeader):
+            self.sendMethod(0, spec.Connection.Start(server_properties=SERVER_PROPERTIES))
+        elif isinstance(f, _frame.Heartbeat):
+            pass
+        elif f.channel_number == 0:
+            self.connectionMethodReceived(f.method)
+        else:
+            self.channelFrameReceived(f)
+
+    def connectionMethodReceived(self, m):
+        if isinstance(m, spec.Connection.StartOk):
+            self.sendMethod(0, spec.Connection.Tune(2047, FRAME_MAX, 0))
+        elif isinstance(m, spec.Connection.TuneOk):
+            self.frame_max = m.frame_max or FRAME_MAX
+        elif isinstance(m, spec.Connection.Open):
+            self.sendMethod(0, spec.Connection.OpenOk())
+        elif isinstance(m, spec.Connection.Close):
+            self.sendMethod(0, spec.Connection.CloseOk())
+            self.transport.loseConnection()
+        elif isinstance(m, spec.Connection.CloseOk):
+            self.transport.loseConnection()
+        else:
+            logger.warning("unexpected connection method %r", m)
+
+    def channelFrameReceived(self, f):
+
+        number = f.channel_number
+        ch = self.channels.get(number)
+        m = getattr(f, 'method', None)
+
+        if isinstance(m, spec.Channel.Open):
+            self.channels[number] = _BrokerChannel(self, number)
+            self.sendMethod(number, spec.Channel.OpenOk())
+            return
+        elif ch is None:
+            logger.warning("frame %r for unknown channel %d", f, number)
+            return
+        elif ch.closing:
+            # waiting for 'Channel.CloseOk', drop everything else
+            if isinstance(m, spec.Channel.CloseOk):
+                del self.channels[number]
+            return
+
+        try:
+            if m is None:
+                ch.contentReceived(f)
+            else:
+                handler = getattr(ch, 'amqp_' + m.NAME.replace('.', '_'), None)
+                if handler is None:
+                    raise _ChannelError(
+                        NOT_IMPLEMENTED, "NOT_IMPLEMENTED - method %s" % m.NAME)
+                handler(m)
+        except _ChannelError as e:
+            logger.debug("close channel %d: %s", number, e.text)
+            self.closeChannel(ch, e.code, e.text, m)
+
+    def closeChannel(self, ch, code, text, method=None):
+        ch.release()
+        ch.closing = True
+        index = method.INDEX if method is not None else 0
+        self.sendMethod(ch.number, spec.Channel.Close(code, text, index >> 16, index & 0xffff))
+
+
+class AMQPBroker(protocol.ServerFactory):
+
+    """Broker state: exchanges, queues & client connections."""
+
+    protocol = _BrokerProtocol
+
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.connections = set()
+        self.exchanges = {}
+        self.queues = {}
+        self._declareDefaultExchanges()
+
+    def _declareDefaultExchanges(self):
+        self.declareExchange('', 'direct', durable=True)
+        for t in ['direct', 'fanout', 'topic', 'headers']:
+            self.declareExchange('amq.' + t, t, durable=True)
+
+    def declareExchange(self, name, type='direct', **kwargs):
+        e = self.exchanges.get(name)
+        if e is None:
+            e = self.exchanges[name] = _Exchange(name, type, **kwargs)
+        return e
+
+    def declareQueue(self, name, **kwargs):
+        q = self.queues.get(name)
+        if q is None:
+            q = self.queues[name] = _Queue(self, name, **kwargs)
+        return q
+
+    def deleteExchange(self, e):
+        self.exchanges.pop(e.name, None)
+        for x in self.exchanges.values():
+            x.unbindAll(e)
+
+    def deleteQueue(self, q):
+        if q.deleted:
+            return
+        q.deleted = True
+        self.queues.pop(q.name, None)
+        for e in self.exchanges.values():
+            e.unbindAll(q)
+        for c in list(q.consumers):
+            c.channel.consumers.pop(c.tag, None)
+            c.channel.send(spec.Basic.Cancel(c.tag, nowait=True))
+        q.consumers.clear()
+        q.purge()
+
+    def route(self, exchange, routing_key, headers=None):
+        if not exchange.name:
+            q = self.queues.get(routing_key)
+            return [q] if q else []
+        queues, seen, todo = [], set(), [exchange]
+        while todo:
+            e = todo.pop()
+            if e.name in seen:
+                continue
+            seen.add(e.name)
+            for dest in e.match(routing_key, headers):
+                if isinstance(dest, _Exchange):
+                    todo.append(dest)
+                elif dest not in queues:
+                    queues.append(dest)
+        return queues
+
+    def publish(self, exchange, routing_key, properties, body):
+        queues = self.route(exchange, routing_key, properties.headers)
+        for q in queues:
+            q.enqueue(_Message(exchange.name, routing_key, properties, body))
+        return len(queues)
+
+    def deadLetter(self, queue, msg, reason):
+
+        e = self.exchanges.get(queue.dead_letter_exchange)
+        if queue.dead_letter_exchange is None or e is None:
+            return
+
+        properties = copy.copy(msg.properties)
+        headers = properties.headers = dict(properties.headers or ())
+        deaths = [dict(d) for d in headers.get('x-death') or ()]
+        for d in deaths:
+            if d.get('queue') == queue.name and d.get('reason') == reason:
+                d['count'] = d.get('count', 1) + 1
+                deaths.remove(d)
+                deaths.insert(0, d)
+                break
+        else:
+            deaths.insert(0, {
+                'queue': queue.name,
+                'reason': reason,
+                'count': 1,
+                'exchange': msg.exchange,
+                'routing-keys': [msg.routing_key],
+            })
+        headers['x-death'] = deaths
+        if reason == 'expired':
+            properties.expiration = None
+
+        rk = queue.dead_letter_routing_key
+        self.publish(e, msg.routing_key if rk is None else rk, properties, msg.body)
+
+    # -- helpers for tests
+
+    def messageCount(self, queue):
+        q = self.queues.get(queue)
+        return len(q.messages) if q else None
+
+    def consumerCount(self, queue):
+        q = self.queues.get(queue)
+        return len(q.consumers) if q else None
+
+    def dropConnections(self):
+        for c in list(self.connections):
+            c.transport.loseConnection()
+
+    def restart(self):
+        """Drop all connections & forget non-durable entities and messages."""
+        self.dropConnections()
+        for q in list(self.queues.values()):
+            if not q.durable:
+                self.deleteQueue(q)
+            else:
+                q.messages = collections.deque(
+                    m for m in q.messages if m.properties.delivery_mode == 2)
+        for e in list(self.exchanges.values()):
+            if not e.durable:
+                self.deleteExchange(e)
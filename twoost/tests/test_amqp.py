@@ -2,14 +2,29 @@
 
 from __future__ import print_function, division, absolute_import
 
+import os
+import time
+import uuid
+import zlib
+import threading
+import multiprocessing.pool
+
+import msgpack
 import zope.interface
 
-from twisted.internet import reactor, endpoints
+from twisted.internet import reactor, endpoints, task
 from twisted.internet import defer
-from twisted.trial.unittest import TestCase
+from twisted.internet.error import ConnectionDone
+from twisted.trial.unittest import TestCase, SkipTest
+
+from pika.adapters.twisted_connection import ClosableDeferredQueue
+from pika import frame
+from pika.exceptions import ChannelClosed
+from pika.spec import Basic, BasicProperties
 
 from twoost import amqp
 from twoost.timed import sleep
+from twoost.tests.amqpbroker import AMQPBroker
 
 import twisted.internet.base  # noqa
 
@@ -71,20 +86,33 @@ class SingleExchangeSchema(object):
 
 class BaseTest(TestCase):
 
+    """Runs against in-process broker, set TWOOST_TEST_AMQP=host:port to use real one."""
+
     schema = None
 
     def clientParams(self):
         return {
             'schema': self.schema,
-            'host': "localhost",
-            'port': 5672,
+            'host': self.host,
+            'port': self.port,
         }
 
+    def startBroker(self):
+        real = os.environ.get('TWOOST_TEST_AMQP')
+        if real:
+            self.broker = None
+            host, _, port = real.partition(':')
+            return host, int(port or 5672)
+        self.broker = AMQPBroker()
+        self.broker_port = reactor.listenTCP(0, self.broker, interface='127.0.0.1')
+        return '127.0.0.1', self.broker_port.getHost().port
+
     @defer.inlineCallbacks
     def setUp(self):
+        self.host, self.port = self.startBroker()
         params = self.clientParams()
 
-        self.endpoint = endpoints.TCP4ClientEndpoint(reactor, "localhost", 5672)
+        self.endpoint = endpoints.TCP4ClientEndpoint(reactor, self.host, self.port)
         self.factory = amqp.AMQPFactory(**params)
         self.client = amqp.AMQPService(self.endpoint, self.factory, **params)
         self.client.startService()
@@ -96,6 +124,10 @@ class BaseTest(TestCase):
     @defer.inlineCallbacks
     def tearDown(self):
         yield self.client.stopService()
+        if self.broker:
+            self.broker.dropConnections()
+            yield self.broker_port.stopListening()
+            yield sleep(0)
 
     @defer.inlineCallbacks
     def clearQueue(self, queue, sleep_time=0.3):
@@ -207,6 +239,34 @@ class ReconnectTest(BaseTest):
 
         yield sql.stopService()
 
+    @defer.inlineCallbacks
+    def test_time_to_consuming(self):
+
+        consumers = [
+            self.client.setupQueueConsuming(QX, self.rcv)
+            for _ in range(20)
+        ]
+        yield sleep(0.5)
+
+        def all_consuming():
+            p = self.client.protocol
+            return p and all(
+                c._protocol_instance is p and c.consumer_tag and not c._consume_deferred
+                for c in consumers)
+
+        self.assertTrue(all_consuming())
+
+        yield self.client.dropConnection()
+        t0 = reactor.seconds()
+        while not all_consuming():
+            yield sleep(0.005)
+        elapsed = reactor.seconds() - t0
+        logger.info("time to consuming after reconnect: %.3f sec", elapsed)
+
+        for c in consumers:
+            yield c.stopService()
+        self.assertTrue(elapsed < 0.5, "consumers restarted in %.3f sec" % elapsed)
+
     @defer.inlineCallbacks
     def test_reject_strategies(self):
 
@@ -257,7 +317,8 @@ class ReconnectTest(BaseTest):
         self.assertEqual((2, 0, 0), x, "requeue once")
 
         x = yield doche('requeue_forever')
-        self.assertEqual((9, 9, 9), x, "requeue forever")
+        # redelivered every 0.1 sec, 10th delivery (at ~0.9 sec) may miss the window
+        self.assertTrue(all(n in (9, 10) for n in x), "requeue forever %r" % (x,))
 
         x = yield doche('requeue_hold')
         self.assertEqual((2, 1, 1), x, "msg holded")
@@ -492,6 +553,25 @@ class QueueConsumerTest(BaseTest):
         yield sql.stopService()
         yield self.clearQueue(Q1)
 
+    @defer.inlineCallbacks
+    def test_publish_batch(self):
+
+        result = []
+        sql = self.client.setupQueueConsuming(Q1, result.append)
+
+        yield self.client.publishBatch([
+            {'exchange': '', 'routing_key': Q1, 'body': "b1"},
+            ('', Q1, "b2"),
+            {'exchange': '', 'routing_key': Q1, 'body': {'x': 3}, 'content_type': 'json'},
+        ])
+
+        send = self.client.makeBatchSender(exchange='', routing_key=Q1)
+        yield defer.gatherResults([send(i) for i in range(5)])
+
+        yield sleep(0.2)
+        yield sql.stopService()
+        self.assertEqual(["b1", "b2", {'x': 3}] + list(range(5)), result)
+
     @defer.inlineCallbacks
     def test_quick_consume_and_cancel(self):
         sql = self.client.setupQueueConsuming(Q1, lambda _: None)
@@ -537,3 +617,1509 @@ class ExchangeConsumerTest(BaseTest):
 
         for sel in sels:
             yield sel.stopService()
+
+
+class LocalBrokerTest(BaseTest):
+
+    schema = {'queue': {Q1: None}}
+
+    def clientParams(self):
+        params = BaseTest.clientParams(self)
+        params.update(retry_delays=(0.05,), schema_redeclare='passive')
+        return params
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        if os.environ.get('TWOOST_TEST_AMQP'):
+            raise SkipTest("needs in-process broker")
+        yield BaseTest.setUp(self)
+
+    @defer.inlineCallbacks
+    def test_retry_queue(self):
+
+        calls = []
+
+        def rcv(x):
+            calls.append(x)
+            if len(calls) < 3:
+                raise Exception("some error here")
+
+        sql = self.client.setupQueueConsuming(Q1, rcv, on_error='retry_queue')
+        yield sleep(0.05)
+        yield self.client.publishMessage(exchange='', routing_key=Q1, body='1', confirm=True)
+        yield sleep(0.5)
+        yield sql.stopService()
+
+        self.assertEqual(['1', '1', '1'], calls)
+        self.assertEqual(0, self.broker.messageCount(Q1))
+        self.assertEqual(0, self.broker.messageCount(Q1 + '.retry.0.05s'))
+
+    @defer.inlineCallbacks
+    def test_redeclare_schema_after_broker_restart(self):
+
+        self.client.reconnect_max_delay = 0.01
+        self.assertEqual(0, self.broker.messageCount(Q1))
+        self.broker.restart()
+        self.assertEqual(None, self.broker.messageCount(Q1))
+
+        yield sleep(0.5)
+        self.assertEqual(0, self.broker.messageCount(Q1))
+        self.assertEqual(
+            1, self.client.protocol.counters['schema_cache_invalidated'])
+
+    @defer.inlineCallbacks
+    def test_stream_consuming(self):
+
+        items = [uuid.uuid4().hex * 2 for _ in range(10000)]
+        result_d = defer.Deferred()
+        sql = self.client.setupQueueConsuming(
+            Q1, result_d.callback, deserialize=False, stream=True)
+        yield self.client.publishMessage(
+            exchange='', routing_key=Q1, body=items,
+            content_type='msgpack', compression='zlib', confirm=True)
+        msg = yield result_d
+        yield sql.stopService()
+
+        self.assertIsInstance(msg, amqp.AMQPStreamMessage)
+        self.assertTrue(len(msg.fragments) > 1)
+        self.assertEqual(items, msg.data)
+        self.assertEqual(msg.size, self.client.protocol.counters['bytes_in'])
+
+
+class SpoolTest(TestCase):
+
+    queue = 'test_amqp_spool_queue'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.broker = AMQPBroker()
+        self.broker_port = reactor.listenTCP(0, self.broker, interface='127.0.0.1')
+        self.port = self.broker_port.getHost().port
+        yield self.broker_port.stopListening()
+
+        params = {
+            'schema': {'queue': {self.queue: None}},
+            'spool_dir': self.mktemp(),
+            'reconnect_max_delay': 0.05,
+            'reconnect_initial_delay': 0.05,
+        }
+        endpoint = endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1', self.port)
+        self.client = amqp.AMQPService(endpoint, amqp.AMQPFactory(**params), **params)
+        self.client.startService()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.stopService()
+        self.broker.dropConnections()
+        yield self.broker_port.stopListening()
+        yield sleep(0)
+
+    def test_record_roundtrip(self):
+        props = amqp._spoolProperties('json', 1000, {'headers': {'x': 1}})
+        record = amqp._packSpoolRecord(u'exch', 'rk', b'{"a": 1}', props, 'zlib')
+        exchange, rk, data, p, compression = amqp._unpackSpoolRecord(record)
+        self.assertEqual(('exch', 'rk', b'{"a": 1}', 'zlib'), (exchange, rk, data, compression))
+        self.assertEqual(('json', '1000', {'x': 1}), (p.content_type, p.expiration, p.headers))
+
+    @defer.inlineCallbacks
+    def test_spool_while_broker_is_down(self):
+
+        for i in range(50):
+            yield self.client.publishMessage(
+                exchange='', routing_key=self.queue, body={'n': i}, content_type='json')
+        self.assertEqual(50, len(self.client.spool))
+        self.assertIn("spooled 50 msgs", str(self.assertRaises(Exception, self.client.checkHealth)))
+
+        self.broker_port = reactor.listenTCP(self.port, self.broker, interface='127.0.0.1')
+        for _ in range(100):
+            yield sleep(0.02)
+            if not len(self.client.spool):
+                break
+        self.assertEqual(0, len(self.client.spool))
+
+        # new messages go directly to broker
+        yield self.client.publishMessage(
+            exchange='', routing_key=self.queue, body={'n': 50}, content_type='json')
+        self.assertEqual(0, len(self.client.spool))
+
+        q = self.broker.queues[self.queue]
+        self.assertEqual(
+            [{'n': i} for i in range(51)],
+            [amqp.deserialize(m.body, 'json') for m in q.messages])
+
+    @defer.inlineCallbacks
+    def test_spool_survives_restart(self):
+
+        yield self.client.publishMessage(exchange='', routing_key=self.queue, body='msg')
+        yield self.client.stopService()
+
+        self.client.startService()
+        self.assertEqual(1, len(self.client.spool))
+        self.broker_port = reactor.listenTCP(self.port, self.broker, interface='127.0.0.1')
+        for _ in range(100):
+            yield sleep(0.02)
+            if self.broker.messageCount(self.queue):
+                break
+        self.assertEqual(1, self.broker.messageCount(self.queue))
+
+
+class _FakeBatchPublisher(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def publishBatch(self, messages, confirm=True):
+        d = defer.Deferred()
+        self.batches.append((messages, d))
+        return d
+
+
+class BatchSenderTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.publisher = _FakeBatchPublisher()
+
+    def makeSender(self, **kwargs):
+        return amqp._BatchSender(
+            self.publisher, exchange='ex', routing_key='rk', clock=self.clock, **kwargs)
+
+    def test_coalesce_within_tick(self):
+        send = self.makeSender()
+        ds = [send({'n': i}) for i in range(10)]
+        self.assertEqual([], self.publisher.batches)
+
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.publisher.batches))
+        messages, bd = self.publisher.batches[0]
+        self.assertEqual(10, len(messages))
+        self.assertEqual('rk', messages[0]['routing_key'])
+        self.assertEqual({'n': 0}, amqp.deserialize(messages[0]['body'], 'json'))
+
+        self.assertFalse(any(d.called for d in ds))
+        bd.callback(None)
+        self.assertTrue(all(d.called for d in ds))
+
+    def test_max_messages(self):
+        send = self.makeSender(max_messages=3)
+        for i in range(7):
+            send(i)
+        self.assertEqual(2, len(self.publisher.batches))
+        self.clock.advance(0)
+        self.assertEqual([3, 3, 1], [len(m) for m, _ in self.publisher.batches])
+
+    def test_max_bytes(self):
+        send = self.makeSender(max_bytes=10, content_type=None)
+        send("x" * 6)
+        self.assertEqual(0, len(self.publisher.batches))
+        send("x" * 6)
+        self.assertEqual(1, len(self.publisher.batches))
+
+    def test_batch_failure(self):
+        send = self.makeSender()
+        d1, d2 = send(1), send(2)
+        self.clock.advance(0)
+        self.publisher.batches[0][1].errback(amqp._PublishNacked())
+        self.failureResultOf(d1, amqp._PublishNacked)
+        self.failureResultOf(d2, amqp._PublishNacked)
+
+
+class PublishedBatchTest(TestCase):
+
+    def test_confirm(self):
+        b = amqp._PublishedBatch(3)
+        b.callback(None)
+        b.callback(None)
+        self.assertNoResult(b.deferred)
+        b.callback(None)
+        self.assertIsNone(self.successResultOf(b.deferred))
+
+    def test_nack(self):
+        b = amqp._PublishedBatch(3)
+        b.callback(None)
+        b.errback(amqp._PublishNacked())
+        b.errback(amqp._PublishNacked())
+        self.failureResultOf(b.deferred, amqp._PublishNacked)
+
+
+class PublishedMessagesTest(TestCase):
+
+    def test_ordered_confirms(self):
+        pm = amqp._PublishedMessages()
+        for t in range(1, 11):
+            pm.add(t, "m%d" % t)
+
+        self.assertEqual("m3", pm.pop(3))
+        self.assertEqual(["m1", "m2", "m4"], pm.popUpTo(4))
+        self.assertEqual(6, len(pm))
+        self.assertEqual(["m5", "m6", "m7", "m8", "m9", "m10"], pm.popAll())
+        self.assertEqual(0, len(pm))
+
+    def test_head_cleanup(self):
+        pm = amqp._PublishedMessages()
+        for t in range(1, 4):
+            pm.add(t, t)
+        pm.pop(2)
+        pm.pop(1)
+        self.assertEqual([3], list(pm._tags))
+
+
+class _FakeChannel(object):
+
+    def __init__(self):
+        self.published = []
+        self.properties = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((exchange, routing_key, body))
+        self.properties.append(properties)
+
+
+class _FakePushProducer(object):
+
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+def _confirmFrame(method_name, delivery_tag, multiple=False):
+    frame = type('Frame', (object,), {})()
+    frame.method = type(method_name, (object,), {})()
+    frame.method.delivery_tag = delivery_tag
+    frame.method.multiple = multiple
+    return frame
+
+
+def _offlineProtocol(factory):
+    p = factory.buildProtocol(None)
+    p._confirm_channels = [
+        amqp._ConfirmChannel(_FakeChannel())
+        for _ in range(p.publish_channels)
+    ]
+    p._write_channel = _FakeChannel()
+    p._ready_for_publish = True
+    return p
+
+
+class PublishWindowTest(TestCase):
+
+    def test_max_inflight_confirms(self):
+
+        factory = amqp.AMQPFactory(max_inflight_confirms=2)
+        producer = _FakePushProducer()
+        factory.addPushProducer(producer)
+        p = _offlineProtocol(factory)
+
+        ds = [p.publishMessage('', 'q', str(i)) for i in range(4)]
+        self.assertEqual(2, len(p._confirm_channels[0].channel.published))
+        self.assertTrue(producer.paused)
+
+        p._onPublishConfirm(p._confirm_channels[0], _confirmFrame('Ack', 1))
+        self.assertEqual(3, len(p._confirm_channels[0].channel.published))
+        self.assertTrue(producer.paused)
+        self.assertIsNone(self.successResultOf(ds[0]))
+
+        p._onPublishConfirm(p._confirm_channels[0], _confirmFrame('Ack', 3, multiple=True))
+        self.assertEqual(4, len(p._confirm_channels[0].channel.published))
+        self.assertFalse(producer.paused)
+
+        self.assertEqual(
+            ['0', '1', '2', '3'],
+            [x[2] for x in p._confirm_channels[0].channel.published])
+
+    def test_max_inflight_bytes(self):
+
+        factory = amqp.AMQPFactory(max_inflight_bytes=10)
+        p = _offlineProtocol(factory)
+
+        p.publishMessage('', 'q', "x" * 6)
+        p.publishMessage('', 'q', "x" * 6)
+        d = p.publishMessage('', 'q', "x" * 6)
+        self.assertEqual(2, len(p._confirm_channels[0].channel.published))
+
+        p._onPublishConfirm(p._confirm_channels[0], _confirmFrame('Ack', 1))
+        self.assertEqual(3, len(p._confirm_channels[0].channel.published))
+        self.assertNoResult(d)
+
+    def test_fail_waiters_on_connection_lost(self):
+
+        factory = amqp.AMQPFactory(max_inflight_confirms=1)
+        producer = _FakePushProducer()
+        factory.addPushProducer(producer)
+        p = _offlineProtocol(factory)
+
+        d1 = p.publishMessage('', 'q', "1")
+        d2 = p.publishMessage('', 'q', "2")
+        self.assertTrue(producer.paused)
+
+        p._fail_published_messages(ConnectionDone())
+        p._fail_publish_window_waiters(ConnectionDone())
+        self.failureResultOf(d1, ConnectionDone)
+        self.failureResultOf(d2, ConnectionDone)
+        self.assertFalse(producer.paused)
+
+
+class PublishChannelsPoolTest(TestCase):
+
+    def test_round_robin(self):
+        p = _offlineProtocol(amqp.AMQPFactory(publish_channels=3))
+        for i in range(6):
+            p.publishMessage('', 'q', str(i))
+        self.assertEqual(
+            [2, 2, 2],
+            [len(cc.channel.published) for cc in p._confirm_channels])
+        self.assertEqual(
+            [2, 2, 2],
+            [cc.delivery_tag_counter for cc in p._confirm_channels])
+
+    def test_least_inflight(self):
+        p = _offlineProtocol(amqp.AMQPFactory(
+            publish_channels=2, publish_channel_selection='least_inflight'))
+        cc1, cc2 = p._confirm_channels
+        p.publishMessage('', 'q', "1")
+        p.publishMessage('', 'q', "2")
+        p._onPublishConfirm(cc1, _confirmFrame('Ack', 1))
+        p.publishMessage('', 'q', "3")
+        self.assertEqual(["1", "3"], [x[2] for x in cc1.channel.published])
+
+    def test_batch_to_one_channel(self):
+        p = _offlineProtocol(amqp.AMQPFactory(publish_channels=2))
+        d = p.publishBatch([('', 'q', str(i)) for i in range(5)])
+        cc = [cc for cc in p._confirm_channels if cc.published][0]
+        self.assertEqual(5, len(cc.published))
+        p._onPublishConfirm(cc, _confirmFrame('Ack', 5, multiple=True))
+        self.assertIsNone(self.successResultOf(d))
+
+    def test_channel_closed(self):
+        p = _offlineProtocol(amqp.AMQPFactory(publish_channels=2))
+        d1 = p.publishMessage('', 'q', "1")
+        d2 = p.publishMessage('', 'q', "2")
+
+        reopened = []
+        p._open_safewrite_channel = reopened.append
+        p._on_safewrite_channel_closed(0, None, 404, "NOT_FOUND")
+
+        self.assertEqual([0], reopened)
+        self.failureResultOf(d1, ChannelClosed)
+        self.assertNoResult(d2)
+
+        # closed channel is skipped
+        p.publishMessage('', 'q', "3")
+        self.assertEqual(2, len(p._confirm_channels[1].published))
+
+
+class CodecRegistryTest(TestCase):
+
+    def tearDown(self):
+        amqp.MESSAGE_SERIALIZERS.pop('application/x-test', None)
+        amqp._resolved_codecs.clear()
+
+    def test_register_codec(self):
+        amqp.register_codec('application/x-test', lambda x: "<%s>" % x, lambda x: x[1:-1])
+        self.assertEqual("<abc>", amqp.serialize("abc", 'application/X-Test'))
+        self.assertEqual("abc", amqp.deserialize("<abc>", 'application/x-test'))
+
+    def test_builtin_codecs(self):
+        data = {'a': [1, 2, {'b': "c"}]}
+        for ct in [None, '', 'json', 'application/json', 'msgpack', 'application/msgpack']:
+            self.assertEqual(data, amqp.deserialize(amqp.serialize(data, ct), ct))
+        self.assertIs(amqp.get_codec('JSON'), amqp.get_codec('JSON'))
+
+    def test_unknown_codec(self):
+        self.assertRaises(KeyError, amqp.serialize, "x", 'application/unknown')
+
+
+class CompressionTest(TestCase):
+
+    def test_compress_decompress(self):
+        data = "some data " * 100
+        for ce in amqp.CONTENT_ENCODINGS:
+            self.assertEqual(data, amqp.decompress(amqp.compress(data, ce), ce))
+        self.assertEqual(data, amqp.decompress(data, 'utf-8'))
+        self.assertEqual(data, amqp.decompress(data, None))
+
+    def test_compression_threshold(self):
+
+        p = _offlineProtocol(amqp.AMQPFactory(
+            compression='zlib', compression_threshold=100))
+        published = []
+        p._write_channel.basic_publish = (
+            lambda e, rk, body, properties: published.append((body, properties)))
+
+        p.publishMessage('', 'q', "small", confirm=False)
+        p.publishMessage('', 'q', "x" * 200, confirm=False)
+        p.publishMessage('', 'q', "x" * 200, confirm=False, compression=False)
+
+        (b1, p1), (b2, p2), (b3, p3) = published
+        self.assertEqual(("small", None), (b1, p1.content_encoding))
+        self.assertEqual('zlib', p2.content_encoding)
+        self.assertEqual("x" * 200, amqp.decompress(b2, p2.content_encoding))
+        self.assertEqual(("x" * 200, None), (b3, p3.content_encoding))
+
+    def test_consumer_decompress(self):
+
+        data = {'x': "y" * 1000}
+        body = amqp.compress(amqp.serialize(data, 'json'), 'zlib')
+        props = amqp._BasicProperties(content_type='json', content_encoding='zlib')
+        msg = amqp.AMQPMessage(body=body, deliver=None, properties=props)
+
+        result = []
+        consumer = amqp._QueueConsumer('q', result.append)
+        consumer.onMessage(msg)
+        self.assertEqual([data], result)
+        self.assertEqual(data, msg.data)
+
+
+class AMQPMessageTest(TestCase):
+
+    def makeMessage(self, body='{"a": 1}', **props):
+        deliver = Basic.Deliver(
+            consumer_tag='ct', delivery_tag=7, exchange='e', routing_key='rk')
+        props.setdefault('content_type', 'json')
+        return amqp.AMQPMessage(body=body, deliver=deliver, properties=BasicProperties(**props))
+
+    def test_fields(self):
+        msg = self.makeMessage(headers={'h': 1}, reply_to='q2')
+        self.assertEqual(
+            ('ct', 7, 'e', 'rk', 'json', {'h': 1}, 'q2'),
+            (msg.consumer_tag, msg.delivery_tag, msg.exchange, msg.routing_key,
+             msg.content_type, msg.headers, msg.reply_to))
+        self.assertRaises(AttributeError, setattr, msg, 'foo', 1)
+        self.assertRaises(AttributeError, getattr, msg, 'no_such_field')
+
+    def test_decode_once(self):
+
+        calls = []
+
+        def loads(s):
+            calls.append(s)
+            return s.upper()
+
+        amqp.register_codec('x-test-upper', lambda s: s, loads)
+        msg = self.makeMessage(body='abc', content_type='x-test-upper')
+
+        result = []
+        consumer = amqp._QueueConsumer('q', result.append)
+        consumer.onMessage(msg)
+
+        self.assertEqual('ABC', msg.data)
+        self.assertEqual(['ABC'], result)
+        self.assertEqual(['abc'], calls)
+
+
+class AMQPStreamMessageTest(TestCase):
+
+    def makeMessage(self, body, frame=10, **props):
+        deliver = Basic.Deliver(
+            consumer_tag='ct', delivery_tag=7, exchange='e', routing_key='rk')
+        fragments = [body[i:i + frame] for i in range(0, len(body), frame)]
+        return amqp.AMQPStreamMessage(fragments, deliver, BasicProperties(**props))
+
+    def test_chunks(self):
+        msg = self.makeMessage(b"0123456789" * 3 + b"abc")
+        self.assertEqual(4, len(msg.chunks))
+        self.assertEqual(33, msg.size)
+        self.assertTrue(all(c.readonly for c in msg.chunks))
+        self.assertEqual(b"0123456789" * 3 + b"abc", msg.body)
+        self.assertEqual(msg.body, msg.data)
+
+    def test_iter_objects(self):
+        objs = [{'n': i, 's': "x" * i} for i in range(20)]
+        body = b''.join(msgpack.packb(o) for o in objs)
+        msg = self.makeMessage(body, frame=7, content_type='msgpack')
+        self.assertEqual(objs, list(msg.iterObjects()))
+        self.assertEqual(objs[0], msg.data)
+        # body is not joined
+        self.assertIsNone(msg._body)
+
+    def test_compressed(self):
+        data = {'list': list(range(1000))}
+        msg = self.makeMessage(
+            zlib.compress(msgpack.packb(data)), frame=16,
+            content_type='msgpack', content_encoding='zlib')
+        self.assertEqual(msgpack.packb(data), b''.join(msg.iterChunks()))
+        self.assertEqual(data, msg.data)
+
+        msg = self.makeMessage(
+            zlib.compress(b'{"a": [1, 2]}'), frame=4,
+            content_type='json', content_encoding='zlib')
+        self.assertEqual({'a': [1, 2]}, msg.data)
+
+    def test_unknown_encoding(self):
+        msg = self.makeMessage(b"some data", content_encoding='utf-8')
+        self.assertEqual(b"some data", b''.join(c.tobytes() for c in msg.iterChunks()))
+        self.assertEqual(b"some data", msg.data)
+
+    def test_dispatcher(self):
+        d = amqp._FragmentsDispatcher()
+        d.process(frame.Method(1, Basic.Deliver(delivery_tag=1)))
+        d.process(frame.Header(1, 6, BasicProperties()))
+        self.assertIsNone(d.process(frame.Body(1, b"abc")))
+        _, _, body = d.process(frame.Body(1, b"def"))
+        self.assertEqual([b"abc", b"def"], body)
+
+
+class _FakeConsumeChannel(object):
+
+    def __init__(self):
+        self.acks = []
+        self.rejects = []
+        self.qos = []
+
+    def basic_qos(self, prefetch_count, all_channels=0):
+        self.qos.append(prefetch_count)
+        return defer.succeed(None)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.rejects.append((delivery_tag, requeue))
+
+
+class BatchConsumingTest(TestCase):
+
+    ct = 'ct-batch-test'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = amqp._AMQPProtocol({})
+        self.protocol.clock = self.clock
+        self.channel = _FakeConsumeChannel()
+        self.queue = ClosableDeferredQueue()
+        self.batches = []
+        self.delivery_tag = 0
+
+    def tearDown(self):
+        if not self.queue.closed:
+            self.queue.close(amqp._PikaQueueUnconsumed())
+
+    def putMessage(self, body):
+        self.delivery_tag += 1
+        deliver = Basic.Deliver(
+            consumer_tag=self.ct, delivery_tag=self.delivery_tag,
+            exchange='', routing_key='q')
+        self.queue.put((self.channel, deliver, BasicProperties(), body))
+
+    def consume(self, callback=None, on_error='reject', **kwargs):
+        self.protocol._consumer_state[self.ct] = {'on_error': on_error, 'requeue_delay': 1}
+        self.protocol._queueCounsumingLoop(
+            self.ct, self.queue, callback or self.onBatch, no_ack=False, **kwargs)
+
+    def onBatch(self, msgs):
+        self.batches.append([m.body for m in msgs])
+        if "bad" in self.batches[-1]:
+            raise Exception("bad message in batch")
+
+    def test_batch_size_and_timeout(self):
+
+        self.consume(batch_size=3, batch_timeout=1)
+        for i in range(5):
+            self.putMessage(str(i))
+
+        self.assertEqual([["0", "1", "2"]], self.batches)
+        self.clock.advance(0.5)
+        self.assertEqual([["0", "1", "2"]], self.batches)
+        self.clock.advance(0.5)
+        self.assertEqual([["0", "1", "2"], ["3", "4"]], self.batches)
+        self.assertEqual([(3, True), (5, True)], self.channel.acks)
+
+    def test_delayed_requeue_shares_timer(self):
+
+        def fail(msg):
+            raise Exception("fail")
+
+        self.consume(fail, parallel=-1)
+        for i in range(50):
+            self.putMessage(str(i))
+
+        self.assertEqual(50, len(self.protocol._delayed_requeue_tasks[self.ct]))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.assertEqual([], self.channel.rejects)
+
+        self.clock.advance(1.1)
+        self.assertEqual(50, len(self.channel.rejects))
+        self.assertNotIn(self.ct, self.protocol._delayed_requeue_tasks)
+
+    def test_fail_whole_batch(self):
+
+        self.consume(batch_size=3, batch_timeout=1)
+        for body in ["1", "bad", "3"]:
+            self.putMessage(body)
+
+        self.assertEqual([], self.channel.acks)
+        self.clock.advance(1)
+        self.assertEqual([(1, False), (2, False), (3, False)], self.channel.rejects)
+
+    def test_fail_message_by_message(self):
+
+        self.consume(batch_size=3, batch_timeout=1, batch_on_error='message')
+        for body in ["1", "bad", "3"]:
+            self.putMessage(body)
+
+        self.assertEqual(
+            [["1", "bad", "3"], ["1"], ["bad"], ["3"]],
+            self.batches)
+        self.assertEqual([(1, True), (3, False)], self.channel.acks)
+
+        self.clock.advance(1)
+        self.assertEqual([(2, False)], self.channel.rejects)
+
+    def test_no_multiple_ack_over_unacked(self):
+
+        pending = defer.Deferred()
+
+        def on_batch(msgs):
+            self.batches.append([m.body for m in msgs])
+            if msgs[0].body == "slow":
+                return pending
+
+        self.consume(on_batch, batch_size=1, parallel=2)
+        self.putMessage("slow")
+        self.putMessage("fast")
+
+        self.assertEqual([(2, False)], self.channel.acks)
+        pending.callback(None)
+        self.assertEqual([(2, False), (1, True)], self.channel.acks)
+
+
+class AdaptiveConcurrencyTest(TestCase):
+
+    def test_resizable_semaphore(self):
+
+        sem = amqp._ResizableSemaphore(tokens=2)
+        acquired = []
+        for i in range(4):
+            sem.acquire().addCallback(lambda _, i=i: acquired.append(i))
+        self.assertEqual([0, 1], acquired)
+
+        sem.resize(3)
+        self.assertEqual([0, 1, 2], acquired)
+
+        sem.resize(1)
+        sem.release()
+        sem.release()
+        self.assertEqual([0, 1, 2], acquired)
+        sem.release()
+        self.assertEqual([0, 1, 2, 3], acquired)
+
+    def test_increase_on_success(self):
+
+        ac = amqp._AdaptiveConcurrency(max_parallel=3, prefetch_factor=2)
+        changes = []
+        ac.listener = lambda *args: changes.append(args)
+
+        for _ in range(10):
+            ac.callbackDone(0.01, True)
+
+        self.assertEqual(3, ac.limit)
+        self.assertEqual([(2, 4), (3, 6)], changes)
+
+    def test_decrease_on_errors_and_latency(self):
+
+        ac = amqp._AdaptiveConcurrency(
+            initial_parallel=8, target_latency=0.1, decrease_factor=0.5)
+
+        for _ in range(8):
+            ac.callbackDone(0.01, False)
+        self.assertEqual(4, ac.limit)
+
+        for _ in range(4):
+            ac.callbackDone(1.0, True)
+        self.assertEqual(2, ac.limit)
+
+    def test_errors_between_decisions(self):
+
+        ac = amqp._AdaptiveConcurrency(initial_parallel=4, decrease_factor=0.5)
+        for _ in range(3):
+            ac.callbackDone(0.01, False)
+        ac.callbackDone(0.01, True)
+        self.assertEqual(2, ac.limit)
+
+        ac.callbackDone(0.01, False)
+        ac.callbackDone(0.01, True)
+        self.assertEqual(1, ac.limit)
+
+    def test_adapt_consuming_loop(self):
+
+        clock = task.Clock()
+        protocol = amqp._AMQPProtocol({})
+        protocol.clock = clock
+        channel = _FakeConsumeChannel()
+        queue = ClosableDeferredQueue()
+        ac = amqp._AdaptiveConcurrency(initial_parallel=1, max_parallel=2)
+        protocol._consumer_state['ct'] = {
+            'on_error': 'reject', 'requeue_delay': 1,
+            'channel': channel, 'no_ack': False,
+        }
+
+        pending = []
+
+        def callback(msg):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        protocol._queueCounsumingLoop('ct', queue, callback, no_ack=False, adaptive=ac)
+        for i in range(3):
+            deliver = Basic.Deliver(
+                consumer_tag='ct', delivery_tag=i + 1, exchange='', routing_key='q')
+            queue.put((channel, deliver, BasicProperties(), "x"))
+
+        self.assertEqual(1, len(pending))
+        clock.advance(0.1)
+        pending[0].callback(None)
+        self.assertEqual(2, ac.limit)
+        self.assertEqual([4], channel.qos)
+        self.assertEqual(3, len(pending))
+
+        queue.close(amqp._PikaQueueUnconsumed())
+        for d in pending[1:]:
+            d.callback(None)
+        self.assertIdentical(None, ac.listener)
+
+
+class _FakeCallbacks(object):
+
+    def __init__(self):
+        self.callbacks = []
+
+    def add(self, prefix, key, callback, one_shot=True, only_caller=None, arguments=None):
+        self.callbacks.append((key, arguments, callback))
+
+
+class _FakeConsumingChannel(_FakeConsumeChannel):
+
+    channel_number = 1
+
+    def __init__(self):
+        _FakeConsumeChannel.__init__(self)
+        self.callbacks = _FakeCallbacks()
+        self.close_callbacks = []
+        self.queue = ClosableDeferredQueue()
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def basic_consume(self, queue, no_ack, consumer_tag, **kwargs):
+        return defer.succeed((self.queue, consumer_tag))
+
+    def consumeOk(self, consumer_tag):
+        frame = Basic.ConsumeOk(consumer_tag=consumer_tag)
+        for key, arguments, callback in self.callbacks.callbacks:
+            if key is Basic.ConsumeOk and arguments == {'consumer_tag': consumer_tag}:
+                callback(frame)
+
+    def close(self, reply_code, reply_text):
+        self.queue.close(ChannelClosed(reply_code, reply_text))
+        for callback in self.close_callbacks:
+            callback(self, reply_code, reply_text)
+
+
+class ConsumeOkTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = amqp._AMQPProtocol({})
+        self.protocol.clock = self.clock
+        self.channel = _FakeConsumingChannel()
+        self.protocol.channel = lambda: defer.succeed(self.channel)
+        self.messages = []
+
+    def tearDown(self):
+        if not self.channel.queue.closed:
+            self.channel.queue.close(amqp._PikaQueueUnconsumed())
+
+    def test_wait_consume_ok(self):
+
+        d = self.protocol.consumeQueue('q', self.messages.append, consumer_tag='ct1')
+        self.assertFalse(d.called)
+
+        self.channel.consumeOk('ct2')
+        self.assertFalse(d.called)
+
+        self.channel.consumeOk('ct1')
+        self.assertEqual('ct1', self.successResultOf(d))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+        deliver = Basic.Deliver(
+            consumer_tag='ct1', delivery_tag=1, exchange='', routing_key='q')
+        self.channel.queue.put((self.channel, deliver, BasicProperties(), "x"))
+        self.assertEqual(["x"], [m.body for m in self.messages])
+
+    def test_channel_closed_before_consume_ok(self):
+
+        d = self.protocol.consumeQueue('q', self.messages.append, consumer_tag='ct1')
+        self.channel.close(404, "NOT_FOUND")
+
+        self.failureResultOf(d, ChannelClosed)
+        self.assertNotIn('ct1', self.protocol._consumer_state)
+
+
+class RetryQueueTest(TestCase):
+
+    ct = 'ct-retry-test'
+
+    def setUp(self):
+        factory = amqp.AMQPFactory(retry_delays=(1, 10), retry_max_count=2)
+        self.protocol = _offlineProtocol(factory)
+        self.protocol.clock = task.Clock()
+        self.protocol._consumer_state[self.ct] = {'on_error': 'retry_queue', 'queue': 'q'}
+        self.channel = _FakeConsumeChannel()
+        self.queue = ClosableDeferredQueue()
+        self.cc = self.protocol._confirm_channels[0]
+
+        def fail(msg):
+            raise Exception("fail")
+
+        self.protocol._queueCounsumingLoop(self.ct, self.queue, fail, no_ack=False)
+
+    def tearDown(self):
+        self.queue.close(amqp._PikaQueueUnconsumed())
+
+    def putMessage(self, delivery_tag, retry_count=None):
+        deliver = Basic.Deliver(
+            consumer_tag=self.ct, delivery_tag=delivery_tag,
+            exchange='', routing_key='q')
+        headers = {'x-retry-count': retry_count} if retry_count is not None else None
+        props = BasicProperties(content_type='application/json', headers=headers)
+        self.queue.put((self.channel, deliver, props, '"body"'))
+
+    def test_republish_to_retry_queue(self):
+
+        self.putMessage(1)
+        self.putMessage(2, retry_count=1)
+
+        self.assertEqual(
+            [('', 'q.retry.1s', '"body"'), ('', 'q.retry.10s', '"body"')],
+            self.cc.channel.published)
+        self.assertEqual(
+            [{'x-retry-count': 1}, {'x-retry-count': 2}],
+            [p.headers for p in self.cc.channel.properties])
+        self.assertEqual(
+            ['application/json'] * 2,
+            [p.content_type for p in self.cc.channel.properties])
+
+        # ack original message after confirm only
+        self.assertEqual([], self.channel.acks)
+        self.protocol._onPublishConfirm(self.cc, _confirmFrame('Ack', 2, multiple=True))
+        self.assertEqual([(1, False), (2, False)], self.channel.acks)
+        self.assertEqual([], self.channel.rejects)
+
+    def test_requeue_on_nack(self):
+
+        self.putMessage(1)
+        self.protocol._onPublishConfirm(self.cc, _confirmFrame('Nack', 1))
+        self.assertEqual([], self.channel.acks)
+        self.assertEqual([(1, True)], self.channel.rejects)
+
+    def test_reject_after_max_retries(self):
+
+        self.putMessage(1, retry_count=2)
+        self.assertEqual([], self.cc.channel.published)
+        self.assertEqual([(1, False)], self.channel.rejects)
+
+    def test_declare_retry_queues(self):
+
+        declared = []
+
+        def declareQueue(queue, **kwargs):
+            declared.append((queue, kwargs))
+            return defer.succeed(None)
+
+        self.protocol.declareQueue = declareQueue
+        self.protocol._declareRetryQueues('q')
+        self.protocol._declareRetryQueues('q')
+
+        self.assertEqual(['q.retry.1s', 'q.retry.10s'], [q for q, _ in declared])
+        self.assertEqual(
+            {'durable': True, 'message_ttl': 10000,
+             'dead_letter_exchange': '', 'dead_letter_exchange_rk': 'q'},
+            declared[1][1])
+
+    def test_no_retry_queue_for_exchange(self):
+
+        declared = []
+        self.protocol.declareQueue = lambda *a, **kw: declared.append(a)
+        d = self.protocol.consumeExchange(
+            callback=lambda msg: None, exchange='x', on_error='retry_queue')
+        self.failureResultOf(d, ValueError)
+        self.assertEqual([], declared)
+
+        service = amqp.AMQPService(None, amqp.AMQPFactory())
+        self.assertRaises(
+            ValueError, service.setupExchangeConsuming,
+            'x', lambda msg: None, on_error='retry_queue')
+
+
+class MetricsTest(TestCase):
+
+    def test_protocol_metrics(self):
+
+        p = _offlineProtocol(amqp.AMQPFactory())
+        p.clock = task.Clock()
+        p.publishMessage('', 'q', "abc")
+        p.publishBatch([('', 'q', "de"), ('', 'q', "f")])
+        p.publishMessage('', 'q', "xyz", confirm=False)
+
+        m = p.getMetrics()
+        self.assertEqual(4, m['messages_out'])
+        self.assertEqual(9, m['bytes_out'])
+        self.assertEqual(3, m['published_inflight'])
+
+        p.clock.advance(0.5)
+        p._onPublishConfirm(p._confirm_channels[0], _confirmFrame('Ack', 3, multiple=True))
+
+        m = p.getMetrics()
+        self.assertEqual(0, m['published_inflight'])
+        self.assertEqual(3, m['confirms_acked'])
+        self.assertEqual(2, m['confirm_latency']['count'])
+        self.assertEqual(0.5, m['confirm_latency']['max'])
+
+    def test_metrics_while_channel_reopening(self):
+
+        p = _offlineProtocol(amqp.AMQPFactory(publish_channels=2))
+        p.clock = task.Clock()
+        p.publishMessage('', 'q', "abc")
+        p._confirm_channels[1] = None
+
+        m = p.getMetrics()
+        self.assertEqual(1, m['published_inflight'])
+        self.assertEqual(3, m['published_inflight_bytes'])
+
+        service = amqp.AMQPService(None, amqp.AMQPFactory())
+        service._protocol = p
+        service._protocol_ready = True
+        self.assertIn("unconfirmed 1", service.checkHealth())
+
+    def test_consuming_metrics(self):
+
+        clock = task.Clock()
+        p = amqp._AMQPProtocol({})
+        p.clock = clock
+        channel = _FakeConsumeChannel()
+        queue = ClosableDeferredQueue()
+        p._consumer_state['ct'] = {'on_error': 'reject', 'requeue_delay': 1}
+
+        def callback(data):
+            clock.advance(0.1)
+            if data == "bad":
+                raise Exception("bad message")
+
+        consumer = amqp._QueueConsumer('q', callback)
+        consumer.clock = clock
+        p._queueCounsumingLoop('ct', queue, consumer.onMessage, no_ack=False)
+
+        for i, body in enumerate(["ok", "bad", "ok"]):
+            deliver = Basic.Deliver(
+                consumer_tag='ct', delivery_tag=i + 1, exchange='', routing_key='q')
+            queue.put((channel, deliver, BasicProperties(), body))
+
+        m = p.getMetrics()
+        self.assertEqual(3, m['messages_in'])
+        self.assertEqual(7, m['bytes_in'])
+        self.assertEqual(2, m['acks'])
+        self.assertEqual({'reject': 1}, m['nacks_by_strategy'])
+        self.assertEqual(1, m['delayed_requeue'])
+
+        s = consumer.stats()
+        self.assertEqual(3, s['messages'])
+        self.assertEqual(1, s['failures'])
+        self.assertEqual(3, s['callback_latency']['count'])
+        self.assertTrue(0.09 < s['callback_latency']['p50'] < 0.12)
+
+        queue.close(amqp._PikaQueueUnconsumed())
+
+
+class _FakeMemcache(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return defer.succeed((0, self.data.get(key)))
+
+    def getMultiple(self, keys):
+        return defer.succeed(dict((k, (0, self.data.get(k))) for k in keys))
+
+    def set(self, key, value, flags=0, expireTime=0):
+        self.data[key] = value
+        return defer.succeed(True)
+
+
+class DedupTest(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.pending = {}
+
+    def callback(self, data):
+        self.calls.append(data)
+        if data == "bad":
+            raise Exception("bad message")
+        elif not isinstance(data, list):
+            return self.pending.get(data)
+
+    def makeMessage(self, body, message_id=None):
+        deliver = Basic.Deliver(
+            consumer_tag='ct', delivery_tag=1, exchange='', routing_key='q')
+        return amqp.AMQPMessage(
+            body=body, deliver=deliver, properties=BasicProperties(message_id=message_id))
+
+    def test_skip_processed(self):
+
+        consumer = amqp._QueueConsumer('q', self.callback, dedup=True)
+        consumer.onMessage(self.makeMessage("a", message_id='1'))
+        consumer.onMessage(self.makeMessage("a", message_id='1'))
+        consumer.onMessage(self.makeMessage("b", message_id='2'))
+        consumer.onMessage(self.makeMessage("c"))
+        consumer.onMessage(self.makeMessage("c"))
+
+        self.assertEqual(["a", "b", "c", "c"], self.calls)
+        self.assertEqual(
+            {'hits': 1, 'misses': 2, 'size': 2},
+            consumer.stats()['dedup'])
+
+    def test_failed_message_is_not_remembered(self):
+
+        consumer = amqp._QueueConsumer('q', self.callback, dedup=True)
+        self.failureResultOf(consumer.onMessage(self.makeMessage("bad", message_id='1')))
+        self.failureResultOf(consumer.onMessage(self.makeMessage("bad", message_id='1')))
+        self.assertEqual(["bad", "bad"], self.calls)
+
+    def test_wait_inflight_duplicate(self):
+
+        self.pending["a"] = defer.Deferred()
+        consumer = amqp._QueueConsumer('q', self.callback, dedup=True)
+        d1 = consumer.onMessage(self.makeMessage("a", message_id='1'))
+        d2 = consumer.onMessage(self.makeMessage("a", message_id='1'))
+        self.assertEqual(["a"], self.calls)
+        self.assertFalse(d2.called)
+
+        self.pending["a"].callback(None)
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.assertEqual(["a"], self.calls)
+
+    def test_key_fn_and_memcache(self):
+
+        mc = _FakeMemcache()
+        dedup = {'key_fn': lambda m: m.body, 'memcache': mc}
+
+        c1 = amqp._QueueConsumer('q', self.callback, dedup=dedup)
+        c1.onMessage(self.makeMessage("a"))
+        self.assertEqual(1, len(mc.data))
+
+        # other worker
+        c2 = amqp._QueueConsumer('q', self.callback, dedup=dedup)
+        c2.onMessage(self.makeMessage("a"))
+        c2.onMessage(self.makeMessage("a"))
+        self.assertEqual(["a"], self.calls)
+        self.assertEqual(
+            {'memcache_hits': 1, 'hits': 1, 'size': 1},
+            c2.stats()['dedup'])
+
+    def test_batch(self):
+
+        mc = _FakeMemcache()
+        c1 = amqp._QueueConsumer(
+            'q', self.callback, batch_size=10, dedup={'memcache': mc})
+        c1.onBatch([self.makeMessage("a", '1'), self.makeMessage("b", '2')])
+
+        c2 = amqp._QueueConsumer(
+            'q', self.callback, batch_size=10, dedup={'memcache': mc})
+        c2.onBatch([
+            self.makeMessage("a", '1'),
+            self.makeMessage("c", '3'),
+            self.makeMessage("c", '3'),
+            self.makeMessage("x"),
+        ])
+        c2.onBatch([self.makeMessage("b", '2')])
+
+        self.assertEqual([["a", "b"], ["c", "x"]], self.calls)
+
+
+class _SchedulerClient(object):
+
+    def __init__(self, name, weight=None, priority=None):
+        self.name = name
+        self.weight = weight
+        self.priority = priority
+
+
+class WeightedSchedulerTest(TestCase):
+
+    def setUp(self):
+        self.started = []
+        self.running = []
+
+    def task(self, name):
+        d = defer.Deferred()
+        self.started.append(name)
+        self.running.append(d)
+        return d
+
+    def submit(self, scheduler, client, count):
+        return [scheduler.run(client, self.task, client.name) for _ in range(count)]
+
+    def finishOne(self):
+        self.running.pop(0).callback(None)
+
+    def test_weights(self):
+
+        s = amqp._WeightedScheduler(2)
+        a = _SchedulerClient('a', weight=3)
+        b = _SchedulerClient('b', weight=1)
+        self.submit(s, a, 50)
+        self.submit(s, b, 50)
+
+        for _ in range(40):
+            self.finishOne()
+
+        self.assertEqual(2, s.active)
+        self.assertEqual(42, len(self.started))
+        self.assertTrue(28 <= self.started.count('a') <= 34, self.started)
+
+    def test_priority(self):
+
+        s = amqp._WeightedScheduler(1)
+        low = _SchedulerClient('low')
+        high = _SchedulerClient('high', priority=10)
+        self.submit(s, low, 3)
+        self.submit(s, high, 3)
+
+        for _ in range(5):
+            self.finishOne()
+        self.assertEqual(['low', 'high', 'high', 'high', 'low', 'low'], self.started)
+
+    def test_borrow_idle_budget(self):
+
+        s = amqp._WeightedScheduler(4)
+        a = _SchedulerClient('a', weight=100)
+        b = _SchedulerClient('b', weight=1)
+        self.submit(s, b, 10)
+        self.assertEqual(['b'] * 4, self.started)
+
+        # idle client doesn't accumulate credit
+        self.submit(s, a, 10)
+        self.finishOne()
+        self.finishOne()
+        self.assertEqual(['b'] * 4 + ['a', 'a'], self.started)
+
+    def test_cancel_waiting(self):
+
+        s = amqp._WeightedScheduler(1)
+        a = _SchedulerClient('a')
+        ds = self.submit(s, a, 3)
+        ds[1].cancel()
+        self.failureResultOf(ds[1], defer.CancelledError)
+
+        self.finishOne()
+        self.finishOne()
+        self.assertEqual(['a', 'a'], self.started)
+        self.assertEqual(0, s.active)
+        self.assertEqual({'limit': 1, 'active': 0, 'waiting': 0}, s.stats())
+
+        # message, which waits for slot of removed consumer, isn't failed
+        service = amqp.AMQPService(None, amqp.AMQPFactory(), max_parallel=1)
+        c = service.setupQueueConsuming('q', lambda data: self.task('q'), on_error='reject')
+        p = amqp._AMQPProtocol({})
+        p._consumer_state['ct'] = {'on_error': 'reject', 'requeue_delay': 1}
+        channel = _FakeConsumeChannel()
+        ds = [
+            p._processIncomingMessage(
+                (channel, Basic.Deliver(consumer_tag='ct', delivery_tag=i + 1),
+                 BasicProperties(), "x"),
+                None, c.onMessage, no_ack=False)
+            for i in range(2)
+        ]
+        service.scheduler.unregister(c)
+        self.successResultOf(ds[1])
+        self.assertEqual([(2, True)], channel.rejects)
+        self.assertEqual(0, c.counters['failures'])
+        self.assertEqual({}, p._delayed_requeue_tasks)
+
+        self.finishOne()
+        self.successResultOf(ds[0])
+        self.assertEqual([(1, False)], channel.acks)
+
+    def test_consumers_share_service_budget(self):
+
+        service = amqp.AMQPService(None, amqp.AMQPFactory(), max_parallel=1)
+        c1 = service.setupQueueConsuming('q1', lambda data: self.task('q1'), priority=1)
+        c2 = service.setupQueueConsuming('q2', lambda data: self.task('q2'))
+
+        d2 = c2.onMessage(amqp.AMQPMessage("x", None, BasicProperties()))
+        d1 = c1.onMessage(amqp.AMQPMessage("x", None, BasicProperties()))
+        self.assertEqual(['q2'], self.started)
+
+        self.finishOne()
+        self.successResultOf(d2)
+        self.assertEqual(['q2', 'q1'], self.started)
+        self.finishOne()
+        self.successResultOf(d1)
+
+
+def _childCallback(data):
+    if data == "bad" or data == ["bad"]:
+        raise ValueError("bad data")
+    elif data == "die":
+        os._exit(1)
+    elif data == "hang":
+        time.sleep(60)
+
+
+class ProcessExecutorTest(TestCase):
+
+    def setUp(self):
+        self.executor = amqp._ProcessExecutor(pool_size=1)
+        self.executor.watch_interval = 0.05
+        self.executor.start()
+        self.addCleanup(self.executor.stop)
+
+    def payload(self, data):
+        return amqp.serialize(data, 'application/json'), 'application/json', None
+
+    def test_callback_name(self):
+        self.assertEqual(
+            'twoost.tests.test_amqp._childCallback',
+            amqp._ProcessExecutor.callbackName(_childCallback))
+        self.assertRaises(ValueError, amqp._ProcessExecutor.callbackName, lambda x: x)
+
+    @defer.inlineCallbacks
+    def test_call(self):
+        name = amqp._ProcessExecutor.callbackName(_childCallback)
+        yield self.executor.call(name, self.payload("good"))
+        yield self.executor.call(name, [self.payload("good")])
+
+    @defer.inlineCallbacks
+    def test_call_failed(self):
+        name = amqp._ProcessExecutor.callbackName(_childCallback)
+        d = self.executor.call(name, self.payload("bad"))
+        yield self.assertFailure(d, amqp._ProcessCallbackFailed)
+        d = self.executor.call(name, [self.payload("bad")])
+        yield self.assertFailure(d, amqp._ProcessCallbackFailed)
+
+    @defer.inlineCallbacks
+    def test_child_died(self):
+        name = amqp._ProcessExecutor.callbackName(_childCallback)
+        d = self.executor.call(name, self.payload("die"))
+        yield self.assertFailure(d, amqp._ProcessCallbackFailed)
+        self.assertEqual(self.executor.max_pending, self.executor._semaphore.tokens)
+        # pool is restarted
+        yield self.executor.call(name, self.payload("good"))
+
+    @defer.inlineCallbacks
+    def test_task_timeout(self):
+        self.executor.task_timeout = 0.2
+        name = amqp._ProcessExecutor.callbackName(_childCallback)
+        d = self.executor.call(name, self.payload("hang"))
+        yield self.assertFailure(d, amqp._ProcessCallbackFailed)
+        self.assertEqual(self.executor.max_pending, self.executor._semaphore.tokens)
+        yield self.executor.call(name, self.payload("good"))
+
+    @defer.inlineCallbacks
+    def test_restart_doesnt_block(self):
+        old_pool = self.executor._pool
+        terminated = []
+
+        def terminate():
+            terminated.append(threading.current_thread())
+            multiprocessing.pool.Pool.terminate(old_pool)
+
+        old_pool.terminate = terminate
+        self.executor._restartPool("test")
+        self.assertEqual([], terminated)
+        self.assertIsNot(old_pool, self.executor._pool)
+        yield self.executor._stopping[0]
+        self.assertIsNot(threading.current_thread(), terminated[0])
+
+    @defer.inlineCallbacks
+    def test_cancel_keeps_slot(self):
+        self.executor.task_timeout = 0.2
+        name = amqp._ProcessExecutor.callbackName(_childCallback)
+        d = self.executor.call(name, self.payload("hang"))
+        yield sleep(0.05)
+        d.cancel()
+        yield self.assertFailure(d, defer.CancelledError)
+        # task is still running in child process
+        self.assertEqual(self.executor.max_pending - 1, self.executor._semaphore.tokens)
+        yield sleep(0.5)
+        self.assertEqual(self.executor.max_pending, self.executor._semaphore.tokens)
+
+    def test_consumer_passes_raw_body(self):
+        c = amqp._QueueConsumer(
+            callback=_childCallback, queue='q', executor='process', pool_size=3)
+        self.assertEqual(6, c.parallel)
+        props = BasicProperties(content_type='application/json')
+        msg = amqp.AMQPMessage('"x"', None, props)
+        self.assertEqual(('"x"', 'application/json', None), c._messageData(msg))
+
+
+class _FakeSchemaBuilder(object):
+
+    def __init__(self):
+        self.calls = []
+        self.pending = []
+
+    def _call(self, method, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((method, kwargs))
+        self.pending.append(d)
+        return d
+
+    def declareQueue(self, queue, **kwargs):
+        return self._call('declareQueue', queue=queue, **kwargs)
+
+    def declareExchange(self, exchange, **kwargs):
+        return self._call('declareExchange', exchange=exchange, **kwargs)
+
+    def bindQueue(self, exchange, queue, routing_key='', arguments=None):
+        return self._call('bindQueue', exchange=exchange, queue=queue)
+
+    def bindExchange(self, source, destination, routing_key='', arguments=None):
+        return self._call('bindExchange', source=source, destination=destination)
+
+    def firePending(self):
+        ds, self.pending = self.pending, []
+        for d in ds:
+            d.callback(None)
+        return len(ds)
+
+
+class _FakeSchemaChannel(object):
+
+    is_open = True
+
+    def __init__(self, existing=()):
+        self.calls = []
+        self.existing = set(existing)
+
+    def _call(self, method, name, passive):
+        self.calls.append((method, name, passive))
+        if passive and name not in self.existing:
+            return defer.fail(ChannelClosed(404, "NOT_FOUND"))
+        self.existing.add(name)
+        return defer.succeed(None)
+
+    def queue_declare(self, queue, passive=False, **kwargs):
+        return self._call('queue_declare', queue, passive)
+
+    def exchange_declare(self, exchange, passive=False, **kwargs):
+        return self._call('exchange_declare', exchange, passive)
+
+    def queue_bind(self, queue, exchange, **kwargs):
+        return self._call('queue_bind', (exchange, queue), False)
+
+    def close(self):
+        self.is_open = False
+
+
+class SchemaDeclarationTest(TestCase):
+
+    config = {
+        'exchange': {'e1': {'type': 'fanout'}, 'e2': None},
+        'queue': {'q1': {'durable': True}, 'q2': None, 'tmp': {'auto_delete': True}},
+        'bind': [('e1', 'q1'), {'exchange': 'e2', 'queue': 'q2'}, ('e1', 'tmp')],
+    }
+
+    def test_declare_phases_concurrently(self):
+
+        builder = _FakeSchemaBuilder()
+        d = amqp.schemaFromDict(self.config).declareSchema(builder)
+
+        self.assertEqual(
+            ['declareExchange', 'declareExchange'], [c[0] for c in builder.calls])
+        self.assertEqual(2, builder.firePending())
+        self.assertEqual(3, builder.firePending())
+        self.assertEqual(3, builder.firePending())
+        self.successResultOf(d)
+
+        self.assertEqual(8, len(builder.calls))
+        self.assertIn(('declareExchange', {'exchange': 'e1', 'exchange_type': 'fanout'}), builder.calls)
+        # config is not mutated
+        self.assertEqual({'type': 'fanout'}, self.config['exchange']['e1'])
+
+    def test_first_error_is_propagated(self):
+
+        builder = _FakeSchemaBuilder()
+        d = amqp.schemaFromDict(self.config).declareSchema(builder)
+        builder.pending[1].errback(ChannelClosed(406, "PRECONDITION_FAILED"))
+        self.failureResultOf(d, ChannelClosed)
+
+    def declareWithCache(self, declared, redeclare):
+        builder = _FakeSchemaBuilder()
+        cb = amqp._CachingSchemaBuilder(builder, declared, redeclare)
+        d = amqp.schemaFromDict(self.config).declareSchema(cb)
+        while builder.firePending():
+            pass
+        self.successResultOf(d)
+        return builder, cb
+
+    def test_skip_declared(self):
+
+        declared = set()
+        builder, _ = self.declareWithCache(declared, 'skip')
+        self.assertEqual(8, len(builder.calls))
+
+        builder, cb = self.declareWithCache(declared, 'skip')
+        # auto-deleted queue & its binding are redeclared
+        self.assertEqual([
+            ('declareQueue', {'queue': 'tmp', 'auto_delete': True}),
+            ('bindQueue', {'exchange': 'e1', 'queue': 'tmp'}),
+        ], builder.calls)
+        self.assertEqual(6, cb.skipped)
+
+    def test_passive_verify_declared(self):
+
+        declared = set()
+        self.declareWithCache(declared, 'passive')
+        builder, cb = self.declareWithCache(declared, 'passive')
+
+        self.assertIn(('declareQueue', {'queue': 'q1', 'passive': True}), builder.calls)
+        self.assertIn(
+            ('declareExchange', {'exchange': 'e1', 'exchange_type': 'fanout', 'passive': True}),
+            builder.calls)
+        self.assertEqual(4, cb.verified)
+        self.assertEqual(2, cb.skipped)
+
+    def test_always_redeclare(self):
+        declared = set()
+        self.declareWithCache(declared, 'always')
+        builder, cb = self.declareWithCache(declared, 'always')
+        self.assertEqual(8, len(builder.calls))
+        self.assertEqual(0, cb.skipped)
+
+    def test_redeclare_when_broker_lost_schema(self):
+
+        factory = amqp.AMQPFactory(
+            schema=self.config, schema_channels=1, schema_redeclare='passive')
+
+        p = _offlineProtocol(factory)
+        p._write_channel = _FakeSchemaChannel()
+        self.successResultOf(p._declareSchema())
+        self.assertEqual(6, len(factory.declared_schema))
+
+        # reconnect - just verify
+        existing = p._write_channel.existing
+        p = _offlineProtocol(factory)
+        ch = p._write_channel = _FakeSchemaChannel(existing)
+        self.successResultOf(p._declareSchema())
+        self.assertIn(('queue_declare', 'q1', True), ch.calls)
+        self.assertNotIn(('queue_declare', 'q1', False), ch.calls)
+        self.assertEqual(4, p.counters['schema_verified'])
+
+        # broker restarted - nothing exists
+        p = _offlineProtocol(factory)
+        p._write_channel = _FakeSchemaChannel()
+        ch = _FakeSchemaChannel()
+        p.channel = lambda: defer.succeed(ch)
+        self.successResultOf(p._declareSchema())
+        self.assertEqual(1, p.counters['schema_cache_invalidated'])
+        self.assertIn(('queue_declare', 'q1', False), ch.calls)
+        self.assertEqual([], p._schema_channels)
+        self.assertEqual(6, len(factory.declared_schema))
@@ -0,0 +1,414 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import time
+import collections
+import uuid
+import random
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import msgpack
+
+from twisted.internet import defer, endpoints, reactor
+from twisted.trial.unittest import TestCase, SkipTest
+
+from pika.spec import Basic, BasicProperties
+
+from twoost import amqp, hashring
+from twoost.timed import sleep
+from twoost.tests.amqpbroker import AMQPBroker
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def timeit(fn, number):
+    t0 = time.time()
+    for _ in range(number):
+        fn()
+    return (time.time() - t0) / number
+
+
+def peak_memory(fn):
+    """Returns bytes allocated at peak while `fn` runs (None if can't measure)."""
+    if tracemalloc is None:
+        fn()
+        return None
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def peak_rss(fn):
+    """Returns growth of max RSS while `fn` runs in forked child (None if can't measure).
+
+    Figures depend on allocator & pages inherited from parent, use them for
+    information only.  Result of `fn` is lost.
+    """
+    if resource is None or not hasattr(os, 'fork'):
+        return None
+    return _forked_peak_rss(fn)
+
+
+def _forked_peak_rss(fn):
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            fn()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(w, str(after - before).encode('ascii'))
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    try:
+        data = os.read(r, 64)
+    finally:
+        os.close(r)
+        os.waitpid(pid, 0)
+    if not data:
+        return None
+    # kilobytes on linux, bytes on osx
+    return int(data) * (1 if sys.platform == 'darwin' else 1024)
+
+
+class _FakeConfirmFrame(object):
+
+    def __init__(self, method_name, delivery_tag, multiple=False):
+        self.method = type(method_name, (object,), {})()
+        self.method.delivery_tag = delivery_tag
+        self.method.multiple = multiple
+
+
+class _CountingDeque(collections.deque):
+
+    pops = 0
+
+    def popleft(self):
+        self.pops += 1
+        return collections.deque.popleft(self)
+
+
+class PublishConfirmBenchmark(TestCase):
+
+    confirms = 20000
+
+    def runConfirms(self, window):
+
+        p = amqp._AMQPProtocol({})
+        cc = amqp._ConfirmChannel(None)
+        p._confirm_channels = [cc]
+        tags = [0]
+
+        def publish():
+            tags[0] += 1
+            cc.published.add(tags[0], defer.Deferred())
+
+        for _ in range(window):
+            publish()
+        cc.published._tags = _CountingDeque(cc.published._tags)
+
+        def publish_and_confirm():
+            publish()
+            p._onPublishConfirm(cc, _FakeConfirmFrame('Ack', tags[0] - window, multiple=True))
+
+        cost = timeit(publish_and_confirm, self.confirms)
+        self.assertEqual(window, len(cc.published))
+        logger.info("window %d, confirm cost %.2f us", window, cost * 1e6)
+        return cc.published._tags.pops
+
+    def test_flat_confirm_cost(self):
+        # each multiple-ack confirms one message, it must not scan the window
+        self.assertEqual(self.confirms, self.runConfirms(100))
+        self.assertEqual(self.confirms, self.runConfirms(50000))
+
+
+def make_events(n):
+    return [
+        {
+            'id': uuid.uuid4().hex,
+            'payload': "some event payload #%d " % i * random.randint(1, 10),
+            'created': time.time(),
+            'source': {'host': "webapi-%02d" % (i % 10), 'pid': 10000 + i},
+            'tags': ["tag%d" % t for t in range(i % 5)],
+            'counters': [i, i * 2, i * 3],
+            'flag': bool(i % 2),
+        }
+        for i in range(n)
+    ]
+
+
+class CodecBenchmark(TestCase):
+
+    events = 2000
+    content_types = ['json', 'msgpack']
+
+    def test_codecs(self):
+
+        events = make_events(self.events)
+
+        for ct in self.content_types:
+            try:
+                codec = amqp.get_codec(ct)
+            except KeyError:
+                logger.info("codec %r is not available", ct)
+                continue
+
+            bodies = []
+            t0 = time.time()
+            for e in events:
+                bodies.append(codec.dumps(e))
+            t1 = time.time()
+            decoded = [codec.loads(b) for b in bodies]
+            t2 = time.time()
+
+            self.assertEqual(events, decoded)
+            logger.info(
+                "codec %r: encode %.2f us/msg, decode %.2f us/msg, avg size %d bytes",
+                ct,
+                (t1 - t0) * 1e6 / len(events),
+                (t2 - t1) * 1e6 / len(events),
+                sum(map(len, bodies)) // len(bodies),
+            )
+
+
+class ConsumeOverheadBenchmark(TestCase):
+
+    messages = 20000
+
+    def test_message_overhead(self):
+
+        deliver = Basic.Deliver(
+            consumer_tag='ct', delivery_tag=1, exchange='e', routing_key='rk')
+        props = BasicProperties(content_type='json', headers={'x': 1})
+        body = amqp.serialize({'id': 1, 'payload': "x" * 100}, 'json')
+        consumer = amqp._QueueConsumer('q', lambda data: None)
+
+        def consume():
+            msg = amqp.AMQPMessage(body=body, deliver=deliver, properties=props)
+            msg.routing_key, msg.delivery_tag, msg.content_type, msg.headers
+            consumer.onMessage(msg)
+
+        def fields():
+            msg = amqp.AMQPMessage(body=body, deliver=deliver, properties=props)
+            msg.routing_key, msg.delivery_tag, msg.content_type, msg.headers
+
+        consume_cost = timeit(consume, self.messages)
+        fields_cost = timeit(fields, self.messages)
+        logger.info(
+            "consume overhead %.2f us/msg (message & fields %.2f us/msg)",
+            consume_cost * 1e6, fields_cost * 1e6)
+
+
+class _BrokerBenchmark(TestCase):
+
+    """Publish & consume via real `_AMQPProtocol` and in-process broker."""
+
+    queue = 'bench_amqp_queue'
+    prefetch_count = 500
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.broker = AMQPBroker()
+        self.port = reactor.listenTCP(0, self.broker, interface='127.0.0.1')
+        endpoint = endpoints.TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.port.getHost().port)
+        factory = amqp.AMQPFactory(
+            schema={'queue': {self.queue: None}}, prefetch_count=self.prefetch_count)
+        self.client = amqp.AMQPService(endpoint, factory)
+        self.client.startService()
+        while not (self.broker.connections and self.queue in self.broker.queues):
+            yield sleep(0.01)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.stopService()
+        self.broker.dropConnections()
+        yield self.port.stopListening()
+        yield sleep(0)
+
+
+class BrokerThroughputBenchmark(_BrokerBenchmark):
+
+    messages = 5000
+
+    @defer.inlineCallbacks
+    def test_publish_and_consume(self):
+
+        events = make_events(self.messages)
+
+        t0 = time.time()
+        yield defer.gatherResults([
+            self.client.publishMessage(
+                exchange='', routing_key=self.queue, body=e,
+                content_type='json', confirm=True)
+            for e in events
+        ])
+        t1 = time.time()
+        self.assertEqual(self.messages, self.broker.messageCount(self.queue))
+
+        received = []
+        done = defer.Deferred()
+
+        def rcv(data):
+            received.append(data)
+            if len(received) == self.messages:
+                done.callback(None)
+
+        consumer = self.client.setupQueueConsuming(self.queue, rcv, parallel=100)
+        yield done
+        t2 = time.time()
+        yield consumer.stopService()
+
+        self.assertEqual(events, received)
+        logger.info(
+            "broker roundtrip: publish (confirmed) %d msg/s, consume %d msg/s",
+            self.messages / (t1 - t0), self.messages / (t2 - t1))
+
+
+class HashRingBenchmark(TestCase):
+
+    lookups = 20000
+
+    def test_lookup_cost(self):
+
+        keys = ["user:%d:profile" % i for i in range(self.lookups)]
+
+        for servers in [2, 10, 100]:
+            ring = hashring.HashRing(["mc%d" % i for i in range(servers)])
+            it = iter(keys)
+            cost = timeit(lambda: ring.getNode(next(it)), self.lookups)
+            logger.info(
+                "hash ring of %d servers (%d points): lookup %.2f us",
+                servers, len(ring._points), cost * 1e6)
+
+
+def make_large_body(size, record_size=1024):
+    # stream of msgpack records, which may be decoded one by one
+    record = msgpack.packb({'id': 0, 'payload': "x" * record_size})
+    return record * (size // len(record))
+
+
+def split_frames(body, frame_size=131064):
+    return [body[i:i + frame_size] for i in range(0, len(body), frame_size)]
+
+
+class LargeMessageBenchmark(TestCase):
+
+    size = 10 << 20
+
+    def setUp(self):
+        self.body = make_large_body(self.size)
+        self.fragments = split_frames(self.body)
+        self.deliver = Basic.Deliver(
+            consumer_tag='ct', delivery_tag=1, exchange='e', routing_key='rk')
+        self.props = BasicProperties(content_type='msgpack')
+
+    def buffered(self):
+        # what consumer without `stream` does - join frames & decode whole body
+        msg = amqp.AMQPMessage(
+            body=b''.join(self.fragments), deliver=self.deliver, properties=self.props)
+        u = msgpack.Unpacker(max_buffer_size=0)
+        u.feed(msg.body)
+        return sum(1 for _ in u)
+
+    def streamed(self):
+        msg = amqp.AMQPStreamMessage(self.fragments, self.deliver, self.props)
+        return sum(1 for _ in msg.iterObjects())
+
+    def test_decode_memory(self):
+
+        rss = tracemalloc is None and os.environ.get('TWOOST_TEST_BENCH_RSS')
+        if rss:
+            # opt-in, forks test runner; measure first - freed memory
+            # of earlier runs would be reused by child
+            logger.info(
+                "%d MB message: buffered max rss +%s bytes, streamed max rss +%s bytes",
+                self.size >> 20, peak_rss(self.buffered), peak_rss(self.streamed))
+
+        buffered_cost = timeit(self.buffered, 3)
+        streamed_cost = timeit(self.streamed, 3)
+        self.assertEqual(self.buffered(), self.streamed())
+
+        buffered_peak = peak_memory(self.buffered)
+        streamed_peak = peak_memory(self.streamed)
+        logger.info(
+            "%d MB message: buffered %.1f ms, peak %s bytes; streamed %.1f ms, peak %s bytes",
+            self.size >> 20, buffered_cost * 1e3, buffered_peak,
+            streamed_cost * 1e3, streamed_peak)
+
+        if buffered_peak is None:
+            if rss:
+                return
+            raise SkipTest("tracemalloc is not available, set TWOOST_TEST_BENCH_RSS=1 "
+                           "to log max rss instead")
+        self.assertTrue(
+            streamed_peak * 4 < buffered_peak,
+            "streamed decoding uses %d bytes vs %d" % (streamed_peak, buffered_peak))
+
+
+class LargeMessageBrokerBenchmark(_BrokerBenchmark):
+
+    messages = 5
+    size = 10 << 20
+    prefetch_count = 2
+
+    @defer.inlineCallbacks
+    def consume(self, stream):
+
+        body = make_large_body(self.size)
+        yield defer.gatherResults([
+            self.client.publishMessage(
+                exchange='', routing_key=self.queue, body=body, confirm=True)
+            for _ in range(self.messages)
+        ])
+
+        received = []
+        done = defer.Deferred()
+
+        def rcv(msg):
+            u = msgpack.Unpacker(max_buffer_size=0)
+            n = 0
+            for c in (msg.chunks if stream else [msg.body]):
+                u.feed(c)
+                n += sum(1 for _ in u)
+            received.append(n)
+            if len(received) == self.messages:
+                done.callback(None)
+
+        t0 = time.time()
+        consumer = self.client.setupQueueConsuming(
+            self.queue, rcv, deserialize=False, stream=stream)
+        yield done
+        t1 = time.time()
+        yield consumer.stopService()
+
+        self.assertEqual(1, len(set(received)))
+        defer.returnValue((t1 - t0) / self.messages)
+
+    @defer.inlineCallbacks
+    def test_stream_consuming(self):
+        buffered_cost = yield self.consume(stream=False)
+        streamed_cost = yield self.consume(stream=True)
+        logger.info(
+            "%d MB messages via broker: buffered %.1f ms/msg, streamed %.1f ms/msg",
+            self.size >> 20, buffered_cost * 1e3, streamed_cost * 1e3)
@@ -0,0 +1,65 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from twoost import cache
+
+
+class LRUCacheTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_lru_eviction(self):
+
+        c = cache.LRUCache(max_size=2, clock=self.clock)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(1, c.get('a'))
+        c.set('c', 3)
+
+        self.assertEqual(2, len(c))
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+        self.assertEqual(3, c.get('c'))
+
+    def test_ttl(self):
+
+        c = cache.LRUCache(ttl=10, clock=self.clock)
+        c.set('a', 1)
+        c.set('b', 2, ttl=20)
+
+        self.clock.advance(10)
+        self.assertIdentical(None, c.get('a'))
+        self.assertEqual('x', c.get('a', 'x'))
+        self.assertEqual(2, c.get('b'))
+        self.assertEqual(1, len(c))
+
+    def test_delete(self):
+        c = cache.LRUCache(clock=self.clock)
+        c.set('a', 1)
+        self.assertTrue(c.delete('a'))
+        self.assertFalse(c.delete('a'))
+        self.assertNotIn('a', c)
+
+    def test_max_bytes(self):
+
+        c = cache.LRUCache(max_bytes=10, clock=self.clock)
+        c.set('a', b"xxxx")
+        c.set('b', b"yyyy")
+        c.set('a', b"zz")
+        self.assertEqual(6, c.bytes)
+
+        c.set('c', b"wwwww")
+        self.assertNotIn('b', c)
+        self.assertEqual([b"zz", b"wwwww"], [c.get('a'), c.get('c')])
+        self.assertEqual(7, c.bytes)
+
+        # too big value is kept alone
+        c.set('d', b"v" * 20)
+        self.assertEqual(1, len(c))
+        c.clear()
+        self.assertEqual(0, c.bytes)
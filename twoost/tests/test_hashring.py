@@ -0,0 +1,51 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+import collections
+
+from twisted.trial.unittest import TestCase
+
+from twoost.hashring import HashRing
+
+
+def keys(n):
+    return ["key:%d" % i for i in range(n)]
+
+
+class HashRingTest(TestCase):
+
+    def distribution(self, ring, ks):
+        return collections.Counter(ring.getNode(k) for k in ks)
+
+    def test_balance(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        d = self.distribution(ring, keys(20000))
+        self.assertEqual(set('abcd'), set(d))
+        for n in d.values():
+            self.assertTrue(3500 < n < 6500, d)
+
+    def test_weights(self):
+        ring = HashRing({'a': 1, 'b': 3})
+        d = self.distribution(ring, keys(20000))
+        self.assertTrue(2.3 < d['b'] / d['a'] < 3.8, d)
+
+    def test_add_node_remaps_few_keys(self):
+        ks = keys(10000)
+        r1 = HashRing(['a', 'b', 'c', 'd'])
+        r2 = HashRing(['a', 'b', 'c', 'd', 'e'])
+        moved = [k for k in ks if r1.getNode(k) != r2.getNode(k)]
+        # only keys of new node are moved
+        self.assertTrue(len(moved) < len(ks) * 0.3, len(moved))
+        self.assertEqual({'e'}, set(r2.getNode(k) for k in moved))
+
+    def test_iter_nodes(self):
+        ring = HashRing(['a', 'b', 'c'])
+        for k in keys(100):
+            nodes = list(ring.iterNodes(k))
+            self.assertEqual(ring.getNode(k), nodes[0])
+            self.assertEqual(['a', 'b', 'c'], sorted(nodes))
+
+    def test_unicode_keys(self):
+        ring = HashRing(['a', 'b'])
+        self.assertEqual(ring.getNode(u"ключ".encode('utf-8')), ring.getNode(u"ключ"))
@@ -3,14 +3,16 @@
 from __future__ import print_function, division, absolute_import
 
 import uuid
+import datetime
 
 from binascii import crc32
 
-from twisted.internet import defer, error
+from twisted.internet import defer, error, task
+from twisted.protocols.memcache import ClientError
 from twisted.application.service import Application, IService
 from twisted.trial.unittest import TestCase
 
-from twoost import app, conf, timed, pclient
+from twoost import app, conf, timed, pclient, memcache
 
 
 def gr(n):
@@ -118,3 +120,519 @@ class MemcacheTestCase(TestCase):
         self.assertEqual(expected_vs, vs)
         self.assertTrue(vs0)
         self.assertTrue(len(vs0) < len(vs))
+
+
+class RingResolverTest(TestCase):
+
+    def setUp(self):
+        self.memcache = memcache.MemCacheCollectionService({
+            'c0': {'host': 'localhost'},
+            'c1': {'host': 'localhost', 'weight': 2},
+            'c2': {'host': 'localhost'},
+        })
+        for name in ['c0', 'c1', 'c2']:
+            self.setConnected(name, True)
+
+    def setConnected(self, name, connected):
+        s = self.memcache[name]
+        s._protocol = object() if connected else None
+        s._protocol_ready = connected
+
+    def test_weights(self):
+        self.assertEqual({'c0': 1, 'c1': 2, 'c2': 1}, self.memcache.ring.nodes)
+
+    def test_failover(self):
+
+        resolve = self.memcache.ringResolver()
+        keys = gr(300)
+        before = dict((k, resolve(k)) for k in keys)
+        self.assertEqual({'c0', 'c1', 'c2'}, set(before.values()))
+
+        self.setConnected('c1', False)
+        during = dict((k, resolve(k)) for k in keys)
+        self.assertNotIn('c1', during.values())
+        for k in keys:
+            if before[k] != 'c1':
+                self.assertEqual(before[k], during[k])
+
+        self.setConnected('c1', True)
+        self.assertEqual(before, dict((k, resolve(k)) for k in keys))
+
+    def test_nothing_connected(self):
+        ring = self.memcache.ring
+        resolve = self.memcache.ringResolver()
+        for name in ['c0', 'c1', 'c2']:
+            self.setConnected(name, False)
+        for k in gr(20):
+            self.assertEqual(ring.getNode(k), resolve(k))
+
+    def test_multi_client(self):
+        m = self.memcache.multiClient()
+        self.assertEqual(self.memcache.ring.getNode('key'), m.resolveClientNameByKey('key'))
+
+
+class _FakeClient(object):
+
+    reconnect_delay = 5
+
+    def __init__(self, connected=True):
+        self.protocol = object() if connected else None
+        self.calls = []
+
+    def protocolCall(self, method_name, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((method_name, args, d))
+        return d
+
+
+class PoolTest(TestCase):
+
+    def setUp(self):
+        self.clients = [_FakeClient(), _FakeClient(), _FakeClient(connected=False)]
+        self.pool = memcache.MemCachePoolService(
+            self.clients, memcache.MemCacheCollectionService.protocolProxiedMethods)
+
+    def test_least_outstanding(self):
+        c0, c1, c2 = self.clients
+
+        d1 = self.pool.get('k1')
+        self.pool.get('k2')
+        self.pool.get('k3')
+        self.assertEqual((2, 1, 0), tuple(len(c.calls) for c in self.clients))
+
+        c0.calls[0][2].callback((0, 'v1'))
+        self.assertEqual((0, 'v1'), self.successResultOf(d1))
+        self.pool.get('k4')
+        self.assertEqual(3, len(c0.calls))
+        self.assertEqual({'pool_size': 3, 'connected': 2, 'outstanding': 3, 'calls': 4},
+                         self.pool.poolStats())
+
+    def test_health(self):
+        self.assertEqual("2 of 3 connections", self.pool.checkHealth())
+        for c in self.clients:
+            c.protocol = None
+        self.assertRaises(Exception, self.pool.checkHealth)
+
+    def test_not_connected(self):
+        for c in self.clients:
+            c.protocol = None
+        self.pool.get('k1')
+        self.pool.get('k2')
+        self.assertEqual((1, 1, 0), tuple(len(c.calls) for c in self.clients))
+
+    def test_collection(self):
+        mc = memcache.MemCacheCollectionService({
+            'c0': {'host': 'localhost', 'pool_size': 4},
+            'c1': {'host': 'localhost'},
+        })
+        self.assertIsInstance(mc['c0'], memcache.MemCachePoolService)
+        self.assertEqual(4, len(mc['c0'].clients))
+        self.assertIsInstance(mc['c1'], pclient.PersistentClientService)
+        stats = mc.poolStats()
+        self.assertEqual(4, stats['c0']['pool_size'])
+        self.assertEqual(1, stats['c1']['pool_size'])
+
+
+class _FakeMultiGetClient(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def getMultiple(self, keys):
+        d = defer.Deferred()
+        self.requests.append((keys, d))
+        return d
+
+    def set(self, key, value):
+        return defer.succeed(True)
+
+
+class CoalescingTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.mc = _FakeMultiGetClient()
+        self.client = memcache.CoalescingMemCacheClient(self.mc, clock=self.clock)
+
+    def test_same_tick_batching(self):
+
+        d1 = self.client.get('k1')
+        d2 = self.client.get('k2')
+        d3 = self.client.get('k1')
+        self.assertEqual([], self.mc.requests)
+
+        self.clock.advance(0)
+        self.assertEqual([['k1', 'k2']], [ks for ks, _ in self.mc.requests])
+
+        # in-flight key is shared too
+        d4 = self.client.get('k2')
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.mc.requests))
+
+        self.mc.requests[0][1].callback({'k1': (0, 'v1'), 'k2': (0, None)})
+        self.assertEqual((0, 'v1'), self.successResultOf(d1))
+        self.assertEqual((0, None), self.successResultOf(d2))
+        self.assertEqual((0, 'v1'), self.successResultOf(d3))
+        self.assertEqual((0, None), self.successResultOf(d4))
+        self.assertEqual(
+            {'gets': 4, 'coalesced': 2, 'batches': 1, 'batched_keys': 2},
+            dict(self.client.counters))
+
+        self.client.get('k1')
+        self.clock.advance(0)
+        self.assertEqual(2, len(self.mc.requests))
+
+    def test_get_multiple(self):
+        d = self.client.getMultiple(['a', 'b'])
+        self.clock.advance(0)
+        self.mc.requests[0][1].callback({'a': (0, '1'), 'b': (0, '2')})
+        self.assertEqual({'a': (0, '1'), 'b': (0, '2')}, self.successResultOf(d))
+
+    def test_per_server_batches(self):
+
+        servers = {'c0': _FakeMultiGetClient(), 'c1': _FakeMultiGetClient()}
+        mc = memcache._MemCacheMultiClientProxy(servers, lambda k: 'c%s' % (int(k) % 2))
+        client = memcache.CoalescingMemCacheClient(mc, clock=self.clock)
+
+        ds = dict((k, client.get(k)) for k in ['1', '2', '3', '4'])
+        self.clock.advance(0)
+        self.assertEqual(['2', '4'], servers['c0'].requests[0][0])
+        self.assertEqual(['1', '3'], servers['c1'].requests[0][0])
+
+        servers['c0'].requests[0][1].callback({'2': (0, 'x'), '4': (0, 'y')})
+        servers['c1'].requests[0][1].errback(error.ConnectionClosed())
+        self.assertEqual((0, 'y'), self.successResultOf(ds['4']))
+        self.failureResultOf(ds['1'], error.ConnectionClosed)
+        self.failureResultOf(ds['3'], error.ConnectionClosed)
+
+    def test_bad_key_fails_alone(self):
+
+        d1 = self.client.get('k1')
+        d2 = self.client.get('x' * 251)
+        d3 = self.client.get(u'k2')
+        d4 = self.client.get('k 3')
+        self.clock.advance(0)
+        self.assertEqual([['k1']], [ks for ks, _ in self.mc.requests])
+
+        self.mc.requests[0][1].callback({'k1': (0, 'v1')})
+        self.assertEqual((0, 'v1'), self.successResultOf(d1))
+        for d in [d2, d3, d4]:
+            self.failureResultOf(d, ClientError)
+
+    def test_resolve_error(self):
+
+        servers = {'c0': _FakeMultiGetClient()}
+
+        def resolve(k):
+            if k == 'bad':
+                raise KeyError(k)
+            return 'c1' if k == 'lost' else 'c0'
+
+        mc = memcache._MemCacheMultiClientProxy(servers, resolve)
+        client = memcache.CoalescingMemCacheClient(mc, clock=self.clock)
+
+        ds = dict((k, client.get(k)) for k in ['ok', 'bad', 'lost'])
+        self.clock.advance(0)
+        self.assertEqual([['ok']], [ks for ks, _ in servers['c0'].requests])
+        self.failureResultOf(ds['bad'], KeyError)
+        self.failureResultOf(ds['lost'], ValueError)
+        self.assertEqual(['ok'], list(client._waiters))
+
+    def test_max_batch_size(self):
+        self.client.max_batch_size = 2
+        for k in 'abcde':
+            self.client.get(k)
+        self.clock.advance(0)
+        self.assertEqual([['a', 'b'], ['c', 'd'], ['e']], [ks for ks, _ in self.mc.requests])
+
+    def test_passthrough(self):
+        self.assertTrue(self.successResultOf(self.client.set('k', 'v')))
+
+
+class _FakeMemCache(object):
+
+    def __init__(self):
+        self.data = {}
+        self.gets = []
+
+    def get(self, key):
+        d = defer.Deferred()
+        self.gets.append((key, d))
+        return d
+
+    def answer(self, i=0):
+        key, d = self.gets.pop(i)
+        d.callback(self.data.get(key, (0, None)))
+
+    def set(self, key, val, flags=0, expireTime=0):
+        self.data[key] = flags, val
+        return defer.succeed(True)
+
+    def delete(self, key):
+        return defer.succeed(self.data.pop(key, None) is not None)
+
+
+class TwoTierTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.mc = _FakeMemCache()
+        self.client = memcache.TwoTierMemCacheClient(
+            self.mc, ttl=10, stale_ttl=5, negative_ttl=2, clock=self.clock)
+
+    def test_hits(self):
+
+        self.mc.data['k'] = 1, 'v'
+        d1 = self.client.get('k')
+        d2 = self.client.get('k')
+        self.assertEqual(1, len(self.mc.gets))
+        self.mc.answer()
+        self.assertEqual((1, 'v'), self.successResultOf(d1))
+        self.assertEqual((1, 'v'), self.successResultOf(d2))
+
+        self.assertEqual((1, 'v'), self.successResultOf(self.client.get('k')))
+        self.assertEqual([], self.mc.gets)
+
+        m = self.client.getMetrics()
+        self.assertEqual((1, 2, 1, 1), (m['hits'], m['misses'], m['coalesced'], m['fetches']))
+        self.assertEqual(1 / 3, m['hit_ratio'])
+
+    def test_stale_while_refresh(self):
+
+        self.mc.data['k'] = 0, 'v1'
+        self.client.get('k')
+        self.mc.answer()
+        self.mc.data['k'] = 0, 'v2'
+
+        self.clock.advance(11)
+        # stale value is returned, only one refresh is started
+        self.assertEqual((0, 'v1'), self.successResultOf(self.client.get('k')))
+        self.assertEqual((0, 'v1'), self.successResultOf(self.client.get('k')))
+        self.assertEqual(1, len(self.mc.gets))
+        self.mc.answer()
+        self.assertEqual((0, 'v2'), self.successResultOf(self.client.get('k')))
+
+        # too old
+        self.clock.advance(16)
+        d = self.client.get('k')
+        self.assertNoResult(d)
+
+    def test_negative_caching(self):
+        d = self.client.get('k')
+        self.mc.answer()
+        self.assertEqual((0, None), self.successResultOf(d))
+        self.assertEqual((0, None), self.successResultOf(self.client.get('k')))
+        self.assertEqual(1, self.client.getMetrics()['negative_hits'])
+        self.clock.advance(8)
+        self.assertNoResult(self.client.get('k'))
+
+    def test_write_through(self):
+
+        self.successResultOf(self.client.set('k', 'v', flags=3))
+        self.assertEqual((3, 'v'), self.successResultOf(self.client.get('k')))
+
+        self.successResultOf(self.client.delete('k'))
+        self.assertNoResult(self.client.get('k'))
+        self.assertEqual(None, self.mc.data.get('k'))
+
+    def test_invalidate_on_set(self):
+
+        self.client.write = 'invalidate'
+        self.mc.data['k'] = 0, 'v1'
+        self.client.get('k')
+        self.mc.answer()
+
+        self.successResultOf(self.client.set('k', 'v2'))
+        d = self.client.get('k')
+        self.mc.answer()
+        self.assertEqual((0, 'v2'), self.successResultOf(d))
+
+    def test_set_during_fetch(self):
+
+        self.mc.data['k'] = 0, 'old'
+        d = self.client.get('k')
+        key, fetch = self.mc.gets.pop()
+        self.successResultOf(self.client.set('k', 'new'))
+        fetch.callback((0, 'old'))
+        self.assertEqual((0, 'old'), self.successResultOf(d))
+        self.assertEqual((0, 'new'), self.successResultOf(self.client.get('k')))
+
+    def test_fetch_error(self):
+        d1 = self.client.get('k')
+        d2 = self.client.get('k')
+        self.mc.gets.pop()[1].errback(error.ConnectionClosed())
+        self.failureResultOf(d1, error.ConnectionClosed)
+        self.failureResultOf(d2, error.ConnectionClosed)
+        self.assertNoResult(self.client.get('k'))
+
+
+class _DictMemCache(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return defer.succeed(self.data.get(key, (0, None)))
+
+    def getMultiple(self, keys):
+        return defer.succeed(dict((k, self.data.get(k, (0, None))) for k in keys))
+
+    def set(self, key, val, flags=0, expireTime=0):
+        self.data[key] = flags, val
+        return defer.succeed(True)
+
+    def add(self, key, val, flags=0, expireTime=0):
+        if key in self.data:
+            return defer.succeed(False)
+        return self.set(key, val, flags)
+
+    def delete(self, key):
+        return defer.succeed(self.data.pop(key, None) is not None)
+
+
+_clock = task.Clock()
+
+
+class _Dao(object):
+
+    def __init__(self, memcache):
+        self.memcache = memcache
+        self.calls = []
+        self.pending = None
+
+    @memcache.cached(lambda x: x, ttl=60, tags=lambda x: ['tag:%s' % x], clock=_clock)
+    def compute(self, x):
+        self.calls.append(x)
+        return {'x': x, 'created': datetime.datetime(2014, 1, 2, 3, 4, 5, 6)}
+
+    @memcache.cached(lambda x: x, ttl=60, clock=_clock)
+    def slow(self, x):
+        self.calls.append(x)
+        self.pending = defer.Deferred()
+        return self.pending
+
+    @memcache.cached(lambda x: x, ttl=60, lock_timeout=1, lock_poll=0.1, clock=_clock)
+    def locked(self, x):
+        self.calls.append(x)
+        return x * 2
+
+
+class _OtherDao(_Dao):
+
+    @memcache.cached(lambda x: x, ttl=60, clock=_clock)
+    def slow(self, x):
+        self.calls.append(x)
+        return 'other'
+
+
+class CachedTest(TestCase):
+
+    def setUp(self):
+        self.mc = _DictMemCache()
+        self.dao = _Dao(self.mc)
+
+    def test_cache_aside(self):
+        r1 = self.successResultOf(self.dao.compute(1))
+        r2 = self.successResultOf(self.dao.compute(1))
+        self.assertEqual(r1, r2)
+        self.assertEqual(datetime.datetime(2014, 1, 2, 3, 4, 5, 6), r2['created'])
+        self.assertEqual([1], self.dao.calls)
+
+        self.successResultOf(self.dao.compute.invalidate(1))
+        self.successResultOf(self.dao.compute(1))
+        self.assertEqual([1, 1], self.dao.calls)
+
+    def test_tags(self):
+        self.successResultOf(self.dao.compute(1))
+        self.successResultOf(self.dao.compute(2))
+        self.successResultOf(memcache.invalidate_tags(self.mc, ['tag:1']))
+        self.successResultOf(self.dao.compute(1))
+        self.successResultOf(self.dao.compute(2))
+        self.assertEqual([1, 2, 1], self.dao.calls)
+
+    def test_single_flight(self):
+        d1 = self.dao.slow(1)
+        d2 = self.dao.slow(1)
+        self.assertEqual([1], self.dao.calls)
+        self.dao.pending.callback('v')
+        self.assertEqual('v', self.successResultOf(d1))
+        self.assertEqual('v', self.successResultOf(d2))
+
+    def test_early_refresh(self):
+        d = self.dao.slow(1)
+        _clock.advance(1)  # computation took 1 second
+        self.dao.pending.callback('v')
+        self.successResultOf(d)
+
+        _clock.advance(1)
+        self.assertEqual('v', self.successResultOf(self.dao.slow(1)))
+        self.assertEqual(1, len(self.dao.calls))
+
+        _clock.advance(59)  # expired
+        self.dao.slow(1)
+        self.assertEqual(2, len(self.dao.calls))
+        # old value is returned while refresh is in progress
+        self.assertEqual('v', self.successResultOf(self.dao.slow(1)))
+        self.dao.pending.callback('v2')
+        self.assertEqual('v2', self.successResultOf(self.dao.slow(1)))
+
+    def test_early_refresh_probability(self):
+        m = type(self.dao).slow
+        expire_at = _clock.seconds() + 10
+        refreshed = sum(1 for _ in range(1000) if not m._isFresh(expire_at, 5))
+        # P(5 * Exp(1) >= 10) ~ 0.135
+        self.assertTrue(50 < refreshed < 250, refreshed)
+        self.assertTrue(all(m._isFresh(expire_at, 0) for _ in range(100)))
+
+    def test_lock(self):
+        key = type(self.dao).locked.key(3)
+        self.mc.data[b"lock:" + key] = 0, "1"
+        d = self.dao.locked(3)
+        self.assertNoResult(d)
+
+        # other process stored value
+        self.mc.data[key] = 0, memcache._packCached([33, _clock.seconds() + 60, 0, []])
+        _clock.advance(0.1)
+        self.assertEqual(33, self.successResultOf(d))
+        self.assertEqual([], self.dao.calls)
+
+        # lock is expired
+        del self.mc.data[key]
+        d = self.dao.locked(3)
+        _clock.pump([0.1] * 11)
+        self.assertEqual(6, self.successResultOf(d))
+
+    def test_lock_ignores_stale_value(self):
+        key = type(self.dao).locked.key(4)
+        self.mc.data[b"lock:" + key] = 0, "1"
+        d = self.dao.locked(4)
+
+        # expired or invalidated values aren't returned, keep waiting
+        self.mc.data[key] = 0, memcache._packCached([1, _clock.seconds() - 1, 0, []])
+        _clock.advance(0.1)
+        self.assertNoResult(d)
+        self.mc.data[key] = 0, memcache._packCached([2, _clock.seconds() + 60, 0, ['old']])
+        _clock.advance(0.1)
+        self.assertNoResult(d)
+
+        self.mc.data[key] = 0, memcache._packCached([44, _clock.seconds() + 60, 0, []])
+        _clock.advance(0.1)
+        self.assertEqual(44, self.successResultOf(d))
+        self.assertEqual([], self.dao.calls)
+
+    def test_same_method_names(self):
+        other = _OtherDao(self.mc)
+        self.assertEqual('other', self.successResultOf(other.slow(1)))
+        d = self.dao.slow(1)
+        self.assertNoResult(d)
+        self.dao.pending.callback('v')
+        self.assertEqual('v', self.successResultOf(d))
+        self.assertEqual('other', self.successResultOf(other.slow(1)))
+        # inherited method still uses keys of base class
+        self.assertEqual(type(self.dao).locked.key(1), type(other).locked.key(1))
+
+    def test_no_memcache(self):
+        dao = _Dao(None)
+        self.successResultOf(dao.compute(1))
+        self.successResultOf(dao.compute(1))
+        self.assertEqual([1, 1], dao.calls)
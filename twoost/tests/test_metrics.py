@@ -0,0 +1,41 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+from twisted.trial.unittest import TestCase
+
+from twoost import metrics
+
+
+class HistogramTest(TestCase):
+
+    def test_empty(self):
+        h = metrics.Histogram()
+        self.assertEqual(
+            {'count': 0, 'mean': None, 'max': None, 'p50': None, 'p99': None},
+            h.snapshot(quantiles=(0.5, 0.99)))
+
+    def test_quantiles(self):
+
+        h = metrics.Histogram()
+        for i in range(1, 1001):
+            h.add(i / 1000)
+
+        self.assertEqual(1000, h.count)
+        self.assertAlmostEqual(0.5005, h.snapshot()['mean'])
+        self.assertEqual(1.0, h.max)
+        for q in [0.5, 0.9, 0.99]:
+            self.assertTrue(abs(h.quantile(q) - q) / q < 0.15, (q, h.quantile(q)))
+        self.assertEqual(1.0, h.quantile(1))
+
+    def test_out_of_range(self):
+
+        h = metrics.Histogram(min_value=0.01, max_value=10)
+        h.add(0)
+        h.add(1000)
+        self.assertEqual(0.01, h.quantile(0.5))
+        self.assertEqual(1000, h.quantile(1))
+
+        h.reset()
+        self.assertEqual(0, h.count)
+        self.assertIdentical(None, h.quantile(0.5))
@@ -0,0 +1,142 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+import os
+
+from twisted.trial.unittest import TestCase
+
+from twoost import spool
+
+
+class SegmentSpoolTest(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def open(self, **kwargs):
+        s = spool.SegmentSpool(self.path, **kwargs)
+        self.addCleanup(s.close)
+        return s
+
+    def readAll(self, s):
+        items = []
+        while 1:
+            r = s.read()
+            if r is None:
+                return items
+            items.append(r)
+
+    def segments(self):
+        return sorted(n for n in os.listdir(self.path) if n.endswith('.seg'))
+
+    def test_fifo(self):
+
+        s = self.open()
+        for i in range(5):
+            s.append(b"msg%d" % i)
+        self.assertEqual(5, len(s))
+
+        items = self.readAll(s)
+        self.assertEqual([b"msg%d" % i for i in range(5)], [d for _, d in items])
+        self.assertIsNone(s.read())
+
+        for pos, _ in items:
+            s.ack(pos)
+        self.assertEqual(0, len(s))
+        self.assertEqual(0, s.size)
+
+    def test_rewind(self):
+
+        s = self.open()
+        s.append(b"a")
+        s.append(b"b")
+        s.append(b"c")
+
+        items = self.readAll(s)
+        s.ack(items[1][0])  # out of order
+        s.rewind()
+
+        self.assertEqual([b"a", b"c"], [d for _, d in self.readAll(s)])
+        self.assertEqual(3, len(s))
+        s.ack(items[0][0])
+        self.assertEqual(1, len(s))
+
+    def test_reopen(self):
+
+        s = spool.SegmentSpool(self.path)
+        for i in range(3):
+            s.append(b"msg%d" % i)
+        pos, _ = s.read()
+        s.ack(pos)
+        s.read()  # read, but not acked
+        s.close()
+
+        s = self.open()
+        self.assertEqual(2, len(s))
+        self.assertEqual([b"msg1", b"msg2"], [d for _, d in self.readAll(s)])
+
+    def test_broken_tail(self):
+
+        s = spool.SegmentSpool(self.path)
+        s.append(b"good")
+        s.append(b"broken")
+        s.close()
+
+        fn = os.path.join(self.path, self.segments()[0])
+        with open(fn, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(b"broken"))
+            f.write(b"BROKEN")
+
+        s = self.open()
+        self.assertEqual([b"good"], [d for _, d in self.readAll(s)])
+        s.append(b"next")
+        self.assertEqual([b"next"], [d for _, d in self.readAll(s)])
+
+    def test_segments_rotation(self):
+
+        s = self.open(segment_size=64)
+        for i in range(10):
+            s.append(b"x" * 20)
+        self.assertTrue(len(self.segments()) > 3)
+
+        # big record gets own segment
+        s.append(b"y" * 200)
+        items = self.readAll(s)
+        self.assertEqual(b"y" * 200, items[-1][1])
+
+        for pos, _ in items:
+            s.ack(pos)
+        self.assertEqual(1, len(self.segments()))
+        self.assertEqual(0, len(s))
+
+        s.append(b"z")
+        self.assertEqual([b"z"], [d for _, d in self.readAll(s)])
+        self.assertEqual(1, len(self.segments()))
+
+    def test_max_size(self):
+
+        s = self.open(segment_size=64, max_size=100)
+        s.append(b"x" * 40)
+        s.append(b"x" * 40)
+        self.assertRaises(spool.SpoolFull, s.append, b"x" * 40)
+
+        pos, _ = s.read()
+        s.ack(pos)
+        s.append(b"x" * 40)
+        self.assertEqual(2, len(s))
+
+    def test_drain_and_fill(self):
+
+        s = self.open(segment_size=100)
+        s.append(b"x" * 60)
+        pos, _ = s.read()
+        s.ack(pos)
+        self.assertIsNone(s.read())
+
+        # only segment is full - it's replaced by new one
+        s.append(b"a" * 60)
+        s.append(b"b")
+        self.assertEqual(2, len(s))
+        self.assertEqual([b"a" * 60, b"b"], [d for _, d in self.readAll(s)])
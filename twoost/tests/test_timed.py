@@ -2,7 +2,7 @@
 
 from __future__ import print_function, division, absolute_import
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial.unittest import TestCase
 
 from twoost import timed
@@ -57,3 +57,140 @@ class TimeoutTest(TestCase):
 
         self.assertEqual(0, self.cnt)
         self.assertEqual(3, self.max_cnt)
+
+
+class TimerWheelTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timed.TimerWheel(tick=0.1, wheel_size=8, clock=self.clock)
+        self.fired = []
+
+    def test_coalesce_timers(self):
+
+        runs = []
+
+        def runner(fn, timers):
+            runs.append(len(timers))
+            return fn(timers)
+
+        self.wheel.runner = runner
+        for i in range(100):
+            self.wheel.callLater(0.25, self.fired.append, i)
+        self.wheel.callLater(0.27, self.fired.append, 100)
+
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.assertEqual(101, len(self.wheel))
+
+        self.clock.advance(0.249)
+        self.assertEqual([], self.fired)
+        self.clock.advance(0.001)
+        self.assertEqual(list(range(100)), self.fired)
+        self.assertEqual(1, len(self.wheel))
+        self.clock.advance(0.02)
+        self.assertEqual(list(range(101)), self.fired)
+        self.assertEqual([100, 1], runs)
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_exact_deadline(self):
+
+        self.clock.advance(0.05)
+        self.wheel.callLater(0.1, self.fired.append, 1)
+        self.clock.advance(0.099)
+        self.assertEqual([], self.fired)
+        self.clock.advance(0.001)
+        self.assertEqual([1], self.fired)
+
+    def test_earlier_timer_in_same_slot(self):
+
+        self.wheel.callLater(0.18, self.fired.append, 2)
+        self.assertAlmostEqual(0.18, self.clock.getDelayedCalls()[0].getTime())
+        self.wheel.callLater(0.12, self.fired.append, 1)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.assertAlmostEqual(0.12, self.clock.getDelayedCalls()[0].getTime())
+
+        # later timer of the same slot isn't fired early
+        self.clock.advance(0.12)
+        self.assertEqual([1], self.fired)
+        self.assertAlmostEqual(0.18, self.clock.getDelayedCalls()[0].getTime())
+        self.clock.advance(0.06)
+        self.assertEqual([1, 2], self.fired)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_cancel(self):
+
+        t1 = self.wheel.callLater(0.5, self.fired.append, 1)
+        t2 = self.wheel.callLater(0.5, self.fired.append, 2)
+        t1.cancel()
+        self.assertFalse(t1.active())
+        self.assertTrue(t2.active())
+
+        self.clock.advance(1)
+        self.assertEqual([2], self.fired)
+        self.assertFalse(t2.active())
+
+    def test_delay_longer_than_wheel(self):
+
+        self.wheel.callLater(2.0, self.fired.append, 'late')
+        self.wheel.callLater(0.3, self.fired.append, 'early')
+
+        self.clock.pump([0.1] * 5)
+        self.assertEqual(['early'], self.fired)
+        self.clock.pump([0.1] * 14)
+        self.assertEqual(['early'], self.fired)
+        self.clock.advance(0.1)
+        self.assertEqual(['early', 'late'], self.fired)
+
+    def test_clock_lag(self):
+
+        self.wheel.callLater(0.3, self.fired.append, 1)
+        self.wheel.callLater(3.0, self.fired.append, 2)
+        self.clock.advance(10)
+        self.assertEqual([1, 2], self.fired)
+
+    def test_runner(self):
+
+        runs = []
+
+        def runner(fn, timers):
+            runs.append(len(timers))
+            return fn(timers)
+
+        self.wheel.runner = runner
+        for i in range(3):
+            self.wheel.callLater(0.1, self.fired.append, i)
+        self.wheel.callLater(0.2, self.fired.append, 3)
+
+        self.clock.pump([0.1, 0.1])
+        self.assertEqual([3, 1], runs)
+        self.assertEqual(4, len(self.fired))
+
+    def test_skip_empty_ticks(self):
+
+        self.wheel.callLater(0.55, self.fired.append, 1)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.assertAlmostEqual(0.55, self.clock.getDelayedCalls()[0].getTime())
+
+        # earlier timer reschedules ticker
+        self.wheel.callLater(0.15, self.fired.append, 0)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.assertAlmostEqual(0.15, self.clock.getDelayedCalls()[0].getTime())
+
+        self.clock.advance(0.15)
+        self.assertEqual([0], self.fired)
+        self.assertAlmostEqual(0.55, self.clock.getDelayedCalls()[0].getTime())
+        self.clock.advance(0.4)
+        self.assertEqual([0, 1], self.fired)
+
+    def test_schedule_from_timer(self):
+
+        def fire(x):
+            self.fired.append(x)
+            if x == 1:
+                self.wheel.callLater(0.5, fire, 3)
+
+        self.wheel.callLater(0.1, fire, 1)
+        self.wheel.callLater(0.3, fire, 2)
+        self.clock.pump([0.1, 0.2, 0.3])
+        self.assertEqual([1, 2, 3], self.fired)
@@ -1,10 +1,16 @@
 # coding: utf-8
 
+import math
+import heapq
 import functools
+import itertools
 
 from twisted.internet import defer, reactor, task
 from twisted.python import failure
 
+import logging
+logger = logging.getLogger(__name__)
+
 __all__ = [
     'sleep',
     'timeoutDeferred',
@@ -12,6 +18,7 @@ __all__ = [
     'withParallelLimit',
     'TimeoutError',
     'CloseableDeferredQueue',
+    'TimerWheel',
 ]
 
 
@@ -115,3 +122,144 @@ class CloseableDeferredQueue(defer.DeferredQueue):
             return defer.succeed(self.pending.pop(0))
         self._ensure_open()
         return defer.DeferredQueue.get(self)
+
+
+class _WheelTimer(object):
+
+    __slots__ = ('wheel', 'due', 'at', 'fn', 'args', 'kwargs')
+
+    def __init__(self, wheel, due, at, fn, args, kwargs):
+        self.wheel = wheel
+        self.due = due
+        self.at = at
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def active(self):
+        return self.wheel is not None
+
+    def cancel(self):
+        if self.wheel is None:
+            raise Exception("timer already called or cancelled")
+        self.wheel._cancel(self)
+
+
+class TimerWheel(object):
+
+    """Hashed timer wheel - cheap replacement for `callLater` for many timers.
+
+    Timers are hashed into `tick` seconds wide slots, reactor sees at most
+    one delayed call per wheel, set to deadline of the earliest timer.
+    Timers never fire early; all timers due at that moment are fired from
+    single reactor call (optionally wrapped by `runner`), others wait for
+    next call.  Scheduling costs O(log n) for n timers of one slot,
+    cancelling costs O(1).
+    """
+
+    def __init__(self, tick=0.1, wheel_size=512, clock=None, runner=None):
+        assert tick > 0 and wheel_size > 0
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.clock = clock or reactor
+        self.runner = runner
+        # heaps of (deadline, seq, timer), cancelled timers are dropped lazily
+        self._slots = [[] for _ in range(wheel_size)]
+        self._seq = itertools.count()
+        self._cursor = None
+        self._ticker = None
+        self._ticker_at = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _tickOf(self, t):
+        return int(math.floor(t / self.tick))
+
+    def callLater(self, delay, fn, *args, **kwargs):
+
+        at = self.clock.seconds() + max(0, delay)
+        due = self._tickOf(at)
+        # slots before cursor contain only timers of next wheel turns
+        self._cursor = min(self._cursor, due) if self._count else due
+
+        t = _WheelTimer(self, due, at, fn, args, kwargs)
+        heapq.heappush(self._slots[due % self.wheel_size], (at, next(self._seq), t))
+        self._count += 1
+
+        if self._ticker is None:
+            self._scheduleTicker()
+        elif at < self._ticker_at:
+            self._ticker.cancel()
+            self._setTicker(at)
+        return t
+
+    def _cancel(self, t):
+        t.wheel = None
+        self._count -= 1
+
+    def _head(self, slot):
+        while slot and slot[0][2].wheel is None:
+            heapq.heappop(slot)
+        return slot[0] if slot else None
+
+    def _scheduleTicker(self):
+        # earliest timer of nearest slot (or full turn of wheel)
+        at = (self._cursor + self.wheel_size) * self.tick
+        for i in range(self._cursor, self._cursor + self.wheel_size):
+            head = self._head(self._slots[i % self.wheel_size])
+            if head is not None and head[2].due == i:
+                at = head[0]
+                break
+        self._setTicker(at)
+
+    def _setTicker(self, at):
+        self._ticker_at = at
+        self._ticker = self.clock.callLater(max(0, at - self.clock.seconds()), self._onTick)
+
+    def _onTick(self):
+
+        self._ticker = None
+        # tolerate float errors, ticker is scheduled exactly at deadline
+        now = self.clock.seconds() + 1e-9
+        now_tick = self._tickOf(now)
+        last = min(now_tick, self._cursor + self.wheel_size - 1)
+
+        expired = []
+        for i in range(self._cursor, last + 1):
+            slot = self._slots[i % self.wheel_size]
+            while slot and slot[0][0] <= now:
+                t = heapq.heappop(slot)[2]
+                if t.wheel is not None:
+                    t.wheel = None
+                    expired.append(t)
+
+        self._cursor = max(self._cursor, now_tick)
+        self._count -= len(expired)
+
+        if expired:
+            if self.runner:
+                self.runner(self._runTimers, expired)
+            else:
+                self._runTimers(expired)
+
+        if self._count and self._ticker is None:
+            self._scheduleTicker()
+
+    def _runTimers(self, timers):
+        for t in timers:
+            try:
+                t.fn(*t.args, **t.kwargs)
+            except Exception:
+                logger.exception("timer %r failed", t.fn)
+
+    def stop(self):
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        for slot in self._slots:
+            for _, _, t in slot:
+                t.wheel = None
+            del slot[:]
+        self._count = 0